@@ -0,0 +1,101 @@
+"""
+PostgreSQL backend that takes connections from an in-process
+psycopg_pool.ConnectionPool instead of opening a new one per request.
+
+    DATABASES["default"]["ENGINE"] = "asite.db.postgresql_pool"
+    DATABASES["default"]["OPTIONS"]["pool"] = {"min_size": 2, "max_size": 20}
+
+Pool options are passed to ConnectionPool, except "health_check": when
+true, every connection is checked before it is handed out.
+
+Keep CONN_MAX_AGE = 0 with this backend: Django then "closes" the
+connection at the end of every request, which hands it back to the pool.
+Needs psycopg 3 and psycopg_pool.
+"""
+import atexit
+import threading
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.psycopg_any import IsolationLevel, is_psycopg3
+
+try:
+    from psycopg_pool import ConnectionPool
+except ImportError:
+    ConnectionPool = None
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, conn_params, pool_options):
+    """One pool per database alias per process, created on first use."""
+    pool = _pools.get(alias)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(alias)
+            if pool is None:
+                pool_options = dict(pool_options)
+                if pool_options.pop("health_check", False):
+                    pool_options["check"] = ConnectionPool.check_connection
+                pool = ConnectionPool(
+                    kwargs=conn_params,
+                    name="asite-%s" % alias,
+                    open=True,
+                    **pool_options,
+                )
+                _pools[alias] = pool
+    return pool
+
+
+@atexit.register
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.close()
+        _pools.clear()
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not is_psycopg3 or ConnectionPool is None:
+            raise ImproperlyConfigured(
+                "asite.db.postgresql_pool needs psycopg 3 and psycopg_pool "
+                "(pip install 'psycopg[pool]')."
+            )
+
+    def get_pool_options(self):
+        return dict(self.settings_dict["OPTIONS"].get("pool") or {})
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        conn_params.pop("pool", None)
+        return conn_params
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, conn_params, self.get_pool_options())
+        connection = pool.getconn()
+        options = self.settings_dict["OPTIONS"]
+        if "isolation_level" in options:
+            try:
+                self.isolation_level = IsolationLevel(options["isolation_level"])
+            except ValueError:
+                pool.putconn(connection)
+                raise ImproperlyConfigured(
+                    "Invalid transaction isolation level %s specified."
+                    % options["isolation_level"]
+                )
+            connection.isolation_level = self.isolation_level
+        else:
+            self.isolation_level = IsolationLevel.READ_COMMITTED
+        return connection
+
+    def _close(self):
+        # Give the connection back; the pool rolls back anything open
+        # and throws broken connections away.
+        if self.connection is not None:
+            with self.wrap_database_errors:
+                _pools[self.alias].putconn(self.connection)
@@ -1,6 +1,11 @@
 # LZY custom table definitions with function to create it
 #     using direct django.db.connection
 
+import csv
+import io
+
+from django.db import connection
+
 lzy_table00_def = """
 CREATE TABLE lzy_table00 (
     version TEXT,
@@ -11,7 +16,289 @@ CREATE TABLE lzy_table00 (
 lzy_table01_def = """
 """
 
-from django.db import connection
+# Optional flat copy of the journal, range partitioned by tdate
+#     (one partition per month), kept in sync by triggers on
+#     psql_journal_transactionrecord / psql_journal_transaction.
+# Queries with a tdate range only touch the matching partitions,
+#     and an old month can be detached without touching the hot tables.
+# The partition of a month is created by the first row of that month;
+#     the default partition only gets rows of detached months.
+lzy_journal_part_def = """
+CREATE TABLE IF NOT EXISTS lzy_journal_part (
+    record_id       BIGINT       NOT NULL,
+    transaction_id  BIGINT       NOT NULL,
+    tdate           DATE         NOT NULL,
+    record_num      SMALLINT     NOT NULL,
+    account_id      BIGINT       NOT NULL,
+    amount          BIGINT       NOT NULL,
+    side            CHAR(1)      NOT NULL,
+    PRIMARY KEY (tdate, record_id)
+) PARTITION BY RANGE (tdate);
+
+CREATE INDEX IF NOT EXISTS lzy_journal_part_account_idx
+    ON lzy_journal_part (account_id, tdate);
+
+CREATE TABLE IF NOT EXISTS lzy_journal_part_default
+    PARTITION OF lzy_journal_part DEFAULT;
+
+-- Create and attach the partition of the month of d unless it exists.
+-- Rows of that month already in the default partition are moved first,
+--     as in lzy_journal_part_month_def.
+CREATE OR REPLACE FUNCTION lzy_journal_part_ensure(d DATE) RETURNS void AS $$
+DECLARE
+    part  TEXT := 'lzy_journal_part_' || to_char(d, 'YYYYMM');
+    first DATE := date_trunc('month', d)::date;
+    next  DATE := (date_trunc('month', d) + interval '1 month')::date;
+BEGIN
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    -- one creator at a time, the others find the partition made
+    LOCK TABLE lzy_journal_part IN SHARE ROW EXCLUSIVE MODE;
+    IF to_regclass(part) IS NOT NULL THEN
+        RETURN;
+    END IF;
+    EXECUTE format('CREATE TABLE %I (LIKE lzy_journal_part INCLUDING DEFAULTS)',
+                   part);
+    EXECUTE format('WITH moved AS (DELETE FROM lzy_journal_part_default '
+                   'WHERE tdate >= %L AND tdate < %L RETURNING *) '
+                   'INSERT INTO %I SELECT * FROM moved', first, next, part);
+    EXECUTE format('ALTER TABLE lzy_journal_part ATTACH PARTITION %I '
+                   'FOR VALUES FROM (%L) TO (%L)', part, first, next);
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION lzy_journal_part_sync() RETURNS trigger AS $$
+BEGIN
+    IF TG_TABLE_NAME = 'psql_journal_transaction' THEN
+        PERFORM lzy_journal_part_ensure(NEW.tdate);
+        UPDATE lzy_journal_part SET tdate = NEW.tdate
+            WHERE transaction_id = NEW.id AND tdate <> NEW.tdate;
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM lzy_journal_part WHERE record_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM lzy_journal_part_ensure(t.tdate)
+            FROM psql_journal_transaction t WHERE t.id = NEW.transaction_id;
+        INSERT INTO lzy_journal_part
+            SELECT NEW.id, NEW.transaction_id, t.tdate, NEW.record_num,
+                   NEW.account_id, NEW.amount, NEW.side
+            FROM psql_journal_transaction t WHERE t.id = NEW.transaction_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS lzy_journal_part_rec ON psql_journal_transactionrecord;
+CREATE TRIGGER lzy_journal_part_rec
+    AFTER INSERT OR UPDATE OR DELETE ON psql_journal_transactionrecord
+    FOR EACH ROW EXECUTE FUNCTION lzy_journal_part_sync();
+
+DROP TRIGGER IF EXISTS lzy_journal_part_txn ON psql_journal_transaction;
+CREATE TRIGGER lzy_journal_part_txn
+    AFTER UPDATE OF tdate ON psql_journal_transaction
+    FOR EACH ROW EXECUTE FUNCTION lzy_journal_part_sync();
+"""
+
+lzy_journal_part_drop = """
+DROP TRIGGER IF EXISTS lzy_journal_part_rec ON psql_journal_transactionrecord;
+DROP TRIGGER IF EXISTS lzy_journal_part_txn ON psql_journal_transaction;
+DROP FUNCTION IF EXISTS lzy_journal_part_sync();
+DROP FUNCTION IF EXISTS lzy_journal_part_ensure(DATE);
+DROP TABLE IF EXISTS lzy_journal_part;
+"""
+
+# Format with name, start, end (dates as 'YYYY-MM-DD').
+# Rows of that month sitting in the default partition are moved first,
+#     otherwise ATTACH fails.
+lzy_journal_part_month_def = """
+CREATE TABLE {name} (LIKE lzy_journal_part INCLUDING DEFAULTS);
+WITH moved AS (
+    DELETE FROM lzy_journal_part_default
+    WHERE tdate >= '{start}' AND tdate < '{end}'
+    RETURNING *
+)
+INSERT INTO {name} SELECT * FROM moved;
+ALTER TABLE lzy_journal_part ATTACH PARTITION {name}
+    FOR VALUES FROM ('{start}') TO ('{end}');
+"""
+
+lzy_journal_part_fill = """
+SELECT lzy_journal_part_ensure(tdate)
+FROM (SELECT DISTINCT date_trunc('month', tdate)::date AS tdate
+      FROM psql_journal_transaction) months;
+INSERT INTO lzy_journal_part
+SELECT r.id, r.transaction_id, t.tdate, r.record_num,
+       r.account_id, r.amount, r.side
+FROM psql_journal_transactionrecord r
+JOIN psql_journal_transaction t ON t.id = r.transaction_id
+ON CONFLICT DO NOTHING;
+"""
+
+# Optional materialized view of monthly totals per account, read by the
+#     reports (psql_journal/matviews.py) instead of the journal.
+# The unique index is what REFRESH ... CONCURRENTLY needs; readers are
+#     not blocked while it runs.
+# lzy_matview_refresh remembers when each view was last refreshed, so
+#     readers can tell whether it is fresh enough.
+lzy_account_month_def = """
+CREATE MATERIALIZED VIEW IF NOT EXISTS lzy_account_month AS
+SELECT r.account_id,
+       date_trunc('month', t.tdate)::date                      AS month,
+       SUM(CASE WHEN r.side = 'D' THEN r.amount ELSE 0 END)::bigint AS debit,
+       SUM(CASE WHEN r.side = 'C' THEN r.amount ELSE 0 END)::bigint AS credit,
+       COUNT(*)                                                AS records
+FROM psql_journal_transactionrecord r
+JOIN psql_journal_transaction t ON t.id = r.transaction_id
+GROUP BY r.account_id, date_trunc('month', t.tdate)
+WITH DATA;
+
+CREATE UNIQUE INDEX IF NOT EXISTS lzy_account_month_uniq
+    ON lzy_account_month (account_id, month);
+CREATE INDEX IF NOT EXISTS lzy_account_month_month_idx
+    ON lzy_account_month (month);
+
+CREATE TABLE IF NOT EXISTS lzy_matview_refresh (
+    name            TEXT         PRIMARY KEY,
+    refreshed_at    TIMESTAMPTZ  NOT NULL,
+    duration_ms     DOUBLE PRECISION
+);
+INSERT INTO lzy_matview_refresh (name, refreshed_at)
+    VALUES ('lzy_account_month', now())
+    ON CONFLICT (name) DO UPDATE SET refreshed_at = EXCLUDED.refreshed_at;
+"""
+
+lzy_account_month_drop = """
+DROP MATERIALIZED VIEW IF EXISTS lzy_account_month;
+DROP TABLE IF EXISTS lzy_matview_refresh;
+"""
+
+# Double-entry check: every psql_journal_transaction must balance
+#     (debits = credits) when the database transaction commits.
+# Statement triggers on psql_journal_transactionrecord note the touched
+#     transaction ids in lzy_balance_pending (one INSERT ... SELECT per
+#     statement, so COPY and bulk inserts stay set-based) and put one
+#     marker row per database transaction in lzy_balance_check.
+# The deferred constraint trigger on the marker fires once at COMMIT and
+#     checks all the noted transactions in one GROUP BY query.
+lzy_balance_check_def = """
+CREATE UNLOGGED TABLE IF NOT EXISTS lzy_balance_pending (
+    xid             BIGINT  NOT NULL,
+    transaction_id  BIGINT  NOT NULL,
+    PRIMARY KEY (xid, transaction_id)
+);
+CREATE UNLOGGED TABLE IF NOT EXISTS lzy_balance_check (
+    xid             BIGINT  PRIMARY KEY
+);
+
+CREATE OR REPLACE FUNCTION lzy_balance_note() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO lzy_balance_pending
+            SELECT DISTINCT txid_current(), transaction_id FROM new_rows
+            ON CONFLICT DO NOTHING;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        INSERT INTO lzy_balance_pending
+            SELECT DISTINCT txid_current(), transaction_id FROM old_rows
+            ON CONFLICT DO NOTHING;
+    END IF;
+    INSERT INTO lzy_balance_check VALUES (txid_current())
+        ON CONFLICT DO NOTHING;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION lzy_balance_verify() RETURNS trigger AS $$
+DECLARE
+    bad TEXT;
+BEGIN
+    SELECT string_agg(transaction_id::text, ', ') INTO bad FROM (
+        SELECT p.transaction_id
+        FROM lzy_balance_pending p
+        JOIN psql_journal_transactionrecord r
+            ON r.transaction_id = p.transaction_id
+        WHERE p.xid = NEW.xid
+        GROUP BY p.transaction_id
+        HAVING SUM(CASE WHEN r.side = 'D' THEN r.amount
+                        ELSE -r.amount END) <> 0
+        ORDER BY p.transaction_id
+        LIMIT 20
+    ) unbalanced;
+    IF bad IS NOT NULL THEN
+        RAISE EXCEPTION 'unbalanced transactions: %', bad
+            USING ERRCODE = 'check_violation';
+    END IF;
+    DELETE FROM lzy_balance_pending WHERE xid = NEW.xid;
+    DELETE FROM lzy_balance_check WHERE xid = NEW.xid;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS lzy_balance_note_ins ON psql_journal_transactionrecord;
+CREATE TRIGGER lzy_balance_note_ins
+    AFTER INSERT ON psql_journal_transactionrecord
+    REFERENCING NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION lzy_balance_note();
+DROP TRIGGER IF EXISTS lzy_balance_note_upd ON psql_journal_transactionrecord;
+CREATE TRIGGER lzy_balance_note_upd
+    AFTER UPDATE ON psql_journal_transactionrecord
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION lzy_balance_note();
+DROP TRIGGER IF EXISTS lzy_balance_note_del ON psql_journal_transactionrecord;
+CREATE TRIGGER lzy_balance_note_del
+    AFTER DELETE ON psql_journal_transactionrecord
+    REFERENCING OLD TABLE AS old_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION lzy_balance_note();
+
+DROP TRIGGER IF EXISTS lzy_balance_verify ON lzy_balance_check;
+CREATE CONSTRAINT TRIGGER lzy_balance_verify
+    AFTER INSERT ON lzy_balance_check
+    DEFERRABLE INITIALLY DEFERRED
+    FOR EACH ROW EXECUTE FUNCTION lzy_balance_verify();
+"""
+
+lzy_balance_check_drop = """
+DROP TRIGGER IF EXISTS lzy_balance_note_ins ON psql_journal_transactionrecord;
+DROP TRIGGER IF EXISTS lzy_balance_note_upd ON psql_journal_transactionrecord;
+DROP TRIGGER IF EXISTS lzy_balance_note_del ON psql_journal_transactionrecord;
+DROP TABLE IF EXISTS lzy_balance_check;
+DROP TABLE IF EXISTS lzy_balance_pending;
+DROP FUNCTION IF EXISTS lzy_balance_note();
+DROP FUNCTION IF EXISTS lzy_balance_verify();
+"""
+
+# Search indexes of psql_journal/search.py, created by migration 0013.
+# desc_tsv is the parsed Transaction.desc ("desc" is a reserved word,
+#     hence the quotes), stored so that ranking the matches does not
+#     parse every description again. Not a model field: the database
+#     fills it on every write.
+# The full-text index on it matches whole words and word prefixes.
+lzy_search_fts_def = """
+ALTER TABLE psql_journal_transaction ADD COLUMN IF NOT EXISTS desc_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('simple', "desc")) STORED;
+CREATE INDEX IF NOT EXISTS psqlj_txn_desc_fts_idx
+    ON psql_journal_transaction USING gin (desc_tsv);
+"""
+
+# The trigram indexes serve ILIKE '%fragment%' anywhere in a word.
+#     Only created where the pg_trgm extension is available.
+lzy_search_trgm_def = """
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS psqlj_txn_desc_trgm_idx
+    ON psql_journal_transaction USING gin ("desc" gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS psqlj_account_trgm_idx
+    ON psql_journal_account USING gin (code gin_trgm_ops, name gin_trgm_ops);
+"""
+
+lzy_search_drop = """
+DROP INDEX IF EXISTS psqlj_txn_desc_fts_idx;
+DROP INDEX IF EXISTS psqlj_txn_desc_trgm_idx;
+DROP INDEX IF EXISTS psqlj_account_trgm_idx;
+ALTER TABLE psql_journal_transaction DROP COLUMN IF EXISTS desc_tsv;
+"""
 
 def lzy_custom_sql(sql_str):
     # Execute an sql and return the result
@@ -26,3 +313,39 @@ def lzy_open_txtfile(filename):
     with open(filename, 'rt', encoding="utf-8") as f:
         read_data = f.read()
     return read_data
+
+
+def lzy_copy_from(table, columns, rows):
+    # COPY rows (iterable of tuples) into table using the raw
+    #     psycopg cursor behind django.db.connection.
+    # Works with both psycopg 3 (cursor.copy) and psycopg2 (copy_expert).
+    # Caller must be inside transaction.atomic() to get all-or-nothing.
+    copy_sql = "COPY %s (%s) FROM STDIN" % (
+        connection.ops.quote_name(table),
+        ", ".join(connection.ops.quote_name(c) for c in columns),
+    )
+    with connection.cursor() as cursor:
+        raw = cursor.cursor
+        if hasattr(raw, "copy"):
+            with raw.copy(copy_sql) as copy:
+                for row in rows:
+                    copy.write_row(row)
+        else:
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for row in rows:
+                writer.writerow(["\\N" if v is None else v for v in row])
+            buf.seek(0)
+            raw.copy_expert(copy_sql + " WITH (FORMAT csv, NULL '\\N')", buf)
+
+
+def lzy_reserve_ids(table, count):
+    # Take count values from the id sequence of table, so parent rows
+    #     can be COPYed together with their children.
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            [table, count],
+        )
+        return [r[0] for r in cursor.fetchall()]
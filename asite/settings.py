@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/4.2/ref/settings/
 """
 
+import copy
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # LZY: first, so its "total" timing covers the rest
+    'psql_journal.instrumentation.RequestProfileMiddleware',
+    # LZY: picks primary or replica for the request's reads
+    'psql_journal.replicas.ReplicaRouterMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -75,17 +81,152 @@ WSGI_APPLICATION = 'asite.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.2/ref/settings/#databases
 
+# LZY: everything below can be overridden from the environment,
+#   e.g. ASITE_DB_HOST=db ASITE_DB_CONN_MAX_AGE=300 gunicorn asite.wsgi
+
+def env_int(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    if value.lower() == 'none':
+        return None
+    return int(value)
+
+def env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.postgresql',
-        'NAME': 'asitedatabase',
-        'USER': 'lianto',
-        'PASSWORD': '123456',
-        'HOST': 'localhost',
-        'PORT': '5432',
+        'NAME': os.environ.get('ASITE_DB_NAME', 'asitedatabase'),
+        'USER': os.environ.get('ASITE_DB_USER', 'lianto'),
+        'PASSWORD': os.environ.get('ASITE_DB_PASSWORD', '123456'),
+        'HOST': os.environ.get('ASITE_DB_HOST', 'localhost'),
+        'PORT': os.environ.get('ASITE_DB_PORT', '5432'),
+        # Persistent connections: keep a worker's connection for this many
+        #   seconds instead of reconnecting on every request
+        #   (0 = close after each request, none = forever).
+        'CONN_MAX_AGE': env_int('ASITE_DB_CONN_MAX_AGE', 60),
+        # Check a reused connection at the start of each request, so a
+        #   connection dropped by the server is replaced, not an error.
+        'CONN_HEALTH_CHECKS': env_bool('ASITE_DB_CONN_HEALTH_CHECKS', True),
+        'OPTIONS': {},
     }
 }
 
+# LZY: in-process connection pool (asite/db/postgresql_pool), mainly for
+#   the ASGI deployment where every request runs its queries in its own
+#   thread, so persistent connections would pile up. Turn on with
+#   ASITE_DB_POOL=1, needs psycopg[pool].
+if env_bool('ASITE_DB_POOL', False):
+    DATABASES['default']['ENGINE'] = 'asite.db.postgresql_pool'
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': env_int('ASITE_DB_POOL_MIN', 2),
+        'max_size': env_int('ASITE_DB_POOL_MAX', 20),
+        'timeout': float(os.environ.get('ASITE_DB_POOL_TIMEOUT', '10')),
+        # recycle idle/old connections, test them before handing out
+        'max_idle': float(os.environ.get('ASITE_DB_POOL_MAX_IDLE', '600')),
+        'max_lifetime': float(os.environ.get('ASITE_DB_POOL_MAX_LIFETIME', '3600')),
+        'health_check': env_bool('ASITE_DB_POOL_HEALTH_CHECKS', True),
+    }
+    # the pool keeps the connections, Django must hand them back
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+    DATABASES['default']['CONN_HEALTH_CHECKS'] = False
+
+# LZY: read replica for the journal's list, search, report and export
+#   reads (psql_journal/replicas.py). Set ASITE_DB_REPLICA_HOST and/or
+#   ASITE_DB_REPLICA_NAME; the rest defaults to the primary's settings.
+#   Reads fall back to the primary while the replica lags more than
+#   ASITE_DB_REPLICA_MAX_LAG seconds, and a client stays on the primary
+#   for ASITE_DB_REPLICA_STICKY seconds after it wrote.
+if os.environ.get('ASITE_DB_REPLICA_HOST') or os.environ.get('ASITE_DB_REPLICA_NAME'):
+    DATABASES['replica'] = copy.deepcopy(DATABASES['default'])
+    for key in ('HOST', 'PORT', 'NAME', 'USER', 'PASSWORD'):
+        value = os.environ.get('ASITE_DB_REPLICA_' + key)
+        if value:
+            DATABASES['replica'][key] = value
+    # tests run against the primary only
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+DATABASE_ROUTERS = ['psql_journal.replicas.ReplicaRouter']
+PSQLJ_REPLICA_ALIAS = 'replica'
+PSQLJ_REPLICA_MAX_LAG = float(os.environ.get('ASITE_DB_REPLICA_MAX_LAG', '5'))
+PSQLJ_REPLICA_STICKY = env_int('ASITE_DB_REPLICA_STICKY', 10)
+
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# LZY: rendered journal pages and report fragments (psql_journal/pagecache.py).
+#   Page caching needs a cache every process shares, since imports and
+#   job workers invalidate it: ASITE_CACHE_REDIS_URL (needs the redis
+#   package) for several hosts, else a directory on this host,
+#   ASITE_CACHE_DIR (default var/cache).
+if os.environ.get('ASITE_CACHE_REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.environ['ASITE_CACHE_REDIS_URL'],
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.environ.get('ASITE_CACHE_DIR',
+                                       str(BASE_DIR / 'var' / 'cache')),
+            'OPTIONS': {'MAX_ENTRIES': env_int('ASITE_CACHE_MAX_ENTRIES', 1000)},
+        }
+    }
+
+PSQLJ_PAGE_CACHE = 'default'
+PSQLJ_PAGE_CACHE_TIMEOUT = env_int('ASITE_PAGE_CACHE_TIMEOUT', 300)
+PSQLJ_PAGE_CACHE_ENABLED = env_bool('ASITE_PAGE_CACHE', True)
+
+# LZY: share of requests that get a Server-Timing header and a
+#   "psql_journal.profile" log line (psql_journal/instrumentation.py).
+PSQLJ_PROFILE_SAMPLE_RATE = float(os.environ.get('ASITE_PROFILE_SAMPLE_RATE', '0.01'))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'psql_journal.profile': {
+            'handlers': ['console'],
+            'level': os.environ.get('ASITE_PROFILE_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
+# LZY: batch entry in TwoInputMultipleCreateView (rows per POST, rows per
+#   INSERT). Every row posts a few fields, so the field limit follows.
+PSQLJ_BATCH_MAX_ROWS = env_int('ASITE_BATCH_MAX_ROWS', 5000)
+PSQLJ_BATCH_CHUNK_SIZE = env_int('ASITE_BATCH_CHUNK_SIZE', 1000)
+DATA_UPLOAD_MAX_NUMBER_FIELDS = max(1000, PSQLJ_BATCH_MAX_ROWS * 4)
+# transactions and bytes per request to api/transactions/bulk/, which
+#   reads its body from the stream past DATA_UPLOAD_MAX_MEMORY_SIZE
+PSQLJ_API_MAX_BATCH = env_int('ASITE_API_MAX_BATCH', 10000)
+PSQLJ_API_MAX_BYTES = env_int('ASITE_API_MAX_BYTES', 32 * 1024 * 1024)
+PSQLJ_API_MAX_LINE_BYTES = env_int('ASITE_API_MAX_LINE_BYTES', 1024 * 1024)
+
+# LZY: background jobs (psql_journal/jobs.py, manage.py run_jobs).
+#   Files imported or exported by jobs live in PSQLJ_JOB_DIR.
+PSQLJ_JOB_DIR = os.environ.get('ASITE_JOB_DIR', str(BASE_DIR / 'var' / 'jobs'))
+PSQLJ_JOB_STALE_AFTER = env_int('ASITE_JOB_STALE_AFTER', 600)
+
+# LZY: Parquet files of archived months (psql_journal/archive.py,
+#   manage.py archive_journal); needs pyarrow.
+PSQLJ_ARCHIVE_DIR = os.environ.get('ASITE_ARCHIVE_DIR', str(BASE_DIR / 'var' / 'archive'))
+
+# LZY: date ranges psql_journal.columnar.ledger() keeps loaded per process.
+PSQLJ_COLUMNAR_MAX_LEDGERS = env_int('ASITE_COLUMNAR_MAX_LEDGERS', 4)
+
 # LZY 21Jan24
 AUTH_USER_MODEL = "myuser.User"
 
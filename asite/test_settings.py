@@ -0,0 +1,28 @@
+"""
+Settings for the test suite:
+
+    python manage.py test --settings=asite.test_settings
+"""
+
+import copy
+
+from .settings import *  # noqa: F401,F403
+from .settings import DATABASES, LOGGING
+
+# a mirror of the test database, so the replica routing is tested too
+if 'replica' not in DATABASES:
+    DATABASES['replica'] = copy.deepcopy(DATABASES['default'])
+    DATABASES['replica']['TEST'] = {'MIRROR': 'default'}
+
+# per process: no page from an earlier run is served, and page caching
+#   is off except where a test sets up a shared cache
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'asite-test',
+    }
+}
+
+# no sampled requests, and no profile lines on the test output
+PSQLJ_PROFILE_SAMPLE_RATE = 0.0
+LOGGING['loggers']['psql_journal.profile']['level'] = 'WARNING'
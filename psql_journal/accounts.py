@@ -0,0 +1,48 @@
+"""
+Chart of accounts helpers: code lookups and subtree roll-ups.
+"""
+from django.core.exceptions import ValidationError
+from django.db.models import Sum
+
+from .models import Account, AccountBalance
+
+
+def resolve_codes(codes, create=True):
+    """
+    Return {code: account id} for codes with one query. Unknown codes
+    become new root accounts (one bulk insert), or raise ValidationError
+    when create is False.
+    """
+    codes = set(codes)
+    found = dict(Account.objects.filter(code__in=codes).values_list("code", "id"))
+    missing = codes - found.keys()
+    if missing:
+        if not create:
+            raise ValidationError(
+                "Unknown account(s): %(codes)s.", code="unknown_account",
+                params={"codes": ", ".join(sorted(missing))})
+        Account.objects.bulk_create(
+            [Account(code=code) for code in sorted(missing)],
+            ignore_conflicts=True,
+        )
+        Account.fill_missing_paths()
+        found.update(
+            Account.objects.filter(code__in=missing).values_list("code", "id"))
+    return found
+
+
+def subtree(account):
+    """account and all its descendants."""
+    return Account.objects.filter(path__startswith=account.path)
+
+
+def subtree_balance(account):
+    """
+    {"debit", "credit", "balance"} of account and all its descendants,
+    one query over AccountBalance joined on the path index.
+    """
+    totals = AccountBalance.objects.filter(
+        account__path__startswith=account.path,
+    ).aggregate(debit=Sum("debit", default=0), credit=Sum("credit", default=0))
+    totals["balance"] = totals["debit"] - totals["credit"]
+    return totals
@@ -0,0 +1,528 @@
+"""
+JSON API of the journal.
+
+The read views are coroutines: under ASGI (asite/asgi.py) a request
+waiting on PostgreSQL does not hold a worker. Under WSGI they still work,
+Django runs them in an event loop per request. They read from the
+replica when one is configured (replicas.py).
+
+post_transactions is the machine write path: a batch of entries in the
+bulkload format, checked without forms and written with one bulk insert.
+upload_journal takes files of any size, see the "Streamed uploads"
+section.
+"""
+import codecs
+import datetime
+import itertools
+import json
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, IntegrityError, transaction
+from django.db.models import Prefetch, Sum
+from django.http import FileResponse, Http404, JsonResponse, UnreadablePostError
+from django.urls import reverse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
+from django.views.generic.base import View
+
+from . import bulkload, jobs, search
+from .replicas import replica_reads
+from .models import (
+    Account,
+    AccountBalance,
+    Job,
+    JournalUpload,
+    Transaction,
+    TransactionRecord,
+)
+from .views import KeysetPaginationMixin
+
+
+NDJSON_TYPES = ("application/x-ndjson", "application/jsonl",
+                "application/x-jsonlines")
+DEFAULT_MAX_BATCH = 10000
+DEFAULT_MAX_BYTES = 32 * 1024 * 1024
+DEFAULT_MAX_LINE_BYTES = 1024 * 1024
+UPLOAD_TYPES = {"text/csv": "csv", **{t: "jsonl" for t in NDJSON_TYPES}}
+UPLOAD_STALE_AFTER = datetime.timedelta(minutes=5)
+
+
+def record_json(rec):
+    return {
+        "record_num": rec.record_num,
+        "account": rec.account.code,
+        "side": rec.side,
+        "amount": rec.amount,
+    }
+
+
+def transaction_json(txn, records):
+    return {
+        "id": txn.id,
+        "tdate": txn.tdate.isoformat(),
+        "desc": txn.desc,
+        "records": [record_json(r) for r in records],
+    }
+
+
+class AsyncTransactionListView(KeysetPaginationMixin, View):
+    """Keyset-paged transactions with their records."""
+    replica_reads = True
+    model = Transaction
+    keyset_fields = ("tdate", "id")
+
+    def get_queryset(self):
+        return Transaction.objects.prefetch_related(
+            Prefetch(
+                "transactionrecord_set",
+                queryset=TransactionRecord.objects.select_related(
+                    "account").order_by("record_num"),
+                to_attr="records",
+            )
+        )
+
+    async def get(self, request, *args, **kwargs):
+        queryset, forward = self.keyset_queryset(self.get_queryset())
+        rows = [txn async for txn in queryset]
+        page = self.keyset_page(rows, forward)
+        return JsonResponse({
+            "results": [
+                transaction_json(txn, txn.records)
+                for txn in page["object_list"]
+            ],
+            "next": page["next_cursor"] if page["has_next"] else None,
+            "previous": (page["previous_cursor"]
+                         if page["has_previous"] else None),
+        })
+
+
+@replica_reads
+async def transaction_detail(request, pk):
+    try:
+        txn = await Transaction.objects.aget(pk=pk)
+    except Transaction.DoesNotExist:
+        raise Http404("No such transaction.")
+    records = [
+        rec async for rec in
+        TransactionRecord.objects.filter(transaction_id=pk)
+        .select_related("account").order_by("record_num")
+    ]
+    return JsonResponse(transaction_json(txn, records))
+
+
+@replica_reads
+def search_transactions(request):
+    """?q=&account=&limit=, ranked; pass "next" back as ?after=."""
+    try:
+        page = search.search(
+            request.GET.get("q", ""),
+            request.GET.get("account", ""),
+            after=request.GET.get("after"),
+            limit=int(request.GET.get("limit", search.DEFAULT_LIMIT)),
+        )
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse({
+        "results": [
+            {**transaction_json(txn, txn.records), "rank": rank}
+            for txn, rank in page["results"]
+        ],
+        "next": page["next"],
+    })
+
+
+@replica_reads
+async def account_balances(request):
+    """
+    All account balances, or those whose code starts with ?account=.
+    ?rollup=<code> gives the total of that account and its subtree.
+    """
+    rollup = request.GET.get("rollup")
+    if rollup:
+        try:
+            acc = await Account.objects.aget(code=rollup)
+        except Account.DoesNotExist:
+            raise Http404("No such account.")
+        totals = await AccountBalance.objects.filter(
+            account__path__startswith=acc.path,
+        ).aaggregate(debit=Sum("debit", default=0),
+                     credit=Sum("credit", default=0))
+        return JsonResponse({
+            "account": acc.code,
+            "debit": totals["debit"],
+            "credit": totals["credit"],
+            "balance": totals["debit"] - totals["credit"],
+        })
+
+    qs = AccountBalance.objects.select_related("account").order_by(
+        "account__code")
+    prefix = request.GET.get("account")
+    if prefix:
+        qs = qs.filter(account__code__startswith=prefix)
+    return JsonResponse({
+        "results": [
+            {
+                "account": b.account.code,
+                "debit": b.debit,
+                "credit": b.credit,
+                "balance": b.balance,
+            }
+            async for b in qs
+        ],
+    })
+
+
+##############
+# Bulk posting
+
+def max_batch():
+    return getattr(settings, "PSQLJ_API_MAX_BATCH", DEFAULT_MAX_BATCH)
+
+
+def max_bytes():
+    return getattr(settings, "PSQLJ_API_MAX_BYTES", DEFAULT_MAX_BYTES)
+
+
+def max_line_bytes():
+    return getattr(settings, "PSQLJ_API_MAX_LINE_BYTES",
+                   DEFAULT_MAX_LINE_BYTES)
+
+
+class BodyTooLarge(Exception):
+    """The request body, or one ndjson line of it, is over the limit."""
+
+
+def _limited_lines(request, limit, line_limit):
+    """Lines of the body, reading at most line_limit + 1 bytes at a time."""
+    total = 0
+    for lineno in itertools.count(1):
+        line = request.readline(line_limit + 1)
+        if not line:
+            return
+        total += len(line)
+        if total > limit:
+            raise BodyTooLarge("The body is larger than %d bytes." % limit)
+        if len(line) > line_limit and not line.endswith(b"\n"):
+            raise BodyTooLarge("Line %d is longer than %d bytes."
+                               % (lineno, line_limit))
+        yield line
+
+
+def read_batch(request):
+    """
+    The raw entries of the request body: a JSON list (or an object with
+    a "transactions" list), or one JSON entry per line for ndjson.
+    Read from the stream, so DATA_UPLOAD_MAX_MEMORY_SIZE does not apply;
+    max_bytes() caps the body and max_line_bytes() each ndjson line
+    (BodyTooLarge), max_batch() the number of entries.
+    """
+    limit = max_bytes()
+    try:
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        length = 0
+    if length > limit:
+        raise BodyTooLarge("The body is larger than %d bytes." % limit)
+    if request.content_type in NDJSON_TYPES:
+        lines = _limited_lines(request, limit, max_line_bytes())
+        return list(itertools.islice(bulkload.iter_jsonl(lines),
+                                     max_batch() + 1))
+    body = request.read(limit + 1)
+    if len(body) > limit:
+        raise BodyTooLarge("The body is larger than %d bytes." % limit)
+    try:
+        data = json.loads(body or b"null")
+    except ValueError as e:
+        raise ValidationError("Invalid JSON: %(e)s", code="invalid",
+                              params={"e": e})
+    if isinstance(data, dict):
+        data = data.get("transactions")
+    if not isinstance(data, list):
+        raise ValidationError("Expected a list of transactions.",
+                              code="invalid")
+    return data[:max_batch() + 1]
+
+
+def _write_new(entries, positions, results):
+    """
+    Write the entries whose key was not posted before and fill in their
+    results. Keys are checked and written in the same transaction.
+    """
+    with transaction.atomic():
+        posted = bulkload.posted_keys(e["key"] for e in entries)
+        new, new_positions, first_of_key = [], [], {}
+        for i, entry in zip(positions, entries):
+            key = entry["key"]
+            if key in posted:
+                results[i] = {"status": "duplicate", "id": posted[key]}
+            elif key in first_of_key:
+                # repeated within the batch, same id as its first use
+                results[i] = {"status": "duplicate", "of": first_of_key[key]}
+            else:
+                new.append(entry)
+                new_positions.append(i)
+                if key:
+                    first_of_key[key] = i
+        ids = bulkload.write_entries(new)
+    for i, tid in zip(new_positions, ids):
+        results[i] = {"status": "created", "id": tid}
+    for result in results:
+        if result and "of" in result:
+            result["id"] = results[result.pop("of")]["id"]
+
+
+@csrf_exempt
+@require_POST
+def post_transactions(request):
+    """
+    Post a batch of balanced transactions.
+
+    Each item may carry a "key"; an item whose key was already posted is
+    not written again and is reported as a duplicate with its id.
+    Invalid items are reported and skipped, the valid ones are written
+    in one database transaction. With ?atomic=1 nothing is written
+    unless every item is valid (422 otherwise).
+
+    Response: {"created", "duplicates", "invalid", "results": [...]}
+    with one {"index", "status", "id" or "errors"} per item.
+    """
+    try:
+        items = read_batch(request)
+    except ValidationError as e:
+        return JsonResponse({"error": "; ".join(e.messages)}, status=400)
+    except BodyTooLarge as e:
+        return JsonResponse({"error": str(e)}, status=413)
+    if len(items) > max_batch():
+        return JsonResponse(
+            {"error": "At most %d transactions per request." % max_batch()},
+            status=413)
+
+    results = [None] * len(items)
+    entries, positions = [], []
+    for i, data in enumerate(items):
+        try:
+            entries.append(bulkload.clean_entry(data))
+            positions.append(i)
+        except ValidationError as e:
+            results[i] = {"status": "invalid", "errors": e.messages}
+
+    invalid = len(items) - len(entries)
+    status = 200
+    if invalid and request.GET.get("atomic") in ("1", "true"):
+        for i in positions:
+            results[i] = {"status": "skipped"}
+        status = 422
+    else:
+        try:
+            _write_new(entries, positions, results)
+        except IntegrityError:
+            # a concurrent request posted one of the keys first;
+            # the second try reports it as a duplicate
+            _write_new(entries, positions, results)
+
+    for i, result in enumerate(results):
+        result["index"] = i
+        if isinstance(items[i], dict) and items[i].get("key") is not None:
+            result["key"] = items[i]["key"]
+    return JsonResponse({
+        "created": sum(r["status"] == "created" for r in results),
+        "duplicates": sum(r["status"] == "duplicate" for r in results),
+        "invalid": invalid,
+        "results": results,
+    }, status=status)
+
+
+##############
+# Streamed uploads
+#   The body is read line by line straight from the request stream
+#   (never request.POST/FILES) and loaded in committed chunks, so memory
+#   stays at one chunk whatever the upload size. Under ASGI Django
+#   spools the body to a temporary file first, which is still bounded.
+#
+#   Each chunk commits together with JournalUpload.offset, the number
+#   of input entries loaded. When an upload fails (bad entry, dropped
+#   connection), fix the input and POST it again to the upload's URL,
+#   either whole or from entry N with ?start=N; the entries before the
+#   offset are skipped.
+
+def upload_json(upload):
+    return {
+        "id": upload.pk,
+        "format": upload.format,
+        "status": upload.status,
+        "offset": upload.offset,
+        "records": upload.records,
+        "duplicates": upload.duplicates,
+        "chunks": upload.chunks,
+        "error": upload.error,
+        "url": reverse("psqlj:api-upload", args=[upload.pk]),
+    }
+
+
+def body_lines(request, fmt):
+    """Lines of the request body, read as they arrive."""
+    lines = iter(request)
+    if fmt == "csv":
+        return codecs.iterdecode(lines, "utf-8")
+    return lines
+
+
+def _claim(upload):
+    """Mark upload running unless another request is loading it."""
+    stale = timezone.now() - UPLOAD_STALE_AFTER
+    return JournalUpload.objects.filter(pk=upload.pk).exclude(
+        status=JournalUpload.RUNNING, updated__gt=stale,
+    ).update(status=JournalUpload.RUNNING, error="", updated=timezone.now())
+
+
+def _load_upload(request, upload, start):
+    """Load the body of request into upload, from input entry start."""
+    skip = upload.offset - start
+    base_records, base_chunks = upload.records, upload.chunks
+    base_duplicates = upload.duplicates
+
+    def on_chunk(result):
+        JournalUpload.objects.filter(pk=upload.pk).update(
+            offset=start + result.offset,
+            records=base_records + result.records,
+            duplicates=base_duplicates + result.duplicates,
+            chunks=base_chunks + result.chunks,
+            updated=timezone.now(),
+        )
+
+    try:
+        chunk_size = int(request.GET.get("chunk_size",
+                                         bulkload.DEFAULT_CHUNK_SIZE))
+    except ValueError:
+        chunk_size = bulkload.DEFAULT_CHUNK_SIZE
+    status, error = JournalUpload.DONE, ""
+    try:
+        bulkload.load_journal(
+            bulkload.READERS[upload.format](body_lines(request, upload.format)),
+            chunk_size=max(1, min(chunk_size, 10000)),
+            skip=skip,
+            on_chunk=on_chunk,
+        )
+    except ValidationError as e:
+        status, error = JournalUpload.FAILED, "; ".join(e.messages)
+    except ValueError as e:
+        # e.g. UnicodeDecodeError
+        status, error = JournalUpload.FAILED, str(e)
+    except (UnreadablePostError, OSError) as e:
+        status, error = JournalUpload.FAILED, "Upload interrupted: %s" % e
+    except DatabaseError as e:
+        # e.g. a key posted concurrently; the chunk rolled back, resume
+        status, error = JournalUpload.FAILED, "Database error: %s" % e
+    JournalUpload.objects.filter(pk=upload.pk).update(
+        status=status, error=error, updated=timezone.now())
+    upload.refresh_from_db()
+    return upload
+
+
+@csrf_exempt
+@require_http_methods(["GET", "POST"])
+def upload_journal(request, pk=None):
+    """
+    POST api/uploads/?format=csv|jsonl  start an upload (the format can
+                                        also come from the Content-Type)
+    POST api/uploads/<id>/?start=N      resume it, body begins at entry N
+    GET  api/uploads/<id>/              progress
+    """
+    if pk is not None:
+        try:
+            upload = JournalUpload.objects.get(pk=pk)
+        except JournalUpload.DoesNotExist:
+            raise Http404("No such upload.")
+        if request.method == "GET":
+            return JsonResponse(upload_json(upload))
+    elif request.method == "GET":
+        return JsonResponse({"error": "POST a file to start an upload."},
+                            status=405)
+    else:
+        fmt = request.GET.get("format") or UPLOAD_TYPES.get(
+            request.content_type)
+        if fmt not in bulkload.READERS:
+            return JsonResponse(
+                {"error": "Unknown format, use ?format=%s."
+                          % "|".join(sorted(bulkload.READERS))},
+                status=400)
+        upload = JournalUpload.objects.create(format=fmt)
+
+    if upload.status == JournalUpload.DONE:
+        return JsonResponse(upload_json(upload))
+    try:
+        start = int(request.GET.get("start", 0))
+    except ValueError:
+        start = -1
+    if not 0 <= start <= upload.offset:
+        return JsonResponse(
+            {"error": "start must be between 0 and the offset %d."
+                      % upload.offset, **upload_json(upload)},
+            status=400)
+    if pk is not None and not _claim(upload):
+        return JsonResponse(
+            {"error": "The upload is being loaded by another request.",
+             **upload_json(upload)},
+            status=409)
+
+    upload = _load_upload(request, upload, start)
+    status = 200 if upload.status == JournalUpload.DONE else 422
+    return JsonResponse(upload_json(upload), status=status)
+
+
+##############
+# Background jobs (jobs.py), run by the run_jobs worker
+
+def job_json(job):
+    return {
+        "id": job.pk,
+        "kind": job.kind,
+        "params": job.params,
+        "status": job.status,
+        "attempts": job.attempts,
+        "progress": {"done": job.progress_done, "total": job.progress_total},
+        "message": job.message,
+        "result": job.result,
+        "created": job.created.isoformat(),
+        "started": job.started and job.started.isoformat(),
+        "finished": job.finished and job.finished.isoformat(),
+        "url": reverse("psqlj:api-job", args=[job.pk]),
+    }
+
+
+@csrf_exempt
+@require_POST
+def enqueue_job(request):
+    """POST {"kind": ..., "params": {...}}; answers 202 with the job."""
+    try:
+        data = json.loads(request.body or b"null")
+        kind, params = data["kind"], data.get("params") or {}
+        if not isinstance(params, dict):
+            raise ValueError("params must be an object")
+        job = jobs.enqueue(kind, params)
+    except (ValueError, TypeError, KeyError, jobs.JobError) as e:
+        return JsonResponse({"error": str(e)}, status=400)
+    return JsonResponse(job_json(job), status=202)
+
+
+def _get_job(pk):
+    try:
+        return Job.objects.get(pk=pk)
+    except Job.DoesNotExist:
+        raise Http404("No such job.")
+
+
+def job_status(request, pk):
+    return JsonResponse(job_json(_get_job(pk)))
+
+
+def job_file(request, pk):
+    """Download the file a finished job wrote."""
+    job = _get_job(pk)
+    name = (job.result or {}).get("file") if job.status == Job.DONE else None
+    if not name:
+        raise Http404("This job has no file.")
+    return FileResponse(open(jobs.job_path(name), "rb"), as_attachment=True,
+                        filename=name)
@@ -4,3 +4,8 @@ from django.apps import AppConfig
 class PsqlJournalConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'psql_journal'
+
+    def ready(self):
+        from . import balances, pagecache
+        balances.connect_signals()
+        pagecache.connect_signals()
@@ -0,0 +1,432 @@
+"""
+Archive of closed months in Parquet files.
+
+    archive_month(date(2021, 3, 1), remove=True)
+
+writes the live records of the month, with their transaction, to a new
+zstd-compressed Parquet file under PSQLJ_ARCHIVE_DIR:
+
+    year=2021/month=03/part-<id>.parquet
+
+one ArchiveFile row per file. Only months up to the latest period-close
+checkpoint (checkpoints.py) can be archived. With remove=True the
+records and transactions are then deleted from the live tables, in the
+same database transaction and under the exclusive checkpoint lock, so
+no write to the month is lost in between; a later back-dated write to
+the month stays live until the month is archived again. The idempotency
+keys of the removed transactions are kept in ArchivedKey, so a retried
+post of one of them is still a duplicate (bulkload.posted_keys()).
+
+Removing bypasses the balance signals on purpose: AccountBalance,
+AccountDayBalance and the checkpoints keep the archived amounts, so
+trial balance and period-close reports need nothing else. What reads the
+raw records merges the removed files (only those) with the live tables:
+
+  * read() is the scanner: it opens only the files of the months in
+    [start, end] and pushes the tdate and account filters down to the
+    Parquet row groups,
+  * ledger_rows() feeds export.ledger_rows() and reports.account_ledger(),
+  * day_totals() feeds balances.compute_day_balances() and
+    checkpoints.derive(), so rebuild and verify stay exact,
+  * balances() are account totals from the raw records of both.
+
+restore() puts removed records back. Needs the pyarrow package once
+anything is archived.
+"""
+import datetime
+import itertools
+import os
+import uuid
+from collections import defaultdict
+from pathlib import Path
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from . import checkpoints, pagecache
+from .models import (
+    Account,
+    ArchivedKey,
+    ArchiveFile,
+    BalanceCheckpoint,
+    Transaction,
+    TransactionRecord,
+)
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+DEFAULT_CHUNK_SIZE = 50000
+COMPRESSION = "zstd"
+
+COLUMNS = [
+    "transaction_id", "tdate", "desc", "idempotency_key", "record_num",
+    "account_id", "amount", "side",
+]
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The journal archive needs the 'pyarrow' package.")
+
+
+def schema():
+    _require_pyarrow()
+    return pa.schema([
+        ("transaction_id", pa.int64()),
+        ("tdate", pa.date32()),
+        ("desc", pa.string()),
+        ("idempotency_key", pa.string()),
+        ("record_num", pa.int16()),
+        ("account_id", pa.int32()),
+        ("amount", pa.int64()),
+        ("side", pa.string()),
+    ])
+
+
+def archive_dir():
+    return Path(getattr(settings, "PSQLJ_ARCHIVE_DIR", "archive"))
+
+
+def month_bounds(month):
+    """First and last day of the month of month."""
+    first = month.replace(day=1)
+    last = (first + datetime.timedelta(days=32)).replace(
+        day=1) - datetime.timedelta(days=1)
+    return first, last
+
+
+def closed_through():
+    """Last closed day, None if no period is closed."""
+    return BalanceCheckpoint.objects.order_by("-period_end").values_list(
+        "period_end", flat=True).first()
+
+
+def _unlink(paths):
+    for path in paths:
+        (archive_dir() / path).unlink(missing_ok=True)
+
+
+##############
+# Writing
+
+def _live_records(first, last):
+    return TransactionRecord.objects.filter(
+        transaction__tdate__gte=first, transaction__tdate__lte=last,
+    ).order_by(
+        "transaction__tdate", "transaction_id", "record_num",
+    ).values_list(
+        "transaction_id", "transaction__tdate", "transaction__desc",
+        "transaction__idempotency_key", "record_num", "account_id",
+        "amount", "side",
+    )
+
+
+def _write(path, rows, chunk_size):
+    """Write rows in row groups of chunk_size. Return (records, transactions)."""
+    records = transactions = 0
+    last_id = None
+    rows = rows.iterator(chunk_size=chunk_size)
+    fields = schema()
+    with pq.ParquetWriter(path, fields, compression=COMPRESSION) as writer:
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            if not chunk:
+                break
+            columns = list(zip(*chunk))
+            writer.write_batch(pa.record_batch(
+                [pa.array(c, type=f.type) for c, f in zip(columns, fields)],
+                schema=fields))
+            records += len(chunk)
+            for txn in columns[0]:
+                transactions += txn != last_id
+                last_id = txn
+    return records, transactions
+
+
+def _keep_keys(entry, first, last):
+    """Copy the idempotency keys of [first, last] to ArchivedKey."""
+    qn = connection.ops.quote_name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO %s (%s, %s, %s) SELECT %s, %s, %%s FROM %s "
+            "WHERE %s BETWEEN %%s AND %%s AND %s IS NOT NULL" % (
+                qn(ArchivedKey._meta.db_table), qn("key"),
+                qn("transaction_id"), qn("file_id"), qn("idempotency_key"),
+                qn("id"), qn(Transaction._meta.db_table), qn("tdate"),
+                qn("idempotency_key")),
+            [entry.pk, first, last])
+
+
+def _delete_live(first, last):
+    """Delete the records and transactions of [first, last]. Return records."""
+    qn = connection.ops.quote_name
+    rec = qn(TransactionRecord._meta.db_table)
+    txn = qn(Transaction._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "DELETE FROM %s WHERE transaction_id IN "
+            "(SELECT id FROM %s WHERE tdate BETWEEN %%s AND %%s)" % (rec, txn),
+            [first, last])
+        deleted = cursor.rowcount
+        cursor.execute("DELETE FROM %s WHERE tdate BETWEEN %%s AND %%s" % txn,
+                       [first, last])
+    return deleted
+
+
+def archive_month(month, remove=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Write the live records of the month of month to a new file and, with
+    remove, delete them from the live tables. Earlier files of the month
+    that were not removed are replaced. Return the ArchiveFile, or None
+    if the month has no live records. Raise ValueError if the month is
+    not closed.
+    """
+    _require_pyarrow()
+    first, last = month_bounds(month)
+    closed = closed_through()
+    if closed is None or last > closed:
+        raise ValueError("%s is not closed." % first.strftime("%Y-%m"))
+
+    entry = ArchiveFile(month=first, path="year=%04d/month=%02d/part-%s.parquet"
+                        % (first.year, first.month, uuid.uuid4().hex[:12]))
+    path = archive_dir() / entry.path
+    tmp = path.with_name(path.name + ".tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with transaction.atomic():
+            # writers take it shared: nothing is added to the month meanwhile
+            checkpoints.lock(shared=False)
+            replaced = ArchiveFile.objects.filter(month=first,
+                                                  removed__isnull=True)
+            old_paths = list(replaced.values_list("path", flat=True))
+            replaced.delete()
+            transaction.on_commit(lambda: _unlink(old_paths))
+
+            entry.records, entry.transactions = _write(
+                tmp, _live_records(first, last), chunk_size)
+            if not entry.records:
+                tmp.unlink()
+                return None
+            os.replace(tmp, path)
+            if remove:
+                entry.removed = timezone.now()
+            entry.save()
+            if remove:
+                _keep_keys(entry, first, last)
+                deleted = _delete_live(first, last)
+                if deleted != entry.records:
+                    raise RuntimeError(
+                        "Archived %d records of %s but deleted %d."
+                        % (entry.records, first.strftime("%Y-%m"), deleted))
+                pagecache.invalidate("journal")
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        path.unlink(missing_ok=True)
+        raise
+    return entry
+
+
+def restore(month, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Put the removed records of the month of month back into the live
+    tables, with their ids and keys, and delete the files (and so their
+    ArchivedKeys). Return the number of records. The balances never lost
+    them, so they are not touched.
+    """
+    first, _ = month_bounds(month)
+    files = ArchiveFile.objects.filter(month=first, removed__isnull=False)
+    paths = list(files.values_list("path", flat=True))
+    if not paths:
+        return 0
+    _require_pyarrow()
+    restored = 0
+    with transaction.atomic():
+        for path in paths:
+            rows = pq.read_table(archive_dir() / path).to_pylist()
+            txns = {}
+            for row in rows:
+                txns.setdefault(row["transaction_id"], Transaction(
+                    id=row["transaction_id"], tdate=row["tdate"],
+                    desc=row["desc"], idempotency_key=row["idempotency_key"]))
+            Transaction.objects.bulk_create(txns.values(),
+                                            batch_size=chunk_size)
+            TransactionRecord.objects.bulk_create([
+                TransactionRecord(
+                    transaction_id=row["transaction_id"],
+                    record_num=row["record_num"],
+                    account_id=row["account_id"],
+                    amount=row["amount"], side=row["side"])
+                for row in rows
+            ], batch_size=chunk_size)
+            restored += len(rows)
+        files.delete()
+        pagecache.invalidate("journal")
+        transaction.on_commit(lambda: _unlink(paths))
+    return restored
+
+
+##############
+# Reading
+
+def removed_files(start=None, end=None):
+    """ArchiveFiles of removed records for the months touching [start, end]."""
+    qs = ArchiveFile.objects.filter(removed__isnull=False)
+    if start:
+        qs = qs.filter(month__gte=start.replace(day=1))
+    if end:
+        qs = qs.filter(month__lte=end)
+    return qs.order_by("month", "id")
+
+
+def has_removed(start=None, end=None):
+    return removed_files(start, end).exists()
+
+
+def _filter(start, end, account, account_id=None):
+    expr = ds.scalar(True)
+    if start:
+        expr &= ds.field("tdate") >= pa.scalar(start, pa.date32())
+    if end:
+        expr &= ds.field("tdate") <= pa.scalar(end, pa.date32())
+    if account:
+        ids = list(Account.objects.filter(code=account).values_list(
+            "id", flat=True))
+        expr &= ds.field("account_id").isin(pa.array(ids, pa.int32()))
+    if account_id is not None:
+        expr &= ds.field("account_id") == pa.scalar(account_id, pa.int32())
+    return expr
+
+
+def read(start=None, end=None, account=None, columns=None, files=None,
+         account_id=None):
+    """
+    pyarrow Table of the removed records with tdate in [start, end], of
+    the account code account (or the account id account_id) if given.
+    """
+    _require_pyarrow()
+    if files is None:
+        files = removed_files(start, end)
+    paths = [str(archive_dir() / f.path) for f in files]
+    if not paths:
+        return schema().empty_table().select(columns or COLUMNS)
+    return ds.dataset(paths, schema=schema(), format="parquet").to_table(
+        columns=columns, filter=_filter(start, end, account, account_id))
+
+
+def _with_codes(table):
+    """Add the current account code of account_id as "account"."""
+    ids = pc.unique(table.column("account_id"))
+    codes = dict(Account.objects.filter(
+        id__in=ids.to_pylist()).values_list("id", "code"))
+    return table.append_column("account", pc.take(
+        pa.array([codes.get(pk) for pk in ids.to_pylist()], pa.string()),
+        pc.index_in(table.column("account_id"), value_set=ids)))
+
+
+LEDGER_COLUMNS = ["transaction_id", "tdate", "desc", "record_num",
+                  "account", "side", "amount"]
+
+
+def _rows(table, order):
+    table = table.sort_by([(c, "ascending") for c in order])
+    return zip(*(table.column(c).to_pylist() for c in LEDGER_COLUMNS))
+
+
+def ledger_rows(start=None, end=None, account=None, by_account=False):
+    """
+    Yield the removed records as export.LEDGER_HEADER tuples, ordered by
+    tdate, transaction and record_num. One month is in memory at a time.
+
+    by_account orders by account code first, by code point (see
+    export.py); then the records of one account in one month are in
+    memory at a time, read with the account pushed down to the files.
+    """
+    files = list(removed_files(start, end))
+    if not files:
+        return
+    order = ["tdate", "transaction_id", "record_num"]
+    if not by_account:
+        for _, group in itertools.groupby(files, key=lambda f: f.month):
+            yield from _rows(_with_codes(read(start, end, account,
+                                              files=list(group))), order)
+        return
+
+    # {account id: its files}, from the account_id column only
+    accounts = defaultdict(list)
+    for f in files:
+        ids = read(start, end, account, columns=["account_id"],
+                   files=[f]).column("account_id").unique()
+        for pk in ids.to_pylist():
+            accounts[pk].append(f)
+    codes = dict(Account.objects.filter(id__in=accounts).values_list(
+        "id", "code"))
+    for pk in sorted(accounts, key=lambda pk: (codes.get(pk) or "", pk)):
+        for _, group in itertools.groupby(accounts[pk],
+                                          key=lambda f: f.month):
+            table = read(start, end, files=list(group), account_id=pk)
+            table = table.append_column("account", pa.array(
+                [codes.get(pk)] * len(table), pa.string()))
+            yield from _rows(table, order)
+
+
+def _side_totals(table, keys):
+    """{keys values: [debit, credit]} of table."""
+    grouped = table.group_by(keys + ["side"]).aggregate([("amount", "sum")])
+    totals = defaultdict(lambda: [0, 0])
+    columns = [grouped.column(k).to_pylist()
+               for k in keys + ["side", "amount_sum"]]
+    for *key, side, amount in zip(*columns):
+        key = key[0] if len(key) == 1 else tuple(key)
+        totals[key][0 if side == TransactionRecord.DEBIT else 1] += amount
+    return totals
+
+
+def day_totals(end=None):
+    """{(account id, tdate): [debit, credit]} of the removed records."""
+    if not has_removed(None, end):
+        return {}
+    return _side_totals(
+        read(end=end, columns=["account_id", "tdate", "amount", "side"]),
+        ["account_id", "tdate"])
+
+
+def balances(start=None, end=None, account=None):
+    """
+    {"account", "debit", "credit", "balance"} per account from the raw
+    records, removed and live, with tdate in [start, end], ordered by
+    account code.
+    """
+    totals = defaultdict(lambda: [0, 0])
+    if has_removed(start, end):
+        totals.update(_side_totals(
+            read(start, end, account,
+                 columns=["account_id", "amount", "side"]),
+            ["account_id"]))
+    qs = TransactionRecord.objects.all()
+    if start:
+        qs = qs.filter(transaction__tdate__gte=start)
+    if end:
+        qs = qs.filter(transaction__tdate__lte=end)
+    if account:
+        qs = qs.filter(account__code=account)
+    debit = Q(side=TransactionRecord.DEBIT)
+    for row in qs.values("account_id").annotate(
+            debit=Sum("amount", filter=debit, default=0),
+            credit=Sum("amount", filter=~debit, default=0)).order_by():
+        totals[row["account_id"]][0] += row["debit"]
+        totals[row["account_id"]][1] += row["credit"]
+    codes = dict(Account.objects.filter(id__in=totals).values_list(
+        "id", "code"))
+    return sorted((
+        {"account": codes[pk], "debit": d, "credit": c, "balance": d - c}
+        for pk, (d, c) in totals.items()
+    ), key=lambda row: row["account"])
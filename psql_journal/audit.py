@@ -0,0 +1,53 @@
+"""
+Double-entry checks of the journal.
+
+On PostgreSQL, migration 0011 installs a deferred constraint trigger
+(lzy_balance_check_def in asite/sa_tablemodule.py). The trigger checks
+every transaction whose records were written, once, when the database
+transaction commits. A write path that leaves a transaction unbalanced
+fails at COMMIT with IntegrityError, including raw SQL and
+QuerySet.update(), which the Python checks (bulkload.check_balanced)
+never see.
+
+unbalanced() audits the whole journal in one aggregate query. It is the
+only check on other backends.
+"""
+from django.db import connection
+from django.db.models import F, Q, Sum
+
+from .models import TransactionRecord
+
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def trigger_installed():
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_trigger "
+            "WHERE tgname = 'lzy_balance_verify')")
+        return cursor.fetchone()[0]
+
+
+def unbalanced(start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield {"transaction", "debit", "credit"} of every transaction whose
+    debits and credits differ, ordered by id, optionally only those with
+    tdate in [start, end].
+    """
+    qs = TransactionRecord.objects.all()
+    if start:
+        qs = qs.filter(transaction__tdate__gte=start)
+    if end:
+        qs = qs.filter(transaction__tdate__lte=end)
+    qs = qs.values("transaction_id").annotate(
+        debit=Sum("amount", filter=Q(side=TransactionRecord.DEBIT),
+                  default=0),
+        credit=Sum("amount", filter=Q(side=TransactionRecord.CREDIT),
+                   default=0),
+    ).exclude(debit=F("credit")).order_by("transaction_id")
+    for row in qs.iterator(chunk_size=chunk_size):
+        row["transaction"] = row.pop("transaction_id")
+        yield row
@@ -0,0 +1,312 @@
+"""
+Incremental maintenance of AccountBalance and AccountDayBalance.
+
+Every write path applies debit/credit deltas in the same database
+transaction as the journal rows it touches (deltas dated inside a closed
+period also go to its checkpoint, see checkpoints.py):
+
+  * bulk paths (bulkload, bulk_create) call post_records() directly,
+  * single-row ORM save()/delete() of Transaction and TransactionRecord
+    go through the signal handlers connected in PsqlJournalConfig.ready(),
+  * code that writes a whole transaction at once can wrap it in
+    suspended() and apply one combined delta itself.
+
+QuerySet.update() and raw SQL bypass both; run the rebuild_balances
+command afterwards.
+"""
+import datetime
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from . import archive, checkpoints, pagecache
+from .models import (
+    AccountBalance,
+    AccountDayBalance,
+    BalanceCheckpoint,
+    CheckpointBalance,
+    Transaction,
+    TransactionRecord,
+)
+
+
+def record_deltas(rows, sign=1):
+    """
+    Sum rows of (account id, tdate, amount, side) into
+    {(account id, tdate): [debit, credit]}.
+    """
+    deltas = defaultdict(lambda: [0, 0])
+    for account, tdate, amount, side in rows:
+        col = 0 if side == TransactionRecord.DEBIT else 1
+        deltas[(account, tdate)][col] += sign * amount
+    return deltas
+
+
+def merge_deltas(deltas, other):
+    """Add other into deltas, return deltas."""
+    for key, (debit, credit) in other.items():
+        deltas[key][0] += debit
+        deltas[key][1] += credit
+    return deltas
+
+
+def _upsert(table, key_columns, values):
+    if not values:
+        return
+    qn = connection.ops.quote_name
+    columns = list(key_columns) + ["debit", "credit"]
+    sql = (
+        "INSERT INTO {t} ({cols}) VALUES ({params}) "
+        "ON CONFLICT ({keys}) DO UPDATE SET "
+        "{debit} = {t}.{debit} + EXCLUDED.{debit}, "
+        "{credit} = {t}.{credit} + EXCLUDED.{credit}"
+    ).format(
+        t=qn(table),
+        cols=", ".join(qn(c) for c in columns),
+        params=", ".join(["%s"] * len(columns)),
+        keys=", ".join(qn(c) for c in key_columns),
+        debit=qn("debit"),
+        credit=qn("credit"),
+    )
+    with connection.cursor() as cursor:
+        cursor.executemany(sql, values)
+
+
+def apply_deltas(deltas):
+    """Add deltas from record_deltas() to the summaries and checkpoints."""
+    totals = defaultdict(lambda: [0, 0])
+    day_values = []
+    for (account, tdate), (debit, credit) in deltas.items():
+        if debit == 0 and credit == 0:
+            continue
+        day_values.append((account, tdate, debit, credit))
+        totals[account][0] += debit
+        totals[account][1] += credit
+    acc_values = [
+        (account, debit, credit)
+        for account, (debit, credit) in totals.items()
+        if debit != 0 or credit != 0
+    ]
+    with transaction.atomic():
+        _upsert(AccountBalance._meta.db_table, ["account_id"], acc_values)
+        _upsert(AccountDayBalance._meta.db_table, ["account_id", "tdate"],
+                day_values)
+        if day_values:
+            _apply_checkpoint_deltas(day_values)
+
+
+def _apply_checkpoint_deltas(day_values):
+    """Add back-dated deltas to every checkpoint at or after their tdate."""
+    checkpoints.lock()
+    day_values = [
+        (account, tdate if isinstance(tdate, datetime.date)
+         else datetime.date.fromisoformat(str(tdate)), debit, credit)
+        for account, tdate, debit, credit in day_values
+    ]
+    first = min(tdate for _, tdate, _, _ in day_values)
+    ends = list(BalanceCheckpoint.objects.filter(
+        period_end__gte=first).values_list("id", "period_end"))
+    if not ends:
+        return
+    totals = defaultdict(lambda: [0, 0])
+    for account, tdate, debit, credit in day_values:
+        for checkpoint, period_end in ends:
+            if tdate <= period_end:
+                totals[(checkpoint, account)][0] += debit
+                totals[(checkpoint, account)][1] += credit
+    _upsert(CheckpointBalance._meta.db_table, ["checkpoint_id", "account_id"],
+            [(cp, acc, d, c) for (cp, acc), (d, c) in totals.items()])
+
+
+def post_records(rows):
+    """Add rows of (account id, tdate, amount, side) to the balances."""
+    apply_deltas(record_deltas(rows))
+
+
+def unpost_records(rows):
+    """Remove rows of (account id, tdate, amount, side) from the balances."""
+    apply_deltas(record_deltas(rows, sign=-1))
+
+
+def replace_records(old_rows, new_rows):
+    """Apply -old_rows +new_rows as one delta."""
+    apply_deltas(merge_deltas(record_deltas(old_rows, sign=-1),
+                              record_deltas(new_rows)))
+
+
+def rows_of_transactions(transaction_ids):
+    """(account id, tdate, amount, side) of all records of the transactions."""
+    return TransactionRecord.objects.filter(
+        transaction_id__in=transaction_ids,
+    ).values_list("account_id", "transaction__tdate", "amount", "side")
+
+
+##############
+# Signal handlers for single-row ORM writes.
+
+_state = threading.local()
+
+
+@contextmanager
+def suspended():
+    """
+    Turn the signal handlers off in this thread. The caller is then
+    responsible for applying the deltas of what it wrote.
+    """
+    previous = getattr(_state, "suspended", False)
+    _state.suspended = True
+    try:
+        yield
+    finally:
+        _state.suspended = previous
+
+
+def _active(raw=False):
+    return not raw and not getattr(_state, "suspended", False)
+
+
+def _record_pre_save(sender, instance, raw=False, **kwargs):
+    instance._balance_old = None
+    if not _active(raw) or instance.pk is None:
+        return
+    instance._balance_old = list(
+        TransactionRecord.objects.filter(pk=instance.pk).values_list(
+            "account_id", "transaction__tdate", "amount", "side")
+    )
+
+
+def _record_post_save(sender, instance, raw=False, **kwargs):
+    if not _active(raw):
+        return
+    old = getattr(instance, "_balance_old", None) or []
+    new = [(instance.account_id, instance.transaction.tdate,
+            instance.amount, instance.side)]
+    replace_records(old, new)
+
+
+def _record_post_delete(sender, instance, **kwargs):
+    if not _active():
+        return
+    tdate = Transaction.objects.filter(
+        pk=instance.transaction_id).values_list("tdate", flat=True).first()
+    if tdate is None:
+        return
+    unpost_records([(instance.account_id, tdate, instance.amount,
+                     instance.side)])
+
+
+def _transaction_pre_save(sender, instance, raw=False, **kwargs):
+    instance._balance_old_tdate = None
+    if not _active(raw) or instance.pk is None:
+        return
+    instance._balance_old_tdate = Transaction.objects.filter(
+        pk=instance.pk).values_list("tdate", flat=True).first()
+
+
+def _transaction_post_save(sender, instance, raw=False, **kwargs):
+    old_tdate = getattr(instance, "_balance_old_tdate", None)
+    if not _active(raw) or old_tdate is None or old_tdate == instance.tdate:
+        return
+    # Moving a transaction to another day only changes the day table,
+    # the account totals cancel out.
+    records = list(instance.transactionrecord_set.values_list(
+        "account_id", "amount", "side"))
+    old = [(acc, old_tdate, amt, side) for acc, amt, side in records]
+    new = [(acc, instance.tdate, amt, side) for acc, amt, side in records]
+    replace_records(old, new)
+
+
+def connect_signals():
+    uid = "psqlj_balances"
+    pre_save.connect(_record_pre_save, sender=TransactionRecord,
+                     dispatch_uid=uid)
+    post_save.connect(_record_post_save, sender=TransactionRecord,
+                      dispatch_uid=uid)
+    post_delete.connect(_record_post_delete, sender=TransactionRecord,
+                        dispatch_uid=uid)
+    pre_save.connect(_transaction_pre_save, sender=Transaction,
+                     dispatch_uid=uid)
+    post_save.connect(_transaction_post_save, sender=Transaction,
+                      dispatch_uid=uid)
+
+
+##############
+# Rebuild and verify
+
+def compute_day_balances():
+    """
+    Recompute {(account id, tdate): (debit, credit)} from the raw journal
+    with one GROUP BY query, plus the records removed to the archive.
+    """
+    qs = TransactionRecord.objects.values(
+        "account_id", "transaction__tdate",
+    ).annotate(
+        debit=Sum("amount", filter=Q(side=TransactionRecord.DEBIT),
+                  default=0),
+        credit=Sum("amount", filter=Q(side=TransactionRecord.CREDIT),
+                   default=0),
+    ).order_by()
+    days = {
+        (row["account_id"], row["transaction__tdate"]):
+            (row["debit"], row["credit"])
+        for row in qs
+    }
+    for key, (debit, credit) in archive.day_totals().items():
+        d, c = days.get(key, (0, 0))
+        days[key] = (d + debit, c + credit)
+    return days
+
+
+def find_drift():
+    """
+    Compare stored balances with the raw journal.
+    Return a list of (kind, key, stored, expected) tuples.
+    """
+    expected_days = compute_day_balances()
+    expected_accounts = defaultdict(lambda: (0, 0))
+    for (account, _), (debit, credit) in expected_days.items():
+        d, c = expected_accounts[account]
+        expected_accounts[account] = (d + debit, c + credit)
+
+    drift = []
+    stored = {
+        row[0]: (row[1], row[2])
+        for row in AccountBalance.objects.values_list(
+            "account_id", "debit", "credit")
+    }
+    for key in set(stored) | set(expected_accounts):
+        s = stored.get(key, (0, 0))
+        e = expected_accounts.get(key, (0, 0))
+        if s != e:
+            drift.append(("account", key, s, e))
+
+    stored = {
+        (row[0], row[1]): (row[2], row[3])
+        for row in AccountDayBalance.objects.values_list(
+            "account_id", "tdate", "debit", "credit")
+    }
+    for key in set(stored) | set(expected_days):
+        s = stored.get(key, (0, 0))
+        e = expected_days.get(key, (0, 0))
+        if s != e:
+            drift.append(("day", key, s, e))
+    return drift
+
+
+def rebuild():
+    """
+    Replace both summary tables and the checkpoint rows with totals from
+    the raw journal.
+    """
+    days = compute_day_balances()
+    with transaction.atomic():
+        AccountDayBalance.objects.all().delete()
+        AccountBalance.objects.all().delete()
+        CheckpointBalance.objects.all().delete()
+        apply_deltas({k: list(v) for k, v in days.items()})
+        # reports read these tables, drop their cached fragments
+        pagecache.invalidate("journal")
@@ -0,0 +1,95 @@
+"""
+Helpers shared by the bench_* management commands.
+
+Benchmarks seed synthetic data through the normal write paths, so they
+run on SQLite as well as on a local PostgreSQL.
+"""
+import datetime
+import random
+import statistics
+import time
+
+from django.db import connection
+
+
+class Rollback(Exception):
+    """Raise inside transaction.atomic() to throw the seeded data away."""
+
+
+def synthetic_entries(n_transactions, n_records=2, n_accounts=200,
+                      start=datetime.date(2020, 1, 1), days=1460, seed=0):
+    """
+    Yield balanced raw entries for bulkload: n_records - 1 debit lines
+    and one credit line closing the transaction.
+    """
+    rnd = random.Random(seed)
+    accounts = ["%04d" % (1000 + i) for i in range(n_accounts)]
+    for i in range(n_transactions):
+        records = []
+        total = 0
+        for _ in range(max(n_records - 1, 1)):
+            amount = rnd.randint(1, 1000000)
+            total += amount
+            records.append({"account": rnd.choice(accounts),
+                            "amount": amount, "side": "D"})
+        records.append({"account": rnd.choice(accounts),
+                        "amount": total, "side": "C"})
+        yield {
+            "tdate": start + datetime.timedelta(days=rnd.randrange(days)),
+            "desc": "bench %d" % i,
+            "records": records,
+        }
+
+
+def timed(func, repeat=5):
+    """Run func repeat times, return a dict of timings in milliseconds."""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return {
+        "min_ms": round(min(samples), 3),
+        "median_ms": round(statistics.median(samples), 3),
+        "max_ms": round(max(samples), 3),
+    }
+
+
+def explain(sql, params=()):
+    """Return the query plan of sql as text, for the current backend."""
+    if connection.vendor == "postgresql":
+        prefix = "EXPLAIN (ANALYZE, BUFFERS) "
+    elif connection.vendor == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+    with connection.cursor() as cursor:
+        cursor.execute(prefix + sql, params)
+        return "\n".join(" ".join(str(c) for c in row)
+                         for row in cursor.fetchall())
+
+
+def analyze():
+    """Refresh planner statistics after seeding."""
+    with connection.cursor() as cursor:
+        cursor.execute("ANALYZE")
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    Compare two bench_suite result dicts. Return a list of
+    (size, case, baseline median, median, ratio, regressed) for the
+    cases present in both; regressed when ratio > 1 + threshold.
+    """
+    rows = []
+    for size, cases in results["results"].items():
+        base_cases = baseline.get("results", {}).get(size, {})
+        for case, timing in cases.items():
+            base = base_cases.get(case)
+            if not base or "median_ms" not in timing or "median_ms" not in base:
+                continue
+            ratio = (timing["median_ms"] / base["median_ms"]
+                     if base["median_ms"] else float("inf"))
+            rows.append((size, case, base["median_ms"], timing["median_ms"],
+                         ratio, ratio > 1 + threshold))
+    return rows
@@ -0,0 +1,394 @@
+"""
+Bulk loading of journal entries into Transaction and TransactionRecord.
+
+An entry is a plain dict:
+
+    {
+        "tdate": "2024-02-22",
+        "desc": "Office supplies",
+        "records": [
+            {"account": "6100", "amount": 150000, "side": "D"},
+            {"account": "1000", "amount": 150000, "side": "C"},
+        ],
+    }
+
+An optional "key" is stored as Transaction.idempotency_key.
+
+"account" is an Account.code; unknown codes are added to the chart of
+accounts. Entries are cleaned and balance-checked in Python, then written chunk by
+chunk. On PostgreSQL both tables are filled with COPY ... FROM STDIN,
+other backends fall back to bulk_create().
+"""
+import csv
+import datetime
+import itertools
+import json
+import re
+import time
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+
+from asite.sa_tablemodule import lzy_copy_from, lzy_reserve_ids
+from . import balances, pagecache, replicas
+from .accounts import resolve_codes
+from .models import Account, ArchivedKey, Transaction, TransactionRecord
+
+
+DEFAULT_CHUNK_SIZE = 1000
+
+SIDES = {TransactionRecord.DEBIT, TransactionRecord.CREDIT}
+
+DESC_MAX_LENGTH = Transaction._meta.get_field("desc").max_length
+KEY_MAX_LENGTH = Transaction._meta.get_field("idempotency_key").max_length
+ACCOUNT_MAX_LENGTH = Account._meta.get_field("code").max_length
+# column ranges of TransactionRecord.amount and record_num
+AMOUNT_MAX = 2 ** 63 - 1
+RECORD_NUM_MAX = 2 ** 15 - 1
+
+_DIGITS = re.compile(r"[0-9]+")
+
+
+def check_balanced(records):
+    """Raise ValidationError unless debits equal credits."""
+    total = 0
+    for rec in records:
+        if rec["side"] == TransactionRecord.DEBIT:
+            total += rec["amount"]
+        else:
+            total -= rec["amount"]
+    if total != 0:
+        raise ValidationError(
+            "Transaction does not balance (debit - credit = %(total)s).",
+            code="unbalanced",
+            params={"total": total},
+        )
+
+
+def _integer(value, low, high):
+    """
+    value as an int in [low, high] if it is an int or a string of
+    digits, else None. Floats (1.9 would pass int() as 1) and bools are
+    refused.
+    """
+    if isinstance(value, str) and _DIGITS.fullmatch(value.strip()):
+        value = int(value)
+    if type(value) is not int or not low <= value <= high:
+        return None
+    return value
+
+
+def clean_entry(data):
+    """
+    Normalize one raw entry (from JSON, CSV or a form) and check
+    that it balances. Raise ValidationError on bad input.
+    """
+    if not isinstance(data, dict):
+        raise ValidationError("Entry must be an object.", code="invalid")
+
+    try:
+        tdate = data["tdate"]
+        if not isinstance(tdate, datetime.date):
+            tdate = datetime.date.fromisoformat(str(tdate))
+    except KeyError:
+        raise ValidationError("Missing 'tdate'.", code="required")
+    except ValueError:
+        raise ValidationError("Invalid 'tdate': %(v)r.", code="invalid",
+                              params={"v": data["tdate"]})
+
+    desc = str(data.get("desc", ""))
+    if len(desc) > DESC_MAX_LENGTH:
+        raise ValidationError("'desc' is longer than %(n)s characters.",
+                              code="max_length", params={"n": DESC_MAX_LENGTH})
+
+    key = data.get("key")
+    if key is not None:
+        if not isinstance(key, str) or not key or len(key) > KEY_MAX_LENGTH:
+            raise ValidationError("'key' must be a string of 1 to %(n)s "
+                                  "characters.", code="invalid",
+                                  params={"n": KEY_MAX_LENGTH})
+
+    raw_records = data.get("records")
+    if not isinstance(raw_records, list) or len(raw_records) < 2:
+        raise ValidationError("An entry needs at least 2 records.",
+                              code="invalid")
+
+    records = []
+    for num, rec in enumerate(raw_records, start=1):
+        if not isinstance(rec, dict):
+            raise ValidationError("Record %(n)s must be an object.",
+                                  code="invalid", params={"n": num})
+        account = str(rec.get("account", "")).strip()
+        if not account or len(account) > ACCOUNT_MAX_LENGTH:
+            raise ValidationError("Record %(n)s: invalid 'account'.",
+                                  code="invalid", params={"n": num})
+        amount = _integer(rec.get("amount"), 0, AMOUNT_MAX)
+        if amount is None:
+            raise ValidationError("Record %(n)s: 'amount' must be a whole "
+                                  "number from 0 to %(max)s, use 'side' for "
+                                  "credits.", code="invalid",
+                                  params={"n": num, "max": AMOUNT_MAX})
+        record_num = rec.get("record_num")
+        if record_num in (None, ""):
+            record_num = num
+        record_num = _integer(record_num, 1, RECORD_NUM_MAX)
+        if record_num is None:
+            raise ValidationError("Record %(n)s: 'record_num' must be a "
+                                  "whole number from 1 to %(max)s.",
+                                  code="invalid",
+                                  params={"n": num, "max": RECORD_NUM_MAX})
+        side = str(rec.get("side", TransactionRecord.DEBIT)).upper()
+        if side not in SIDES:
+            raise ValidationError("Record %(n)s: 'side' must be D or C.",
+                                  code="invalid", params={"n": num})
+        records.append({
+            "record_num": record_num,
+            "account": account,
+            "amount": amount,
+            "side": side,
+        })
+
+    check_balanced(records)
+    return {"tdate": tdate, "desc": desc, "key": key, "records": records}
+
+
+##############
+# Readers: turn a text stream into raw entries, one at a time.
+
+def iter_jsonl(lines):
+    """One JSON entry per line. Blank lines are skipped."""
+    for lineno, line in enumerate(lines, start=1):
+        if isinstance(line, bytes):
+            line = line.decode("utf-8")
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as e:
+            raise ValidationError("Line %(n)s: %(e)s", code="invalid",
+                                  params={"n": lineno, "e": e})
+
+
+def iter_csv(lines):
+    """
+    One record per row with a header:
+        ref,tdate,desc,account,amount,side
+    Consecutive rows with the same ref form one entry. tdate and desc
+    are taken from the first row of the entry.
+    """
+    reader = csv.DictReader(lines)
+    for ref, rows in itertools.groupby(reader, key=lambda r: r.get("ref")):
+        rows = list(rows)
+        first = rows[0]
+        yield {
+            "tdate": first.get("tdate"),
+            "desc": first.get("desc", ""),
+            "records": [
+                {
+                    "record_num": row.get("record_num"),
+                    "account": row.get("account"),
+                    "amount": row.get("amount"),
+                    "side": row.get("side") or TransactionRecord.DEBIT,
+                }
+                for row in rows
+            ],
+        }
+
+
+READERS = {
+    "csv": iter_csv,
+    "jsonl": iter_jsonl,
+}
+
+
+##############
+# Writers
+
+def _write_copy(entries, account_ids):
+    """COPY a list of clean entries, return the new Transaction ids."""
+    ids = lzy_reserve_ids(Transaction._meta.db_table, len(entries))
+    lzy_copy_from(
+        Transaction._meta.db_table,
+        ["id", "tdate", "desc", "idempotency_key"],
+        ((tid, e["tdate"], e["desc"], e.get("key"))
+         for tid, e in zip(ids, entries)),
+    )
+    lzy_copy_from(
+        TransactionRecord._meta.db_table,
+        ["transaction_id", "record_num", "account_id", "amount", "side"],
+        (
+            (tid, r["record_num"], account_ids[r["account"]], r["amount"],
+             r["side"])
+            for tid, e in zip(ids, entries)
+            for r in e["records"]
+        ),
+    )
+    return ids
+
+
+def _write_orm(entries, account_ids):
+    """bulk_create() fallback for backends without COPY."""
+    txns = [Transaction(tdate=e["tdate"], desc=e["desc"],
+                        idempotency_key=e.get("key"))
+            for e in entries]
+    if connection.features.can_return_rows_from_bulk_insert:
+        Transaction.objects.bulk_create(txns)
+    else:
+        for t in txns:
+            t.save()
+    TransactionRecord.objects.bulk_create(
+        [
+            TransactionRecord(
+                transaction=t,
+                record_num=r["record_num"],
+                account_id=account_ids[r["account"]],
+                amount=r["amount"],
+                side=r["side"],
+            )
+            for t, e in zip(txns, entries)
+            for r in e["records"]
+        ],
+        batch_size=DEFAULT_CHUNK_SIZE,
+    )
+    return [t.pk for t in txns]
+
+
+def write_entries(entries, create_accounts=True):
+    """
+    Write clean entries and their account balances in one database
+    transaction. Return the list of new Transaction ids, in input order.
+
+    Account codes are looked up once per call; unknown codes become new
+    root accounts unless create_accounts is False.
+    """
+    if not entries:
+        return []
+    with transaction.atomic():
+        account_ids = resolve_codes(
+            {r["account"] for e in entries for r in e["records"]},
+            create=create_accounts,
+        )
+        if connection.vendor == "postgresql":
+            ids = _write_copy(entries, account_ids)
+        else:
+            ids = _write_orm(entries, account_ids)
+        balances.post_records(
+            (account_ids[r["account"]], e["tdate"], r["amount"], r["side"])
+            for e in entries
+            for r in e["records"]
+        )
+        # bulk inserts send no signals
+        pagecache.invalidate("journal")
+        # and COPY does not go through the router
+        replicas.pin()
+    return ids
+
+
+def posted_keys(keys):
+    """{idempotency key: Transaction id} of the keys already posted, live
+    or archived (see archive.py)."""
+    keys = [k for k in keys if k]
+    if not keys:
+        return {}
+    posted = dict(
+        Transaction.objects.filter(idempotency_key__in=keys)
+        .values_list("idempotency_key", "id")
+    )
+    archived = [k for k in keys if k not in posted]
+    if archived:
+        posted.update(
+            ArchivedKey.objects.filter(key__in=archived)
+            .values_list("key", "transaction_id")
+        )
+    return posted
+
+
+class ImportResult:
+    """Counters of a bulk load."""
+
+    def __init__(self, skipped=0):
+        self.skipped = skipped
+        self.duplicates = 0
+        self.transactions = 0
+        self.records = 0
+        self.chunks = 0
+        self.started = time.perf_counter()
+        self.elapsed = 0.0
+
+    def add_chunk(self, entries, duplicates=0):
+        self.chunks += 1
+        self.duplicates += duplicates
+        self.transactions += len(entries)
+        self.records += sum(len(e["records"]) for e in entries)
+        self.elapsed = time.perf_counter() - self.started
+
+    @property
+    def offset(self):
+        """Entries of the input that are loaded, counting skipped ones."""
+        return self.skipped + self.duplicates + self.transactions
+
+    @property
+    def rows_per_sec(self):
+        if not self.elapsed:
+            return 0.0
+        return (self.transactions + self.records) / self.elapsed
+
+    def __str__(self):
+        text = "%d transactions, %d records in %.2fs (%.0f rows/s)" % (
+            self.transactions, self.records, self.elapsed, self.rows_per_sec)
+        if self.duplicates:
+            text += ", %d already posted" % self.duplicates
+        return text
+
+
+def load_journal(raw_entries, chunk_size=DEFAULT_CHUNK_SIZE, progress=None,
+                 skip=0, on_chunk=None):
+    """
+    Clean and write an iterable of raw entries in chunks.
+
+    Every chunk is checked in full before it is written and is committed
+    on its own, so a bad entry stops the load after the last good chunk;
+    result.offset is then where to resume.
+    skip leading entries are read but not written (loaded by an earlier
+    run). Entries whose key was posted before, or earlier in the input,
+    are not written either and count as result.duplicates.
+    on_chunk(result) runs inside each chunk's transaction, so what it
+    records commits together with the chunk. progress(result) is called
+    after each committed chunk.
+    """
+    result = ImportResult(skipped=skip)
+    raw_entries = iter(raw_entries)
+    for _ in itertools.islice(raw_entries, skip):
+        pass
+    offset = skip
+    while True:
+        chunk = []
+        for n, data in enumerate(itertools.islice(raw_entries, chunk_size)):
+            try:
+                chunk.append(clean_entry(data))
+            except ValidationError as e:
+                raise ValidationError(
+                    "Entry %(n)s: %(e)s", code="invalid",
+                    params={"n": offset + n + 1, "e": "; ".join(e.messages)},
+                )
+        if not chunk:
+            break
+        size = len(chunk)
+        with transaction.atomic():
+            posted = posted_keys(e["key"] for e in chunk)
+            new = []
+            for entry in chunk:
+                if entry["key"] in posted:
+                    continue
+                if entry["key"]:
+                    posted[entry["key"]] = None
+                new.append(entry)
+            write_entries(new)
+            offset += size
+            result.add_chunk(new, duplicates=size - len(new))
+            if on_chunk is not None:
+                on_chunk(result)
+        if progress is not None:
+            progress(result)
+    return result
@@ -0,0 +1,193 @@
+"""
+Period-close checkpoints of the account balances.
+
+close(period_end) writes, in bulk, the debit/credit totals of every
+account over all records with tdate <= period_end. Balance queries then
+start from the nearest checkpoint and only sum the AccountDayBalance
+rows after it (see account_totals() and reports.py), so their cost
+depends on the distance to the last close, not on the age of the ledger.
+
+A write dated on or before a closed period_end is added to the
+checkpoints by balances.apply_deltas(), in the same database
+transaction. On PostgreSQL an advisory lock (shared by writers,
+exclusive while closing) keeps a close from missing a write that has
+not committed yet.
+
+verify() re-derives a checkpoint from the raw TransactionRecord rows.
+"""
+import datetime
+
+from django.db import connection, transaction
+from django.db.models import F, FilteredRelation, Max, Q, Sum
+from django.db.models.functions import Coalesce
+
+from . import archive
+from .models import (
+    Account,
+    AccountDayBalance,
+    BalanceCheckpoint,
+    CheckpointBalance,
+    TransactionRecord,
+)
+
+
+# pg_advisory_xact_lock key, see lock()
+CHECKPOINT_LOCK_ID = 0x70736a63
+
+
+def lock(shared=True):
+    """Take the checkpoint lock until the end of the transaction."""
+    if connection.vendor == "postgresql":
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock%s(%%s)"
+                % ("_shared" if shared else ""),
+                [CHECKPOINT_LOCK_ID])
+
+
+def nearest(day):
+    """The latest checkpoint with period_end <= day, or None."""
+    if day is None:
+        return BalanceCheckpoint.objects.order_by("-period_end").first()
+    return BalanceCheckpoint.objects.filter(
+        period_end__lte=day).order_by("-period_end").first()
+
+
+def account_totals(checkpoint, end=None, account=None):
+    """
+    Account queryset joined to its checkpoint row (cp__) and to its
+    AccountDayBalance rows in (checkpoint.period_end, end] (days__),
+    restricted to accounts that have either. Aggregate over those two.
+    """
+    days = Q(accountdaybalance__tdate__gt=checkpoint.period_end)
+    if end:
+        days &= Q(accountdaybalance__tdate__lte=end)
+    qs = Account.objects.annotate(
+        cp=FilteredRelation(
+            "checkpoint_balances",
+            condition=Q(checkpoint_balances__checkpoint=checkpoint)),
+        days=FilteredRelation("accountdaybalance", condition=days),
+    ).filter(Q(cp__id__isnull=False) | Q(days__id__isnull=False))
+    if account:
+        qs = qs.filter(code=account)
+    return qs
+
+
+def balances_at(day, account=None):
+    """{account id: debit - credit} of all records with tdate <= day."""
+    checkpoint = nearest(day)
+    if checkpoint is None:
+        qs = AccountDayBalance.objects.filter(tdate__lte=day)
+        if account:
+            qs = qs.filter(account__code=account)
+        qs = qs.values("account_id").annotate(
+            balance=Sum(F("debit") - F("credit")),
+        ).order_by()
+        return {row["account_id"]: row["balance"] for row in qs}
+    qs = account_totals(checkpoint, day, account).values("id").annotate(
+        balance=Coalesce(Max(F("cp__debit") - F("cp__credit")), 0)
+        + Coalesce(Sum(F("days__debit") - F("days__credit")), 0),
+    ).order_by()
+    return {row["id"]: row["balance"] for row in qs}
+
+
+def close(period_end):
+    """Write the checkpoint of period_end. Return it."""
+    with transaction.atomic():
+        lock(shared=False)
+        if BalanceCheckpoint.objects.filter(period_end=period_end).exists():
+            raise ValueError("Period %s is already closed." % period_end)
+        previous = nearest(period_end)
+        checkpoint = BalanceCheckpoint.objects.create(period_end=period_end)
+        if previous is None:
+            rows = AccountDayBalance.objects.filter(
+                tdate__lte=period_end,
+            ).values("account_id").annotate(
+                total_debit=Sum("debit"),
+                total_credit=Sum("credit"),
+            ).order_by()
+            rows = [(r["account_id"], r["total_debit"], r["total_credit"])
+                    for r in rows]
+        else:
+            rows = account_totals(previous, period_end).values("id").annotate(
+                total_debit=Coalesce(Max("cp__debit"), 0)
+                + Coalesce(Sum("days__debit"), 0),
+                total_credit=Coalesce(Max("cp__credit"), 0)
+                + Coalesce(Sum("days__credit"), 0),
+            ).order_by()
+            rows = [(r["id"], r["total_debit"], r["total_credit"])
+                    for r in rows]
+        CheckpointBalance.objects.bulk_create(
+            [CheckpointBalance(checkpoint=checkpoint, account_id=a,
+                               debit=d, credit=c) for a, d, c in rows],
+            batch_size=1000,
+        )
+    return checkpoint
+
+
+def month_ends(first, last):
+    """Last day of every month from the month of first to last."""
+    day = first.replace(day=1)
+    while True:
+        end = (day + datetime.timedelta(days=32)).replace(
+            day=1) - datetime.timedelta(days=1)
+        if end > last:
+            return
+        yield end
+        day = end + datetime.timedelta(days=1)
+
+
+def reopen(period_end):
+    """Delete the checkpoint of period_end. Return whether it existed."""
+    deleted, _ = BalanceCheckpoint.objects.filter(
+        period_end=period_end).delete()
+    return bool(deleted)
+
+
+def derive(period_end):
+    """
+    {account id: (debit, credit)} of period_end from the raw records,
+    live and archived.
+    """
+    qs = TransactionRecord.objects.filter(
+        transaction__tdate__lte=period_end,
+    ).values("account_id").annotate(
+        debit=Sum("amount", filter=Q(side=TransactionRecord.DEBIT),
+                  default=0),
+        credit=Sum("amount", filter=Q(side=TransactionRecord.CREDIT),
+                   default=0),
+    ).order_by()
+    totals = {row["account_id"]: (row["debit"], row["credit"]) for row in qs}
+    for (account, _), (debit, credit) in archive.day_totals(
+            period_end).items():
+        d, c = totals.get(account, (0, 0))
+        totals[account] = (d + debit, c + credit)
+    return totals
+
+
+def verify(checkpoint):
+    """Return [(account id, stored, expected)] of the rows that differ."""
+    expected = derive(checkpoint.period_end)
+    stored = {
+        row[0]: (row[1], row[2])
+        for row in checkpoint.balances.values_list(
+            "account_id", "debit", "credit")
+    }
+    return [
+        (key, stored.get(key, (0, 0)), expected.get(key, (0, 0)))
+        for key in sorted(set(stored) | set(expected))
+        if stored.get(key, (0, 0)) != expected.get(key, (0, 0))
+    ]
+
+
+def repair(checkpoint):
+    """Replace the rows of checkpoint with derive()."""
+    with transaction.atomic():
+        lock(shared=False)
+        checkpoint.balances.all().delete()
+        CheckpointBalance.objects.bulk_create(
+            [CheckpointBalance(checkpoint=checkpoint, account_id=a,
+                               debit=d, credit=c)
+             for a, (d, c) in derive(checkpoint.period_end).items()],
+            batch_size=1000,
+        )
@@ -0,0 +1,414 @@
+"""
+In-memory columnar copy of the journal for vectorized aggregation.
+
+    ledger = ColumnarLedger.load(start, end)
+    ledger.refresh()                    # append what was posted since
+    ledger.balances(end=day)            # same rows as reports.trial_balance
+    ledger.period_totals("month")       # per account and month
+    ledger.rollup()                     # totals of every account subtree
+
+Every TransactionRecord of the tdate range is one row of four NumPy
+arrays: transaction id (int64), tdate as a date ordinal (int32), account
+id (int32; codes are strings, they are only looked up for the result)
+and amount (int64, debit positive, credit negative). The aggregations
+are masks and group-by sums over these arrays, no ORM query and no
+Python loop per record, so a dashboard can ask many of them per load.
+
+Records of months removed to the archive (archive.py) are read from
+their Parquet files on each full load, so the aggregations match the
+reports; this needs pyarrow once anything is removed.
+
+refresh() appends the transactions with an id above the last one
+loaded. It reloads everything when the number of live records at or
+below that id changed, i.e. a lower id committed late, records were
+deleted, or a month was archived away or restored; edits of loaded
+records and moved accounts are not seen, call reload() after those.
+
+The arrays and the chart of accounts form one immutable Snapshot.
+reload() and refresh() build the next one aside and publish it with a
+single assignment, and each aggregation reads the current snapshot
+once, so other threads can aggregate while a refresh runs. ledger()
+keeps refreshed copies of the PSQLJ_COLUMNAR_MAX_LEDGERS ranges used
+last in the process.
+
+Needs the numpy package. The bench_columnar command compares it with
+the same aggregations in SQL.
+"""
+import collections
+import datetime
+import itertools
+import threading
+
+from django.conf import settings
+
+from . import archive
+from .models import Account, TransactionRecord
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+DEFAULT_CHUNK_SIZE = 20000
+DEFAULT_MAX_LEDGERS = 4
+FREQUENCIES = ("day", "month", "year")
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def _require_numpy():
+    if np is None:
+        raise ImportError("The columnar ledger needs the 'numpy' package.")
+
+
+def _sum_by(keys, values, size):
+    """Exact int64 sums of values per key in range(size)."""
+    sums = np.zeros(size, dtype=np.int64)
+    np.add.at(sums, keys, values)
+    return sums
+
+
+def _periods(days, freq):
+    """Date ordinals to consecutive period numbers of freq."""
+    if freq == "day":
+        return days.astype(np.int64)
+    unit = "M" if freq == "month" else "Y"
+    return (days - _EPOCH).astype("datetime64[D]").astype(
+        "datetime64[%s]" % unit).astype(np.int64)
+
+
+def _period_starts(periods, freq):
+    """Period numbers of _periods() to the dates they start on."""
+    if freq == "day":
+        return (periods - _EPOCH).astype("datetime64[D]").tolist()
+    unit = "M" if freq == "month" else "Y"
+    return periods.astype("datetime64[%s]" % unit).astype(
+        "datetime64[D]").tolist()
+
+
+# transaction, day, account, amount: the columns, one row per record
+# last_id: highest transaction id loaded
+# archived: rows read from the archive, not from the live tables
+# codes, parent, depth: per account id the code, parent id (-1 for a
+#   root) and depth from the root
+Snapshot = collections.namedtuple("Snapshot", [
+    "transaction", "day", "account", "amount", "last_id", "archived",
+    "codes", "parent", "depth",
+])
+
+
+def _empty():
+    return Snapshot(
+        transaction=np.zeros(0, dtype=np.int64),
+        day=np.zeros(0, dtype=np.int32),
+        account=np.zeros(0, dtype=np.int32),
+        amount=np.zeros(0, dtype=np.int64),
+        last_id=0, archived=0, codes={},
+        parent=np.zeros(0, dtype=np.int32),
+        depth=np.zeros(0, dtype=np.int32),
+    )
+
+
+def _accounts():
+    """codes, parent and depth of a Snapshot, from the chart of accounts."""
+    rows = list(Account.objects.values_list("id", "code", "parent_id"))
+    size = max((pk for pk, _, _ in rows), default=0) + 1
+    codes = {pk: code for pk, code, _ in rows}
+    parent = np.full(size, -1, dtype=np.int32)
+    for pk, _, parent_id in rows:
+        if parent_id is not None:
+            parent[pk] = parent_id
+    # depth from the root, to roll up one level at a time
+    depth = np.zeros(size, dtype=np.int32)
+    ancestor = parent[np.arange(size)]
+    while (ancestor >= 0).any():
+        depth += ancestor >= 0
+        ancestor = np.where(ancestor >= 0, parent[ancestor], -1)
+    return codes, parent, depth
+
+
+def _appended(data, parts, **changes):
+    """data with the rows of parts added, and changes applied."""
+    if parts:
+        columns = list(zip(*parts))
+        changes.update(
+            transaction=np.concatenate([data.transaction, *columns[0]]),
+            day=np.concatenate([data.day, *columns[1]]),
+            account=np.concatenate([data.account, *columns[2]]),
+            amount=np.concatenate([data.amount, *columns[3]]),
+            last_id=max([data.last_id] + [int(p[0].max())
+                                          for p in parts if len(p[0])]),
+        )
+    return data._replace(**changes)
+
+
+class ColumnarLedger:
+    def __init__(self, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        _require_numpy()
+        self.start = start
+        self.end = end
+        self.chunk_size = chunk_size
+        self.loaded = False
+        self.data = _empty()
+        # one reload or refresh at a time; readers do not wait
+        self._lock = threading.RLock()
+
+    @classmethod
+    def load(cls, start=None, end=None, chunk_size=DEFAULT_CHUNK_SIZE):
+        """Load the records with tdate in [start, end]."""
+        ledger = cls(start, end, chunk_size)
+        ledger.reload()
+        return ledger
+
+    def __len__(self):
+        return len(self.data.amount)
+
+    @property
+    def nbytes(self):
+        data = self.data
+        return sum(a.nbytes for a in (
+            data.transaction, data.day, data.account, data.amount))
+
+    ##############
+    # Loading
+
+    def _records(self, after_id=0):
+        qs = TransactionRecord.objects.filter(transaction_id__gt=after_id)
+        if self.start:
+            qs = qs.filter(transaction__tdate__gte=self.start)
+        if self.end:
+            qs = qs.filter(transaction__tdate__lte=self.end)
+        return qs
+
+    def _fetch(self, after_id=0):
+        """The four columns of the records of transactions > after_id."""
+        rows = self._records(after_id).order_by(
+            "transaction_id", "record_num",
+        ).values_list(
+            "transaction_id", "transaction__tdate", "account_id", "amount",
+            "side",
+        ).iterator(chunk_size=self.chunk_size)
+        ordinals = {}
+        parts = []
+        while True:
+            chunk = list(itertools.islice(rows, self.chunk_size))
+            if not chunk:
+                break
+            txn, tdate, account, amount, side = zip(*chunk)
+            for day in set(tdate).difference(ordinals):
+                ordinals[day] = day.toordinal()
+            amount = np.array(amount, dtype=np.int64)
+            parts.append((
+                np.array(txn, dtype=np.int64),
+                np.array([ordinals[d] for d in tdate], dtype=np.int32),
+                np.array(account, dtype=np.int32),
+                np.where(np.array(side) == TransactionRecord.DEBIT,
+                         amount, -amount),
+            ))
+        return parts
+
+    def _fetch_archived(self):
+        """The four columns of the records removed to the archive."""
+        if not archive.has_removed(self.start, self.end):
+            return []
+        table = archive.read(self.start, self.end, columns=[
+            "transaction_id", "tdate", "account_id", "amount", "side"])
+        if not len(table):
+            return []
+        amount = table.column("amount").to_numpy().astype(np.int64)
+        debit = (table.column("side").to_numpy(zero_copy_only=False)
+                 == TransactionRecord.DEBIT)
+        return [(
+            table.column("transaction_id").to_numpy().astype(np.int64),
+            (table.column("tdate").to_numpy().astype(np.int64)
+             + _EPOCH).astype(np.int32),
+            table.column("account_id").to_numpy().astype(np.int32),
+            np.where(debit, amount, -amount),
+        )]
+
+    def reload(self):
+        """Load the whole range again. Return the number of records."""
+        with self._lock:
+            # live first: a month removed in between is then read twice,
+            # which the next refresh() sees, instead of not at all
+            parts = self._fetch()
+            archived = self._fetch_archived()
+            codes, parent, depth = _accounts()
+            self.data = _appended(_empty(), archived + parts, codes=codes,
+                                  parent=parent, depth=depth,
+                                  archived=sum(len(p[0]) for p in archived))
+            self.loaded = True
+            return len(self.data.amount)
+
+    def refresh(self):
+        """
+        Append the records of transactions posted since the last load.
+        Return the number of records added (all of them after a reload).
+        """
+        with self._lock:
+            if not self.loaded:
+                return self.reload()
+            data = self.data
+            loaded = self._records().filter(
+                transaction_id__lte=data.last_id).count()
+            if loaded != len(data.amount) - data.archived:
+                return self.reload()
+            parts = self._fetch(data.last_id)
+            changes = {}
+            if any(len(p[2]) and p[2].max() >= len(data.parent)
+                   for p in parts):
+                changes = dict(zip(("codes", "parent", "depth"), _accounts()))
+            self.data = _appended(data, parts, **changes)
+            return sum(len(p[0]) for p in parts)
+
+    def with_records(self, rows):
+        """
+        A copy with extra rows of (account code, tdate, amount, side)
+        that are not written anywhere, for what-if analysis.
+        """
+        data = self.data
+        ids = {code: pk for pk, code in data.codes.items()}
+        copy = ColumnarLedger(self.start, self.end, self.chunk_size)
+        copy.loaded = self.loaded
+        copy.data = data
+        rows = list(rows)
+        if not rows:
+            return copy
+        account, tdate, amount, side = zip(*rows)
+        unknown = set(account).difference(ids)
+        if unknown:
+            raise ValueError("Unknown accounts: %s" % ", ".join(sorted(unknown)))
+        amount = np.array(amount, dtype=np.int64)
+        copy.data = _appended(data, [(
+            np.zeros(len(rows), dtype=np.int64),
+            np.array([d.toordinal() for d in tdate], dtype=np.int32),
+            np.array([ids[code] for code in account], dtype=np.int32),
+            np.where(np.array(side) == TransactionRecord.DEBIT,
+                     amount, -amount),
+        )])
+        return copy
+
+    ##############
+    # Aggregations
+    #   Each reads self.data once: a refresh publishing a new snapshot
+    #   meanwhile does not mix two of them.
+
+    @staticmethod
+    def _mask(data, start=None, end=None, account=None):
+        mask = np.ones(len(data.amount), dtype=bool)
+        if start:
+            mask &= data.day >= start.toordinal()
+        if end:
+            mask &= data.day <= end.toordinal()
+        if account:
+            codes = [account] if isinstance(account, str) else account
+            ids = [pk for pk, code in data.codes.items() if code in codes]
+            mask &= np.isin(data.account, ids)
+        return mask
+
+    @staticmethod
+    def _account_sums(data, mask):
+        account = data.account[mask]
+        amount = data.amount[mask]
+        size = len(data.parent)
+        debit = _sum_by(account, np.maximum(amount, 0), size)
+        credit = _sum_by(account, np.maximum(-amount, 0), size)
+        present = np.bincount(account, minlength=size) > 0
+        return debit, credit, present
+
+    def balances(self, start=None, end=None, account=None):
+        """
+        {"account", "debit", "credit", "balance"} per account with records
+        in [start, end], ordered by account code.
+        """
+        data = self.data
+        debit, credit, present = self._account_sums(
+            data, self._mask(data, start, end, account))
+        rows = [
+            {"account": data.codes[pk], "debit": int(debit[pk]),
+             "credit": int(credit[pk]), "balance": int(debit[pk] - credit[pk])}
+            for pk in np.flatnonzero(present)
+        ]
+        return sorted(rows, key=lambda row: row["account"])
+
+    def period_totals(self, freq="month", start=None, end=None, account=None):
+        """
+        {"account", "period", "debit", "credit"} per account and period
+        (first day of the day, month or year), ordered by account code
+        and period.
+        """
+        if freq not in FREQUENCIES:
+            raise ValueError("freq must be one of %s." % ", ".join(FREQUENCIES))
+        data = self.data
+        mask = self._mask(data, start, end, account)
+        periods = _periods(data.day[mask], freq)
+        if not len(periods):
+            return []
+        first = periods.min()
+        span = int(periods.max() - first) + 1
+        keys = data.account[mask].astype(np.int64) * span + (periods - first)
+        found, inverse = np.unique(keys, return_inverse=True)
+        amount = data.amount[mask]
+        debit = _sum_by(inverse, np.maximum(amount, 0), len(found))
+        credit = _sum_by(inverse, np.maximum(-amount, 0), len(found))
+        rows = [
+            {"account": data.codes[pk], "period": period,
+             "debit": d, "credit": c}
+            for pk, period, d, c in zip(
+                (found // span).tolist(),
+                _period_starts(first + found % span, freq),
+                debit.tolist(), credit.tolist())
+        ]
+        # found is ordered by account id and period, the sort is stable
+        return sorted(rows, key=lambda row: row["account"])
+
+    def rollup(self, start=None, end=None):
+        """
+        {account code: {"debit", "credit", "balance"}} of each account
+        plus all its descendants, for the accounts with any records.
+        """
+        data = self.data
+        debit, credit, present = self._account_sums(
+            data, self._mask(data, start, end))
+        present = present.astype(np.int64)
+        # add every level to its parents, deepest first
+        for level in range(int(data.depth.max(initial=0)), 0, -1):
+            ids = np.flatnonzero(data.depth == level)
+            parents = data.parent[ids]
+            for total in (debit, credit, present):
+                np.add.at(total, parents, total[ids])
+        return {
+            data.codes[pk]: {"debit": int(debit[pk]),
+                             "credit": int(credit[pk]),
+                             "balance": int(debit[pk] - credit[pk])}
+            for pk in np.flatnonzero(present)
+        }
+
+
+##############
+# Refreshed copies of the ranges used last, for the process
+
+_ledgers = collections.OrderedDict()
+_lock = threading.Lock()
+
+
+def max_ledgers():
+    return getattr(settings, "PSQLJ_COLUMNAR_MAX_LEDGERS", DEFAULT_MAX_LEDGERS)
+
+
+def ledger(start=None, end=None):
+    """
+    The shared ColumnarLedger of [start, end], refreshed on each call.
+    The least recently used range is dropped beyond max_ledgers().
+    """
+    with _lock:
+        current = _ledgers.get((start, end))
+        if current is None:
+            current = _ledgers[(start, end)] = ColumnarLedger(start, end)
+        _ledgers.move_to_end((start, end))
+        while len(_ledgers) > max_ledgers():
+            _ledgers.popitem(last=False)
+    # loads it the first time; other ranges are not held up meanwhile
+    current.refresh()
+    return current
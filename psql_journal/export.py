@@ -0,0 +1,125 @@
+"""
+Streaming export of the general ledger.
+
+Rows are read through QuerySet.iterator(chunk_size=...), which uses a
+server-side cursor on PostgreSQL, and written out as they arrive, so
+memory use does not grow with the size of the ledger.
+
+Records of archived months that were removed from the live tables are
+merged in from the archive (see archive.py). Ordered by account, both
+sides compare codes by code point, as Python and Arrow do, not by the
+database collation.
+"""
+import csv
+import heapq
+import tempfile
+
+from django.db import connection
+from django.db.models import F
+from django.db.models.functions import Collate
+
+from . import archive
+from .models import TransactionRecord
+
+
+DEFAULT_CHUNK_SIZE = 2000
+
+LEDGER_HEADER = [
+    "transaction_id", "tdate", "desc", "record_num",
+    "account", "side", "amount",
+]
+
+
+# collations that order strings by code point
+CODE_POINT_COLLATIONS = {"postgresql": "C", "sqlite": "BINARY"}
+
+
+def code_point_order(field="account__code"):
+    """Order expression of field by code point, see the module docstring."""
+    collation = CODE_POINT_COLLATIONS.get(connection.vendor)
+    return Collate(F(field), collation) if collation else F(field)
+
+
+def ledger_queryset(start=None, end=None, account=None, by_account=False):
+    """Live ledger rows ordered by date (by_account: by account first)."""
+    qs = TransactionRecord.objects.all()
+    if start:
+        qs = qs.filter(transaction__tdate__gte=start)
+    if end:
+        qs = qs.filter(transaction__tdate__lte=end)
+    if account:
+        qs = qs.filter(account__code=account)
+    order = ["transaction__tdate", "transaction_id", "record_num"]
+    if by_account:
+        order.insert(0, code_point_order())
+    return qs.order_by(*order).values_list(
+        "transaction_id", "transaction__tdate", "transaction__desc",
+        "record_num", "account__code", "side", "amount",
+    )
+
+
+def ledger_key(by_account=False):
+    """Sort key of ledger rows in the order of ledger_queryset()."""
+    if by_account:
+        return lambda row: (row[4], row[1], row[0], row[3])
+    return lambda row: (row[1], row[0], row[3])
+
+
+def ledger_rows(start=None, end=None, account=None,
+                chunk_size=DEFAULT_CHUNK_SIZE, by_account=False):
+    """Yield ledger rows (see LEDGER_HEADER) one by one."""
+    rows = ledger_queryset(start, end, account, by_account).iterator(
+        chunk_size=chunk_size)
+    if not archive.has_removed(start, end):
+        return rows
+    return heapq.merge(
+        archive.ledger_rows(start, end, account, by_account), rows,
+        key=ledger_key(by_account))
+
+
+class Echo:
+    """File-like object whose write() just returns the value."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(rows, header=LEDGER_HEADER):
+    """Yield CSV text lines for rows, header first."""
+    writer = csv.writer(Echo())
+    yield writer.writerow(header)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+def write_csv(rows, fileobj, header=LEDGER_HEADER):
+    for line in iter_csv(rows, header):
+        fileobj.write(line)
+
+
+def write_xlsx(rows, fileobj, header=LEDGER_HEADER):
+    """
+    Write rows to an XLSX file with openpyxl's write-only workbook,
+    which keeps only the current row in memory.
+    """
+    try:
+        from openpyxl import Workbook
+    except ImportError:
+        raise ImportError("XLSX export needs the 'openpyxl' package.")
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Ledger")
+    ws.append(header)
+    for row in rows:
+        ws.append(row)
+    wb.save(fileobj)
+
+
+def xlsx_tempfile(rows, header=LEDGER_HEADER):
+    """
+    XLSX is a zip archive and cannot be streamed while it is written,
+    so build it in a temporary file and return it rewound.
+    """
+    tmp = tempfile.TemporaryFile()
+    write_xlsx(rows, tmp, header)
+    tmp.seek(0)
+    return tmp
@@ -0,0 +1,22 @@
+from django import forms
+
+
+class LedgerFilterForm(forms.Form):
+    """Query-string filters shared by the ledger export and report views."""
+    start = forms.DateField(required=False)
+    end = forms.DateField(required=False)
+    account = forms.CharField(required=False, max_length=200)
+
+    def clean(self):
+        cleaned = super().clean()
+        start, end = cleaned.get("start"), cleaned.get("end")
+        if start and end and start > end:
+            raise forms.ValidationError("start must not be after end.")
+        return cleaned
+
+
+class SearchForm(forms.Form):
+    """Query string of the transaction search (search.py)."""
+    q = forms.CharField(required=False, max_length=200)
+    account = forms.CharField(required=False, max_length=200)
+    after = forms.CharField(required=False)
@@ -0,0 +1,175 @@
+"""
+Per-request SQL, template and form timings.
+
+RequestProfileMiddleware samples a fraction of the requests
+(PSQLJ_PROFILE_SAMPLE_RATE, 0.0 - 1.0). For a sampled request it installs
+an execute_wrapper on every database connection and records:
+
+  * query count, total SQL time and duplicate queries (same SQL and
+    parameters run more than once),
+  * template render time of TemplateResponses,
+  * form/formset construction time of the views wrapped in timed_forms().
+
+The result goes out as a Server-Timing header, readable in the browser's
+network panel, and as one JSON log line on the "psql_journal.profile"
+logger. Requests that are not sampled only pay for one random() call.
+"""
+import contextvars
+import functools
+import json
+import logging
+import random
+import time
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+
+from django.conf import settings
+from django.db import connections
+
+
+logger = logging.getLogger("psql_journal.profile")
+
+_profile = contextvars.ContextVar("psqlj_profile", default=None)
+
+
+class RequestProfile:
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql_time = 0.0
+        self.statements = Counter()
+        self.sections = Counter()
+
+    @property
+    def duplicates(self):
+        """Queries that repeat an earlier one with the same parameters."""
+        return sum(n - 1 for n in self.statements.values())
+
+    def sql_wrapper(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.sql_time += time.perf_counter() - start
+            self.queries += 1
+            self.statements[(sql, repr(params))] += 1
+
+    def as_dict(self):
+        return {
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 3),
+            "queries": self.queries,
+            "duplicates": self.duplicates,
+            "sql_ms": round(self.sql_time * 1000, 3),
+            **{"%s_ms" % name: round(t * 1000, 3)
+               for name, t in self.sections.items()},
+        }
+
+
+def current_profile():
+    """The RequestProfile of the running request, None if not sampled."""
+    return _profile.get()
+
+
+@contextmanager
+def section(name):
+    """Add the time spent in the block to the named section."""
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.sections[name] += time.perf_counter() - start
+
+
+def _in_section(name, func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with section(name):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def timed_forms(func):
+    """
+    Count a view method that returns a form or formset in the "forms"
+    section. Formsets build their forms lazily, so each form is counted
+    when (and if) it is built, which may be while rendering.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if _profile.get() is None:
+            return func(*args, **kwargs)
+        with section("forms"):
+            result = func(*args, **kwargs)
+        if result is not None and hasattr(result, "management_form"):
+            result._construct_form = _in_section("forms",
+                                                 result._construct_form)
+        return result
+    return wrapper
+
+
+def sample_rate():
+    return getattr(settings, "PSQLJ_PROFILE_SAMPLE_RATE", 0.0)
+
+
+def server_timing(data):
+    parts = [
+        'sql;dur=%s;desc="%d queries, %d duplicates"'
+        % (data["sql_ms"], data["queries"], data["duplicates"]),
+    ]
+    for name in ("render", "forms"):
+        if "%s_ms" % name in data:
+            parts.append("%s;dur=%s" % (name, data["%s_ms" % name]))
+    parts.append("total;dur=%s" % data["total_ms"])
+    return ", ".join(parts)
+
+
+class RequestProfileMiddleware:
+    """Put it first in MIDDLEWARE so "total" covers the other middleware."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        rate = sample_rate()
+        if rate <= 0 or random.random() >= rate:
+            return self.get_response(request)
+
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(profile.sql_wrapper))
+                response = self.get_response(request)
+        finally:
+            _profile.reset(token)
+
+        data = profile.as_dict()
+        response["Server-Timing"] = server_timing(data)
+        match = getattr(request, "resolver_match", None)
+        logger.info(json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "view": match.view_name if match else None,
+            "status": response.status_code,
+            **data,
+        }))
+        return response
+
+    def process_template_response(self, request, response):
+        profile = _profile.get()
+        if profile is not None:
+            # rendering starts right after the last template response
+            # middleware and ends with the post-render callbacks
+            start = time.perf_counter()
+
+            def rendered(response):
+                profile.sections["render"] += time.perf_counter() - start
+
+            response.add_post_render_callback(rendered)
+        return response
@@ -0,0 +1,335 @@
+"""
+Database-backed job queue for heavy journal operations.
+
+Jobs are rows of the Job model, so no broker is needed: the web tier
+calls enqueue() and returns at once, and one or more
+`manage.py run_jobs` workers claim and run them.
+
+  * A task is a function registered with @task(name, concurrency=...).
+    At most `concurrency` jobs of one kind run at a time across all
+    workers; on PostgreSQL claims are serialized by an advisory lock so
+    the limit holds exactly.
+  * A failed job is queued again after retry_delay * 2**(attempt - 1)
+    seconds until max_attempts; raise JobError to fail without retry.
+  * Tasks report progress with progress(job, done, total, message).
+    While a task runs, a thread of its worker writes the heartbeat four
+    times per PSQLJ_JOB_STALE_AFTER, however long the task blocks. A
+    running job without a heartbeat for PSQLJ_JOB_STALE_AFTER seconds
+    (its worker died) is requeued, and the old worker no longer records
+    progress or a result for it.
+
+Files read or written by tasks live under PSQLJ_JOB_DIR.
+"""
+import datetime
+import os
+import threading
+import traceback
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, F
+from django.utils import timezone
+
+from . import audit, balances, export, matviews, reports
+from .bulkload import DEFAULT_CHUNK_SIZE, READERS, load_journal
+from .forms import LedgerFilterForm
+from .models import Job
+
+
+DEFAULT_STALE_AFTER = 600
+# pg_advisory_xact_lock key of the claim step
+CLAIM_LOCK_ID = 0x70736a6a
+
+TASKS = {}
+
+
+class JobError(Exception):
+    """A failure that retrying will not fix, e.g. bad parameters."""
+
+
+class Task:
+    def __init__(self, name, func, concurrency, max_attempts, retry_delay):
+        self.name = name
+        self.func = func
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+
+
+def task(name, concurrency=1, max_attempts=3, retry_delay=30):
+    """Register func(job, **params) as the task of jobs of kind name."""
+    def decorator(func):
+        TASKS[name] = Task(name, func, concurrency, max_attempts, retry_delay)
+        return func
+    return decorator
+
+
+def enqueue(kind, params=None, delay=0):
+    """Queue a job of kind with JSON-serializable params."""
+    if kind not in TASKS:
+        raise JobError("Unknown job kind %r." % kind)
+    return Job.objects.create(
+        kind=kind,
+        params=params or {},
+        max_attempts=TASKS[kind].max_attempts,
+        run_after=timezone.now() + datetime.timedelta(seconds=delay),
+    )
+
+
+def stale_timeout():
+    return getattr(settings, "PSQLJ_JOB_STALE_AFTER", DEFAULT_STALE_AFTER)
+
+
+def _owned(job):
+    """The job's row while this claim of it is still running."""
+    return Job.objects.filter(pk=job.pk, status=Job.RUNNING,
+                              worker=job.worker, attempts=job.attempts)
+
+
+def progress(job, done, total=None, message=None):
+    """Record the progress of a running job (and that it is alive)."""
+    job.progress_done = done
+    fields = {"progress_done": done, "heartbeat": timezone.now()}
+    if total is not None:
+        job.progress_total = fields["progress_total"] = total
+    if message is not None:
+        job.message = fields["message"] = message[:200]
+    _owned(job).update(**fields)
+
+
+def claim(worker, kinds=None):
+    """Take the next runnable job within the concurrency limits, or None."""
+    now = timezone.now()
+    with transaction.atomic():
+        if connection.vendor == "postgresql":
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_advisory_xact_lock(%s)",
+                               [CLAIM_LOCK_ID])
+        running = dict(
+            Job.objects.filter(status=Job.RUNNING)
+            .values("kind").annotate(n=Count("id"))
+            .values_list("kind", "n")
+        )
+        allowed = [
+            name for name, t in TASKS.items()
+            if running.get(name, 0) < t.concurrency
+            and (not kinds or name in kinds)
+        ]
+        if not allowed:
+            return None
+        job = (
+            Job.objects.filter(status=Job.QUEUED, run_after__lte=now,
+                               kind__in=allowed)
+            .order_by("run_after", "id")
+            .first()
+        )
+        if job is None:
+            return None
+        claimed = Job.objects.filter(pk=job.pk, status=Job.QUEUED).update(
+            status=Job.RUNNING,
+            attempts=F("attempts") + 1,
+            worker=worker[:100],
+            started=now,
+            heartbeat=now,
+            finished=None,
+        )
+    if not claimed:
+        return None
+    job.refresh_from_db()
+    return job
+
+
+def _beat(job, stop, interval):
+    """Write the heartbeat of job every interval seconds until stop."""
+    try:
+        while not stop.wait(interval):
+            try:
+                _owned(job).update(heartbeat=timezone.now())
+            except DatabaseError:
+                # e.g. SQLite locked by the task; the next beat retries
+                pass
+    finally:
+        connection.close()
+
+
+def run(job):
+    """
+    Run a claimed job and record its result, retry or failure. Return
+    False if it failed, or if it was requeued meanwhile and another
+    worker owns it now.
+    """
+    spec = TASKS.get(job.kind)
+    stop = threading.Event()
+    beat = threading.Thread(target=_beat, daemon=True,
+                            args=(job, stop, stale_timeout() / 4))
+    beat.start()
+    try:
+        if spec is None:
+            raise JobError("Unknown job kind %r." % job.kind)
+        try:
+            result = spec.func(job, **job.params)
+        finally:
+            stop.set()
+            beat.join()
+    except Exception as e:
+        retry = (not isinstance(e, (JobError, TypeError))
+                 and job.attempts < job.max_attempts)
+        fields = {"error": traceback.format_exc(), "heartbeat": timezone.now()}
+        if retry:
+            delay = spec.retry_delay * 2 ** (job.attempts - 1)
+            fields.update(
+                status=Job.QUEUED,
+                run_after=timezone.now() + datetime.timedelta(seconds=delay),
+                message="retry in %ds: %s" % (delay, str(e)[:150]),
+            )
+        else:
+            fields.update(status=Job.FAILED, finished=timezone.now(),
+                          message=str(e)[:200])
+        _owned(job).update(**fields)
+        return False
+    return bool(_owned(job).update(
+        status=Job.DONE, result=result, error="",
+        finished=timezone.now(), heartbeat=timezone.now(),
+    ))
+
+
+def requeue_stale(stale_after=None):
+    """Give jobs of dead workers back to the queue. Return how many."""
+    if stale_after is None:
+        stale_after = stale_timeout()
+    now = timezone.now()
+    stale = Job.objects.filter(
+        status=Job.RUNNING,
+        heartbeat__lt=now - datetime.timedelta(seconds=stale_after),
+    )
+    failed = stale.filter(attempts__gte=F("max_attempts")).update(
+        status=Job.FAILED, finished=now, message="worker lost")
+    requeued = stale.update(
+        status=Job.QUEUED, run_after=now, message="requeued, worker lost")
+    return failed + requeued
+
+
+##############
+# Job files
+
+def job_dir():
+    path = getattr(settings, "PSQLJ_JOB_DIR", None)
+    if not path:
+        path = os.path.join(settings.BASE_DIR, "var", "jobs")
+    os.makedirs(path, exist_ok=True)
+    return os.path.realpath(path)
+
+
+def job_path(name):
+    """Absolute path of name inside job_dir(); refuse anything outside."""
+    base = job_dir()
+    path = os.path.realpath(os.path.join(base, name))
+    if os.path.commonpath([base, path]) != base:
+        raise JobError("%r is outside the job directory." % name)
+    return path
+
+
+def _filters(start=None, end=None, account=None):
+    form = LedgerFilterForm({"start": start, "end": end, "account": account})
+    if not form.is_valid():
+        raise JobError(form.errors.as_text())
+    return form.cleaned_data
+
+
+def _counted(job, rows, every=10000):
+    n = 0
+    for n, row in enumerate(rows, start=1):
+        if n % every == 0:
+            progress(job, n)
+        yield row
+    progress(job, n)
+
+
+##############
+# Built-in tasks
+
+@task("import_journal", concurrency=1)
+def import_journal(job, path, format=None, chunk_size=None):
+    """
+    Load a CSV/JSONL file from the job directory. progress_done is the
+    committed entry offset, so a retry continues after the last chunk.
+    """
+    fmt = format or ("csv" if path.lower().endswith(".csv") else "jsonl")
+    if fmt not in READERS:
+        raise JobError("Unknown format %r." % fmt)
+
+    def on_chunk(result):
+        progress(job, result.offset, message="%d records" % result.records)
+
+    with open(job_path(path), "rt", encoding="utf-8", newline="") as f:
+        try:
+            result = load_journal(
+                READERS[fmt](f),
+                chunk_size=chunk_size or DEFAULT_CHUNK_SIZE,
+                skip=job.progress_done,
+                on_chunk=on_chunk,
+            )
+        except ValidationError as e:
+            raise JobError("; ".join(e.messages))
+    return {"offset": result.offset, "transactions": result.transactions,
+            "records": result.records, "duplicates": result.duplicates}
+
+
+@task("export_ledger", concurrency=2)
+def export_ledger(job, start=None, end=None, account=None, format="csv"):
+    filters = _filters(start, end, account)
+    name = "job-%d-ledger.%s" % (job.pk, format)
+    rows = _counted(job, export.ledger_rows(**filters))
+    if format == "xlsx":
+        with open(job_path(name), "wb") as f:
+            export.write_xlsx(rows, f)
+    elif format == "csv":
+        with open(job_path(name), "wt", encoding="utf-8", newline="") as f:
+            export.write_csv(rows, f)
+    else:
+        raise JobError("Unknown format %r." % format)
+    return {"file": name, "rows": job.progress_done}
+
+
+@task("rebuild_balances", concurrency=1)
+def rebuild_balances(job):
+    progress(job, 0, message="checking drift")
+    drifted = len(balances.find_drift())
+    progress(job, 0, message="rebuilding")
+    balances.rebuild()
+    return {"drifted": drifted}
+
+
+@task("period_close", concurrency=2)
+def period_close(job, start, end, account=None):
+    filters = _filters(start, end, account)
+    if not (filters["start"] and filters["end"]):
+        raise JobError("period_close needs start and end.")
+    columns = ["account", "opening", "debit", "credit", "closing"]
+    name = "job-%d-period-close.csv" % job.pk
+    rows = _counted(job, ([r[c] for c in columns]
+                          for r in reports.period_close(**filters)))
+    with open(job_path(name), "wt", encoding="utf-8", newline="") as f:
+        export.write_csv(rows, f, header=columns)
+    return {"file": name, "rows": job.progress_done}
+
+
+@task("refresh_matviews", concurrency=1)
+def refresh_matviews(job):
+    if not matviews.exists():
+        raise JobError("The materialized view does not exist.")
+    return {"ms": matviews.refresh()}
+
+
+@task("audit_journal", concurrency=1)
+def audit_journal(job, start=None, end=None):
+    filters = _filters(start, end)
+    columns = ["transaction", "debit", "credit"]
+    name = "job-%d-unbalanced.csv" % job.pk
+    rows = _counted(job, ([r[c] for c in columns]
+                          for r in audit.unbalanced(filters["start"],
+                                                    filters["end"])))
+    with open(job_path(name), "wt", encoding="utf-8", newline="") as f:
+        export.write_csv(rows, f, header=columns)
+    return {"file": name, "unbalanced": job.progress_done}
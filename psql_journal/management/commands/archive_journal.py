@@ -0,0 +1,83 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min, Sum
+
+from psql_journal import archive, checkpoints
+from psql_journal.models import ArchiveFile, Transaction
+
+
+def parse_month(value):
+    try:
+        return datetime.date.fromisoformat(value + "-01")
+    except ValueError:
+        raise CommandError("Month must look like YYYY-MM, got %r." % value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive closed months of the journal to compressed Parquet files "
+        "(year=YYYY/month=MM under PSQLJ_ARCHIVE_DIR) and optionally remove "
+        "them from the live tables. Balances, reports and exports keep "
+        "including removed months."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("month", nargs="*", type=parse_month,
+                            help="Month to archive, YYYY-MM.")
+        parser.add_argument("--closed", action="store_true",
+                            help="Archive every closed month that still has "
+                                 "live records.")
+        parser.add_argument("--remove", action="store_true",
+                            help="Delete the archived records from the live "
+                                 "tables.")
+        parser.add_argument("--restore", action="append", default=[],
+                            type=parse_month, metavar="YYYY-MM",
+                            help="Put the removed records of a month back.")
+        parser.add_argument("--chunk-size", type=int,
+                            default=archive.DEFAULT_CHUNK_SIZE,
+                            help="Records per Parquet row group.")
+        parser.add_argument("--list", action="store_true",
+                            help="List the archive files.")
+
+    def handle(self, *args, **options):
+        for month in options["restore"]:
+            restored = archive.restore(month)
+            if not restored:
+                raise CommandError("%s has no removed records."
+                                   % month.strftime("%Y-%m"))
+            self.stdout.write("Restored %d records of %s." % (
+                restored, month.strftime("%Y-%m")))
+
+        months = set(options["month"])
+        if options["closed"]:
+            first = Transaction.objects.aggregate(first=Min("tdate"))["first"]
+            closed = archive.closed_through()
+            if first and closed:
+                months.update(end.replace(day=1)
+                              for end in checkpoints.month_ends(first, closed))
+        for month in sorted(months):
+            try:
+                entry = archive.archive_month(
+                    month, remove=options["remove"],
+                    chunk_size=options["chunk_size"])
+            except (ImportError, ValueError) as e:
+                raise CommandError(str(e))
+            if entry is None:
+                continue
+            self.stdout.write(self.style.SUCCESS(
+                "Archived %s: %d transactions, %d records, %.1f kB%s." % (
+                    month.strftime("%Y-%m"), entry.transactions,
+                    entry.records,
+                    (archive.archive_dir() / entry.path).stat().st_size / 1024,
+                    ", removed" if entry.removed else "")))
+
+        if options["list"]:
+            for entry in ArchiveFile.objects.order_by("month", "id"):
+                self.stdout.write("%s  %8d records  %s%s" % (
+                    entry.month.strftime("%Y-%m"), entry.records, entry.path,
+                    "  removed" if entry.removed else ""))
+            totals = ArchiveFile.objects.filter(
+                removed__isnull=False).aggregate(records=Sum("records"))
+            self.stdout.write("%d records removed from the live tables."
+                              % (totals["records"] or 0))
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import audit
+from psql_journal.forms import LedgerFilterForm
+
+
+class Command(BaseCommand):
+    help = (
+        "List the transactions whose debits and credits differ, found with "
+        "one aggregate query and streamed as they are read."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="First tdate, YYYY-MM-DD.")
+        parser.add_argument("--end", help="Last tdate, YYYY-MM-DD.")
+        parser.add_argument("--ids-only", action="store_true",
+                            help="Print only the transaction ids.")
+        parser.add_argument("--chunk-size", type=int,
+                            default=audit.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        form = LedgerFilterForm({"start": options["start"],
+                                 "end": options["end"]})
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        count = 0
+        for row in audit.unbalanced(form.cleaned_data["start"],
+                                    form.cleaned_data["end"],
+                                    chunk_size=options["chunk_size"]):
+            count += 1
+            if options["ids_only"]:
+                self.stdout.write(str(row["transaction"]))
+            else:
+                self.stdout.write("%(transaction)s debit %(debit)s "
+                                  "credit %(credit)s" % row)
+        if not audit.trigger_installed():
+            self.stderr.write("Note: no commit-time balance check is "
+                              "installed on this database.")
+        if count:
+            raise CommandError("%d unbalanced transactions." % count)
+        self.stderr.write(self.style.SUCCESS("All transactions balance."))
@@ -0,0 +1,149 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.db.models import Q, Sum
+from django.db.models.functions import TruncMonth
+
+from psql_journal import benchmarks, columnar, reports
+from psql_journal.bulkload import load_journal
+from psql_journal.models import Account, TransactionRecord
+
+
+def sql_balances():
+    debit = Q(side=TransactionRecord.DEBIT)
+    return [
+        {"account": row["account__code"], "debit": row["debit"],
+         "credit": row["credit"], "balance": row["debit"] - row["credit"]}
+        for row in TransactionRecord.objects.values("account__code").annotate(
+            debit=Sum("amount", filter=debit, default=0),
+            credit=Sum("amount", filter=~debit, default=0),
+        ).order_by("account__code")
+    ]
+
+
+def sql_monthly():
+    debit = Q(side=TransactionRecord.DEBIT)
+    return [
+        {"account": row["account__code"], "period": row["period"],
+         "debit": row["debit"], "credit": row["credit"]}
+        for row in TransactionRecord.objects.annotate(
+            period=TruncMonth("transaction__tdate"),
+        ).values("account__code", "period").annotate(
+            debit=Sum("amount", filter=debit, default=0),
+            credit=Sum("amount", filter=~debit, default=0),
+        ).order_by("account__code", "period")
+    ]
+
+
+def sql_rollup():
+    qn = connection.ops.quote_name
+    sql = (
+        "SELECT a.code, "
+        "SUM(CASE WHEN r.side = 'D' THEN r.amount ELSE 0 END), "
+        "SUM(CASE WHEN r.side = 'C' THEN r.amount ELSE 0 END) "
+        "FROM {acc} a JOIN {acc} d ON d.path LIKE a.path || '%' "
+        "JOIN {rec} r ON r.account_id = d.id GROUP BY a.code"
+    ).format(acc=qn(Account._meta.db_table),
+             rec=qn(TransactionRecord._meta.db_table))
+    with connection.cursor() as cursor:
+        cursor.execute(sql)
+        return {
+            code: {"debit": int(d), "credit": int(c), "balance": int(d - c)}
+            for code, d, c in cursor.fetchall()
+        }
+
+
+def build_tree():
+    """Give the synthetic accounts parents: 1000 > 1010 > 1011, ..."""
+    accounts = {a.code: a for a in Account.objects.filter(
+        code__regex=r"^1[0-9]{3}$").order_by("code")}
+    for code, acc in accounts.items():
+        n = int(code)
+        parent = "%d" % (n - n % 10 if n % 10 else n - n % 100)
+        if parent != code and parent in accounts:
+            acc.parent = accounts[parent]
+            acc.save()
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic journal and compare balances, monthly totals and "
+        "account roll-ups computed by the NumPy columnar ledger "
+        "(psql_journal/columnar.py) with the same aggregations in SQL. "
+        "Seeded data is rolled back; --transactions 0 uses the current "
+        "journal."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transactions", type=int, default=100000)
+        parser.add_argument("--records", type=int, default=3,
+                            help="Records per transaction.")
+        parser.add_argument("--refresh", type=int, default=1000,
+                            help="Transactions posted before timing refresh().")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+
+    def handle(self, *args, **options):
+        if columnar.np is None:
+            raise CommandError("bench_columnar needs the 'numpy' package.")
+        try:
+            with transaction.atomic():
+                results = self.run(options)
+                raise benchmarks.Rollback
+        except benchmarks.Rollback:
+            pass
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write("Wrote %s" % options["output"])
+
+    def run(self, options):
+        repeat = options["repeat"]
+        if options["transactions"]:
+            result = load_journal(benchmarks.synthetic_entries(
+                options["transactions"], options["records"]))
+            self.stdout.write("Seeded %s" % result)
+            build_tree()
+            benchmarks.analyze()
+
+        results = {}
+        self.stdout.write(self.style.MIGRATE_HEADING("== loading =="))
+        results["load"] = benchmarks.timed(columnar.ColumnarLedger.load, 1)
+        ledger = columnar.ColumnarLedger.load()
+        self.stdout.write("%d records, %.1f MB, load %.1f ms" % (
+            len(ledger), ledger.nbytes / 1e6, results["load"]["median_ms"]))
+        if options["refresh"]:
+            load_journal(benchmarks.synthetic_entries(
+                options["refresh"], options["records"], seed=1))
+            results["refresh"] = benchmarks.timed(ledger.refresh, 1)
+            self.stdout.write("refresh after %d transactions: %.1f ms, "
+                              "%d records" % (options["refresh"],
+                                              results["refresh"]["median_ms"],
+                                              len(ledger)))
+
+        cases = [
+            ("balances", ledger.balances, [
+                ("sql", sql_balances),
+                ("summary tables",
+                 lambda: list(reports.trial_balance())),
+            ]),
+            ("monthly totals", ledger.period_totals, [("sql", sql_monthly)]),
+            ("rollup", ledger.rollup, [("sql", sql_rollup)]),
+        ]
+        for name, compute, others in cases:
+            self.stdout.write(self.style.MIGRATE_HEADING("== %s ==" % name))
+            expected = compute()
+            results[name] = {"columnar": benchmarks.timed(compute, repeat)}
+            self.line("columnar", results[name]["columnar"])
+            for other, func in others:
+                results[name][other] = timing = benchmarks.timed(func, repeat)
+                self.line(other, timing, func() == expected)
+        return results
+
+    def line(self, name, timing, match=None):
+        text = "%s: median %.3f ms (min %.3f, max %.3f)" % (
+            name, timing["median_ms"], timing["min_ms"], timing["max_ms"])
+        if match is not None:
+            text += ", same result" if match else ", DIFFERENT RESULT"
+        self.stdout.write(self.style.MIGRATE_LABEL(text))
@@ -0,0 +1,93 @@
+import copy
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+from django.db.utils import load_backend
+
+from psql_journal import benchmarks
+
+
+MODES = {
+    "new connection": {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": False,
+    },
+    "persistent": {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": False,
+    },
+    "persistent + health check": {
+        "ENGINE": "django.db.backends.postgresql",
+        "CONN_MAX_AGE": 600,
+        "CONN_HEALTH_CHECKS": True,
+    },
+    "pool": {
+        "ENGINE": "asite.db.postgresql_pool",
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": False,
+        "POOL": {"min_size": 1, "max_size": 4},
+    },
+    "pool + health check": {
+        "ENGINE": "asite.db.postgresql_pool",
+        "CONN_MAX_AGE": 0,
+        "CONN_HEALTH_CHECKS": False,
+        "POOL": {"min_size": 1, "max_size": 4, "health_check": True},
+    },
+}
+
+
+def make_wrapper(alias, base_settings, mode):
+    settings_dict = copy.deepcopy(base_settings)
+    mode = dict(mode)
+    pool = mode.pop("POOL", None)
+    settings_dict.update(mode)
+    settings_dict["OPTIONS"].pop("pool", None)
+    if pool is not None:
+        settings_dict["OPTIONS"]["pool"] = pool
+    backend = load_backend(settings_dict["ENGINE"])
+    return backend.DatabaseWrapper(settings_dict, alias)
+
+
+def one_request(wrapper):
+    # what the request_started / request_finished handlers do
+    wrapper.close_if_unusable_or_obsolete()
+    with wrapper.cursor() as cursor:
+        cursor.execute("SELECT 1")
+        cursor.fetchone()
+    wrapper.close_if_unusable_or_obsolete()
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure connection overhead per request for a new connection per "
+        "request, persistent connections and the in-process pool."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200)
+        parser.add_argument("--database", default="default")
+
+    def handle(self, *args, **options):
+        base_settings = connections[options["database"]].settings_dict
+        if "postgresql" not in base_settings["ENGINE"]:
+            raise CommandError("Needs a PostgreSQL database.")
+        n = options["requests"]
+
+        for name, mode in MODES.items():
+            alias = "bench_%s" % name.replace(" ", "").replace("+", "_")
+            try:
+                wrapper = make_wrapper(alias, base_settings, mode)
+            except Exception as e:
+                self.stdout.write("%-26s skipped: %s" % (name, e))
+                continue
+            one_request(wrapper)        # warm up (fills the pool)
+            try:
+                timing = benchmarks.timed(lambda: one_request(wrapper), n)
+            finally:
+                wrapper.close()
+            self.stdout.write(
+                "%-26s median %.3f ms  min %.3f ms  max %.3f ms per request"
+                % (name, timing["median_ms"], timing["min_ms"],
+                   timing["max_ms"]))
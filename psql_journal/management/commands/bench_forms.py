@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from psql_journal import views
+from psql_journal.utils import clear_form_class_cache
+
+
+FORM_VIEWS = [
+    ("MainFormView", views.MainFormView),
+    ("MasterCreateView", views.MasterCreateView),
+    ("TwoInputMultipleCreateView", views.TwoInputMultipleCreateView),
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "Microbenchmark GET requests/sec of the form views with and "
+        "without the form class cache (PSQLJ_FORM_CLASS_CACHE)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=500)
+
+    def handle(self, *args, **options):
+        factory = RequestFactory()
+        n = options["requests"]
+        for name, view_class in FORM_VIEWS:
+            view = view_class.as_view()
+            rates = []
+            for enabled in (False, True):
+                with override_settings(PSQLJ_FORM_CLASS_CACHE=enabled):
+                    clear_form_class_cache()
+                    view(factory.get("/")).render()     # warm up
+                    t0 = time.perf_counter()
+                    for _ in range(n):
+                        view(factory.get("/")).render()
+                    rates.append(n / (time.perf_counter() - t0))
+            self.stdout.write(
+                "%-28s no cache %8.1f req/s   cache %8.1f req/s   x%.2f"
+                % (name, rates[0], rates[1], rates[1] / rates[0]))
@@ -0,0 +1,108 @@
+import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from psql_journal import benchmarks
+from psql_journal.bulkload import load_journal
+from psql_journal.models import Account, Transaction, TransactionRecord
+
+
+def journal_queries(account_id):
+    txn = connection.ops.quote_name(Transaction._meta.db_table)
+    rec = connection.ops.quote_name(TransactionRecord._meta.db_table)
+    start = datetime.date(2021, 3, 1)
+    end = datetime.date(2021, 3, 31)
+    return [
+        (
+            "date range",
+            "SELECT id, tdate, %s FROM %s WHERE tdate BETWEEN %%s AND %%s "
+            "ORDER BY tdate, id" % (connection.ops.quote_name("desc"), txn),
+            [start, end],
+        ),
+        (
+            "one account",
+            "SELECT transaction_id, amount, side FROM %s WHERE account_id = %%s"
+            % rec,
+            [account_id],
+        ),
+        (
+            "account in date range",
+            "SELECT r.transaction_id, t.tdate, r.amount, r.side "
+            "FROM %s r JOIN %s t ON t.id = r.transaction_id "
+            "WHERE r.account_id = %%s AND t.tdate BETWEEN %%s AND %%s"
+            % (rec, txn),
+            [account_id, start, end],
+        ),
+    ]
+
+
+def partitioned_queries():
+    start = datetime.date(2021, 3, 1)
+    end = datetime.date(2021, 3, 31)
+    return [
+        (
+            "partitioned date range",
+            "SELECT transaction_id, account_id, amount, side FROM lzy_journal_part "
+            "WHERE tdate BETWEEN %s AND %s",
+            [start, end],
+        ),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a synthetic journal and show query plans and timings of the "
+        "date-range and per-account queries with and without the journal "
+        "indexes. Everything is rolled back at the end."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transactions", type=int, default=20000)
+        parser.add_argument("--records", type=int, default=3,
+                            help="Records per transaction.")
+        parser.add_argument("--repeat", type=int, default=5)
+
+    def handle(self, *args, **options):
+        try:
+            with transaction.atomic():
+                self.run(options)
+                raise benchmarks.Rollback
+        except benchmarks.Rollback:
+            pass
+
+    def run(self, options):
+        result = load_journal(benchmarks.synthetic_entries(
+            options["transactions"], options["records"]))
+        self.stdout.write("Seeded %s" % result)
+        benchmarks.analyze()
+
+        account_id = Account.objects.get(code="1042").pk
+        queries = journal_queries(account_id)
+        if "lzy_journal_part" in connection.introspection.table_names():
+            queries += partitioned_queries()
+
+        self.report("with indexes", queries, options["repeat"])
+
+        # Plain DROP INDEX so it rolls back with the seeded data.
+        with connection.cursor() as cursor:
+            for model in (Transaction, TransactionRecord):
+                for index in model._meta.indexes:
+                    cursor.execute("DROP INDEX %s"
+                                   % connection.ops.quote_name(index.name))
+        benchmarks.analyze()
+        self.report("without indexes", queries, options["repeat"])
+
+    def report(self, title, queries, repeat):
+        self.stdout.write(self.style.MIGRATE_HEADING("== %s ==" % title))
+        for name, sql, params in queries:
+            def run():
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    cursor.fetchall()
+            timing = benchmarks.timed(run, repeat)
+            self.stdout.write(self.style.MIGRATE_LABEL(
+                "%s: median %.3f ms (min %.3f, max %.3f)" % (
+                    name, timing["median_ms"], timing["min_ms"],
+                    timing["max_ms"])))
+            self.stdout.write(benchmarks.explain(sql, params))
@@ -0,0 +1,193 @@
+import datetime
+import json
+import platform
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.urls import reverse
+
+from psql_journal import benchmarks
+from psql_journal.accounts import resolve_codes
+from psql_journal.bulkload import load_journal
+
+# accounts the MasterCreateView POST case books to
+POST_ACCOUNTS = ("1000", "1001", "1002")
+
+
+def formset_data(prefix, rows):
+    data = {
+        prefix + "-TOTAL_FORMS": str(len(rows)),
+        prefix + "-INITIAL_FORMS": "0",
+    }
+    for i, row in enumerate(rows):
+        for name, value in row.items():
+            data["%s-%d-%s" % (prefix, i, name)] = value
+    return data
+
+
+def request_cases():
+    """(name, method, url, data, expected status) of every timed request."""
+    month = "start=2021-03-01&end=2021-03-31"
+    year = "start=2021-01-01&end=2021-12-31"
+    return [
+        ("TwoInputCreateView GET", "get", reverse("psqlj:add"), None, 200),
+        ("TwoInputCreateView POST", "post", reverse("psqlj:add"),
+         {"str1": "bench", "str2": "bench"}, 302),
+        ("TwoInputMultipleCreateView GET", "get",
+         reverse("psqlj:multiple-add"), None, 200),
+        ("TwoInputMultipleCreateView POST", "post",
+         reverse("psqlj:multiple-add"),
+         formset_data("form", [{"str1": "b%d" % i, "str2": "b%d" % i}
+                               for i in range(10)]), 302),
+        # MainFormView only renders, it has no POST handler
+        ("MainFormView GET", "get", reverse("psqlj:tested1"), None, 200),
+        ("MasterCreateView GET", "get", reverse("psqlj:test2"), None, 200),
+        ("MasterCreateView POST", "post", reverse("psqlj:test2"), {
+            "tdate": "2021-03-15", "desc": "bench post",
+            **formset_data("transactionrecord_set", [
+                {"account": POST_ACCOUNTS[0], "amount": "100", "side": "D"},
+                {"account": POST_ACCOUNTS[1], "amount": "60", "side": "C"},
+                {"account": POST_ACCOUNTS[2], "amount": "40", "side": "C"},
+            ]),
+        }, 302),
+        ("journal list", "get", reverse("psqlj:journal"), None, 200),
+        ("two-input list", "get", reverse("psqlj:list"), None, 200),
+        ("trial balance", "get", reverse("psqlj:trial-balance"), None, 200),
+        ("trial balance month", "get",
+         reverse("psqlj:trial-balance") + "?" + month, None, 200),
+        ("account ledger year", "get",
+         reverse("psqlj:account-ledger") + "?account=1000&" + year, None, 200),
+        ("period close month", "get",
+         reverse("psqlj:period-close") + "?" + month, None, 200),
+        ("api transactions", "get", reverse("psqlj:api-transactions"),
+         None, 200),
+    ]
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed N transactions x M records for each --size and time GET/POST "
+        "of the form views, the list pages and the reports through the "
+        "full request stack. Seeded data is rolled back. Results can be "
+        "written as JSON and compared against a stored baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--size", type=int, action="append", dest="sizes",
+            help="Transactions to seed, repeatable (default 1000 and 10000).")
+        parser.add_argument("--records", type=int, default=3,
+                            help="Records per transaction.")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--output", help="Write the results to this JSON file.")
+        parser.add_argument("--baseline", help="Compare with this results file.")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2,
+            help="Flag a case whose median is this much slower than the "
+                 "baseline (default 0.2 = 20%%).")
+        parser.add_argument(
+            "--page-cache", action="store_true",
+            help="Leave the page cache on (off by default so every repeat "
+                 "hits the database).")
+
+    def handle(self, *args, **options):
+        sizes = options["sizes"] or [1000, 10000]
+        results = {
+            "meta": {
+                "date": datetime.datetime.now().isoformat(timespec="seconds"),
+                "vendor": connection.vendor,
+                "django": django.get_version(),
+                "python": platform.python_version(),
+                "records": options["records"],
+                "repeat": options["repeat"],
+            },
+            "results": {},
+        }
+        overrides = {
+            "ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"],
+            "PSQLJ_PAGE_CACHE_ENABLED": options["page_cache"],
+            "PSQLJ_PROFILE_SAMPLE_RATE": 0.0,
+        }
+        with override_settings(**overrides):
+            for size in sizes:
+                results["results"][str(size)] = self.run_size(size, options)
+
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write("Wrote %s" % options["output"])
+
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["threshold"])
+
+    def run_size(self, size, options):
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            "== %d transactions x %d records ==" % (size, options["records"])))
+        timings = {}
+        try:
+            with transaction.atomic():
+                result = load_journal(benchmarks.synthetic_entries(
+                    size, options["records"]))
+                self.stdout.write("Seeded %s" % result)
+                # a small seed need not use them all
+                resolve_codes(POST_ACCOUNTS)
+                benchmarks.analyze()
+                client = Client()
+                for name, method, url, data, status in request_cases():
+                    timings[name] = self.run_case(
+                        client, method, url, data, status, options["repeat"])
+                    self.write_timing(name, timings[name])
+                raise benchmarks.Rollback
+        except benchmarks.Rollback:
+            pass
+        return timings
+
+    def run_case(self, client, method, url, data, status, repeat):
+        def run():
+            response = getattr(client, method)(url, data)
+            if response.status_code != status:
+                raise CommandError("%s %s returned %d, expected %d" % (
+                    method.upper(), url, response.status_code, status))
+            if response.streaming:
+                b"".join(response.streaming_content)
+
+        run()   # warm up
+        # not CaptureQueriesContext: request_started resets queries_log
+        queries = []
+        def count(execute, sql, params, many, context):
+            queries.append(sql)
+            return execute(sql, params, many, context)
+        with connection.execute_wrapper(count):
+            run()
+        timing = benchmarks.timed(run, repeat)
+        timing["queries"] = len(queries)
+        return timing
+
+    def write_timing(self, name, timing):
+        self.stdout.write(
+            "%-32s median %9.3f ms (min %9.3f, max %9.3f) %4d queries" % (
+                name, timing["median_ms"], timing["min_ms"],
+                timing["max_ms"], timing["queries"]))
+
+    def compare(self, results, path, threshold):
+        with open(path) as f:
+            baseline = json.load(f)
+        self.stdout.write(self.style.MIGRATE_HEADING(
+            "== compared with %s ==" % path))
+        rows = benchmarks.compare(results, baseline, threshold)
+        regressions = 0
+        for size, case, base, median, ratio, regressed in rows:
+            line = "%6s %-32s %9.3f -> %9.3f ms  x%.2f" % (
+                size, case, base, median, ratio)
+            if regressed:
+                regressions += 1
+                self.stdout.write(self.style.ERROR(line + "  REGRESSION"))
+            else:
+                self.stdout.write(line)
+        if regressions:
+            raise CommandError("%d case(s) slower than the baseline by more "
+                               "than %d%%." % (regressions, threshold * 100))
+        self.stdout.write(self.style.SUCCESS("No regressions."))
@@ -0,0 +1,61 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import checkpoints
+from psql_journal.models import BalanceCheckpoint
+
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value)
+    except ValueError:
+        raise CommandError("Date must look like YYYY-MM-DD, got %r." % value)
+
+
+class Command(BaseCommand):
+    help = (
+        "Close periods: write a checkpoint of every account balance at "
+        "each period end, which balance and ledger queries start from."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("period_end", nargs="*", type=parse_date,
+                            help="Last day of a period, YYYY-MM-DD.")
+        parser.add_argument(
+            "--months", nargs=2, type=parse_date, metavar=("FIRST", "LAST"),
+            help="Close every month end from the month of FIRST to LAST "
+                 "that is not closed yet.")
+        parser.add_argument("--reopen", action="append", default=[],
+                            type=parse_date, metavar="YYYY-MM-DD",
+                            help="Delete the checkpoint of a period end.")
+        parser.add_argument("--list", action="store_true",
+                            help="List the checkpoints.")
+
+    def handle(self, *args, **options):
+        for period_end in options["reopen"]:
+            if not checkpoints.reopen(period_end):
+                raise CommandError("%s is not closed." % period_end)
+            self.stdout.write("Reopened %s." % period_end)
+
+        ends = list(options["period_end"])
+        if options["months"]:
+            closed = set(BalanceCheckpoint.objects.values_list(
+                "period_end", flat=True))
+            ends += [end for end in checkpoints.month_ends(*options["months"])
+                     if end not in closed]
+        for period_end in sorted(ends):
+            try:
+                checkpoint = checkpoints.close(period_end)
+            except ValueError as e:
+                raise CommandError(str(e))
+            self.stdout.write(self.style.SUCCESS(
+                "Closed %s (%d accounts)."
+                % (period_end, checkpoint.balances.count())))
+
+        if options["list"]:
+            for checkpoint in BalanceCheckpoint.objects.order_by(
+                    "period_end"):
+                self.stdout.write("%s  %d accounts  closed %s" % (
+                    checkpoint.period_end, checkpoint.balances.count(),
+                    checkpoint.created.strftime("%Y-%m-%d %H:%M")))
@@ -0,0 +1,31 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import jobs
+
+
+class Command(BaseCommand):
+    help = "Queue a background job for the run_jobs worker."
+
+    def add_arguments(self, parser):
+        parser.add_argument("kind", choices=sorted(jobs.TASKS))
+        parser.add_argument(
+            "--param", action="append", default=[], metavar="NAME=VALUE",
+            help="Task parameter, repeatable. VALUE is parsed as JSON "
+                 "when it can be, else taken as a string.")
+        parser.add_argument("--delay", type=float, default=0,
+                            help="Seconds before the job may run.")
+
+    def handle(self, *args, **options):
+        params = {}
+        for item in options["param"]:
+            name, sep, value = item.partition("=")
+            if not sep:
+                raise CommandError("Expected NAME=VALUE, got %r." % item)
+            try:
+                params[name] = json.loads(value)
+            except ValueError:
+                params[name] = value
+        job = jobs.enqueue(options["kind"], params, delay=options["delay"])
+        self.stdout.write("Queued %s." % job)
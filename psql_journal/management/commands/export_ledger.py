@@ -0,0 +1,49 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import export
+from psql_journal.forms import LedgerFilterForm
+
+
+class Command(BaseCommand):
+    help = "Export the general ledger to CSV or XLSX with flat memory use."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--start", help="First tdate, YYYY-MM-DD.")
+        parser.add_argument("--end", help="Last tdate, YYYY-MM-DD.")
+        parser.add_argument("--account")
+        parser.add_argument("--format", choices=["csv", "xlsx"],
+                            default="csv")
+        parser.add_argument("--output", "-o", default="-",
+                            help="Output file, - for stdout (CSV only).")
+        parser.add_argument("--chunk-size", type=int,
+                            default=export.DEFAULT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        form = LedgerFilterForm({
+            "start": options["start"],
+            "end": options["end"],
+            "account": options["account"],
+        })
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        rows = export.ledger_rows(chunk_size=options["chunk_size"],
+                                  **form.cleaned_data)
+
+        output = options["output"]
+        if options["format"] == "xlsx":
+            if output == "-":
+                raise CommandError("XLSX needs --output.")
+            try:
+                with open(output, "wb") as f:
+                    export.write_xlsx(rows, f)
+            except ImportError as e:
+                raise CommandError(str(e))
+            return
+
+        if output == "-":
+            export.write_csv(rows, sys.stdout)
+        else:
+            with open(output, "wt", encoding="utf-8", newline="") as f:
+                export.write_csv(rows, f)
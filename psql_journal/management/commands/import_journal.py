@@ -0,0 +1,49 @@
+import sys
+
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal.bulkload import DEFAULT_CHUNK_SIZE, READERS, load_journal
+
+
+class Command(BaseCommand):
+    help = "Bulk import journal entries from a CSV or JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="Input file, or - for stdin.")
+        parser.add_argument(
+            "--format", choices=sorted(READERS),
+            help="Input format. Default: guessed from the file extension.",
+        )
+        parser.add_argument(
+            "--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+            help="Transactions per COPY/commit (default %(default)s).",
+        )
+
+    def handle(self, *args, **options):
+        path = options["path"]
+        fmt = options["format"]
+        if fmt is None:
+            fmt = "csv" if path.lower().endswith(".csv") else "jsonl"
+
+        def progress(result):
+            if options["verbosity"] > 1:
+                self.stdout.write("chunk %d: %s" % (result.chunks, result))
+
+        if path == "-":
+            infile = sys.stdin
+        else:
+            infile = open(path, "rt", encoding="utf-8", newline="")
+        try:
+            result = load_journal(
+                READERS[fmt](infile),
+                chunk_size=options["chunk_size"],
+                progress=progress,
+            )
+        except ValidationError as e:
+            raise CommandError("; ".join(e.messages))
+        finally:
+            if infile is not sys.stdin:
+                infile.close()
+
+        self.stdout.write(self.style.SUCCESS("Imported %s" % result))
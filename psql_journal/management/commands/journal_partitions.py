@@ -0,0 +1,81 @@
+import datetime
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from asite.sa_tablemodule import (
+    lzy_custom_sql,
+    lzy_journal_part_def,
+    lzy_journal_part_drop,
+    lzy_journal_part_fill,
+    lzy_journal_part_month_def,
+)
+
+
+def parse_month(value):
+    try:
+        return datetime.datetime.strptime(value, "%Y-%m").date()
+    except ValueError:
+        raise CommandError("Month must look like YYYY-MM, got %r." % value)
+
+
+def month_partition(month):
+    """Return (table name, first day, first day of next month)."""
+    start = month.replace(day=1)
+    end = (start + datetime.timedelta(days=32)).replace(day=1)
+    return "lzy_journal_part_%04d%02d" % (start.year, start.month), start, end
+
+
+class Command(BaseCommand):
+    help = (
+        "Manage the optional tdate range-partitioned copy of the journal "
+        "(lzy_journal_part). PostgreSQL only."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--create", action="store_true",
+            help="Create the partitioned table and its sync triggers, "
+                 "then copy the existing journal into it.",
+        )
+        parser.add_argument(
+            "--add-month", action="append", default=[], metavar="YYYY-MM",
+            help="Create and attach the partition of a month.",
+        )
+        parser.add_argument(
+            "--detach-month", action="append", default=[], metavar="YYYY-MM",
+            help="Detach the partition of a month. The table is kept and "
+                 "can be archived or dropped separately.",
+        )
+        parser.add_argument(
+            "--drop", action="store_true",
+            help="Remove the partitioned table and its triggers.",
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Partitioning needs PostgreSQL, not %s."
+                               % connection.vendor)
+
+        with transaction.atomic():
+            if options["drop"]:
+                lzy_custom_sql(lzy_journal_part_drop)
+                self.stdout.write("Dropped lzy_journal_part.")
+                return
+
+            if options["create"]:
+                lzy_custom_sql(lzy_journal_part_def)
+                lzy_custom_sql(lzy_journal_part_fill)
+                self.stdout.write("Created lzy_journal_part.")
+
+            for value in options["add_month"]:
+                name, start, end = month_partition(parse_month(value))
+                lzy_custom_sql(lzy_journal_part_month_def.format(
+                    name=name, start=start, end=end))
+                self.stdout.write("Attached %s [%s, %s)." % (name, start, end))
+
+            for value in options["detach_month"]:
+                name, start, end = month_partition(parse_month(value))
+                lzy_custom_sql(
+                    "ALTER TABLE lzy_journal_part DETACH PARTITION %s;" % name)
+                self.stdout.write("Detached %s." % name)
@@ -0,0 +1,54 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import export, reports
+from psql_journal.forms import LedgerFilterForm
+
+
+REPORTS = {
+    "trial-balance": (
+        reports.trial_balance,
+        ["account", "debit", "credit", "balance"],
+    ),
+    "ledger": (
+        reports.account_ledger,
+        ["account", "tdate", "transaction_id", "record_num", "desc",
+         "side", "amount", "balance"],
+    ),
+    "period-close": (
+        reports.period_close,
+        ["account", "opening", "debit", "credit", "closing"],
+    ),
+    "monthly": (
+        reports.monthly_totals,
+        ["account", "month", "debit", "credit", "records"],
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = "Write a journal report as CSV to stdout."
+
+    def add_arguments(self, parser):
+        parser.add_argument("report", choices=sorted(REPORTS))
+        parser.add_argument("--start", help="First tdate, YYYY-MM-DD.")
+        parser.add_argument("--end", help="Last tdate, YYYY-MM-DD.")
+        parser.add_argument("--account")
+
+    def handle(self, *args, **options):
+        form = LedgerFilterForm({
+            "start": options["start"],
+            "end": options["end"],
+            "account": options["account"],
+        })
+        if not form.is_valid():
+            raise CommandError(form.errors.as_text())
+        filters = form.cleaned_data
+        function, columns = REPORTS[options["report"]]
+        if options["report"] == "period-close" and not (
+                filters["start"] and filters["end"]):
+            raise CommandError("period-close needs --start and --end.")
+
+        rows = ([row[c] for c in columns] for row in function(**filters))
+        export.write_csv(rows, sys.stdout, header=columns)
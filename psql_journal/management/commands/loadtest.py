@@ -0,0 +1,89 @@
+import statistics
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+
+DEFAULT_PATHS = [
+    "/api/transactions/",
+    "/api/balances/",
+]
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    k = max(0, min(len(samples) - 1, round(pct / 100 * len(samples)) - 1))
+    return samples[k]
+
+
+def fetch(url, timeout):
+    t0 = time.perf_counter()
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as resp:
+            resp.read()
+            ok = 200 <= resp.status < 300
+    except (urllib.error.URLError, OSError):
+        ok = False
+    return (time.perf_counter() - t0) * 1000, ok
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare latency of running deployments under concurrency, e.g.\n"
+        "  gunicorn asite.wsgi -w 4 -b :8000\n"
+        "  uvicorn asite.asgi:application --workers 4 --port 8001\n"
+        "  manage.py loadtest --target wsgi=http://127.0.0.1:8000 "
+        "--target asgi=http://127.0.0.1:8001"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--target", action="append", default=[], metavar="NAME=URL",
+            help="Deployment to test, repeatable.",
+        )
+        parser.add_argument(
+            "--path", action="append", dest="paths", metavar="PATH",
+            help="Path to request, repeatable (default: the async read API).",
+        )
+        parser.add_argument("--concurrency", type=int, default=32)
+        parser.add_argument("--requests", type=int, default=2000)
+        parser.add_argument("--timeout", type=float, default=30)
+
+    def handle(self, *args, **options):
+        if not options["target"]:
+            raise CommandError("Give at least one --target NAME=URL.")
+        paths = options["paths"] or DEFAULT_PATHS
+        for target in options["target"]:
+            name, sep, base = target.partition("=")
+            if not sep:
+                raise CommandError("--target must look like NAME=URL.")
+            for path in paths:
+                self.run(name, base.rstrip("/") + path, options)
+
+    def run(self, name, url, options):
+        n = options["requests"]
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(options["concurrency"]) as pool:
+            results = list(pool.map(
+                lambda _: fetch(url, options["timeout"]), range(n)))
+        wall = time.perf_counter() - t0
+
+        latencies = [ms for ms, ok in results if ok]
+        errors = n - len(latencies)
+        if not latencies:
+            self.stdout.write("%-6s %s: all %d requests failed" % (name, url, n))
+            return
+        self.stdout.write(
+            "%-6s %s: p50 %.1f ms  p99 %.1f ms  mean %.1f ms  %.0f req/s  "
+            "errors %d" % (
+                name, url,
+                percentile(latencies, 50),
+                percentile(latencies, 99),
+                statistics.mean(latencies),
+                n / wall,
+                errors,
+            )
+        )
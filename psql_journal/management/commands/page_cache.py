@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import pagecache
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the hit/miss counters of the journal page cache, reset them "
+        "or invalidate a namespace."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--reset", action="store_true",
+                            help="Zero the counters after printing them.")
+        parser.add_argument(
+            "--invalidate", metavar="NAMESPACE", action="append", default=[],
+            help="Give NAMESPACE a new version (%s)."
+                 % ", ".join(pagecache.NAMESPACES))
+
+    def handle(self, *args, **options):
+        if not pagecache.shared():
+            self.stderr.write(
+                "Page caching is off: the %s backend is local to each "
+                "process." % type(pagecache.get_cache()).__name__)
+        for namespace in options["invalidate"]:
+            if namespace not in pagecache.NAMESPACES:
+                raise CommandError("Unknown namespace %r." % namespace)
+            pagecache.invalidate(namespace)
+            self.stdout.write("Invalidated %s." % namespace)
+
+        for namespace, counts in pagecache.stats().items():
+            ratio = counts["hit_ratio"]
+            self.stdout.write("%s: %d hits, %d misses, hit ratio %s" % (
+                namespace, counts["hits"], counts["misses"],
+                "-" if ratio is None else "%.1f%%" % (ratio * 100)))
+
+        if options["reset"]:
+            pagecache.reset_stats()
+            self.stdout.write("Counters reset.")
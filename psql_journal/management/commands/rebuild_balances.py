@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import balances
+
+
+class Command(BaseCommand):
+    help = (
+        "Check AccountBalance/AccountDayBalance against the raw journal "
+        "and optionally rebuild them from scratch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--verify", action="store_true",
+            help="Only report drift, do not rebuild. "
+                 "Exit with an error if any drift is found.",
+        )
+
+    def handle(self, *args, **options):
+        drift = balances.find_drift()
+        for kind, key, stored, expected in drift:
+            self.stdout.write(
+                "%s %s: stored debit/credit %s, expected %s"
+                % (kind, key, stored, expected)
+            )
+
+        if options["verify"]:
+            if drift:
+                raise CommandError("%d balance rows drifted." % len(drift))
+            self.stdout.write(self.style.SUCCESS("Balances are consistent."))
+            return
+
+        balances.rebuild()
+        self.stdout.write(self.style.SUCCESS(
+            "Rebuilt balances (%d rows had drifted)." % len(drift)))
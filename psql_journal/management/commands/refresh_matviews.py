@@ -0,0 +1,62 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from psql_journal import matviews
+
+
+class Command(BaseCommand):
+    help = (
+        "Create, refresh (CONCURRENTLY) or drop the monthly per-account "
+        "materialized view the reports read from. PostgreSQL only."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--create", action="store_true",
+                            help="Create and fill the view.")
+        parser.add_argument("--drop", action="store_true")
+        parser.add_argument(
+            "--if-older", type=float, metavar="SECONDS",
+            help="Only refresh if the last refresh is older than this.")
+        parser.add_argument(
+            "--every", type=float, metavar="SECONDS",
+            help="Keep running and refresh on this interval.")
+        parser.add_argument(
+            "--blocking", action="store_true",
+            help="Plain REFRESH, which locks out readers but is faster.")
+
+    def handle(self, *args, **options):
+        if connection.vendor != "postgresql":
+            raise CommandError("Materialized views need PostgreSQL, not %s."
+                               % connection.vendor)
+        if options["drop"]:
+            matviews.drop()
+            self.stdout.write("Dropped %s." % matviews.VIEW)
+            return
+        if options["create"]:
+            matviews.create()
+            self.stdout.write("Created %s." % matviews.VIEW)
+            return
+        if not matviews.exists():
+            raise CommandError("%s does not exist, run with --create first."
+                               % matviews.VIEW)
+
+        while True:
+            self.refresh(options)
+            if not options["every"]:
+                return
+            # each refresh is its own transaction, don't hold a connection
+            connection.close()
+            time.sleep(options["every"])
+
+    def refresh(self, options):
+        if options["if_older"] is not None:
+            elapsed = matviews.refresh_if_stale(options["if_older"])
+            if elapsed is None:
+                self.stdout.write("%s is fresh (%.0f s old)."
+                                  % (matviews.VIEW, matviews.age()))
+                return
+        else:
+            elapsed = matviews.refresh(concurrently=not options["blocking"])
+        self.stdout.write("Refreshed %s in %.1f ms." % (matviews.VIEW, elapsed))
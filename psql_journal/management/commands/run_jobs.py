@@ -0,0 +1,79 @@
+import os
+import signal
+import socket
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from psql_journal import jobs
+
+
+class Command(BaseCommand):
+    help = (
+        "Run queued background jobs (psql_journal/jobs.py). Start as many "
+        "workers as needed; per-kind concurrency limits hold across them."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--concurrency", type=int, default=2,
+            help="Jobs this worker runs at once, one thread each.")
+        parser.add_argument(
+            "--kind", action="append", dest="kinds", metavar="KIND",
+            help="Only run jobs of this kind, repeatable (%s)."
+                 % ", ".join(sorted(jobs.TASKS)))
+        parser.add_argument("--poll", type=float, default=1.0,
+                            help="Seconds to wait when the queue is empty.")
+        parser.add_argument("--burst", action="store_true",
+                            help="Exit when the queue is empty.")
+
+    def handle(self, *args, **options):
+        unknown = set(options["kinds"] or []) - set(jobs.TASKS)
+        if unknown:
+            raise CommandError("Unknown job kind(s): %s."
+                               % ", ".join(sorted(unknown)))
+        if connection.vendor == "sqlite" and options["concurrency"] > 1:
+            # one writer at a time; concurrent claims and progress
+            # updates would fail with "database is locked"
+            self.stderr.write("SQLite: running one job at a time.")
+            options["concurrency"] = 1
+        self.options = options
+        self.stop = threading.Event()
+        name = "%s:%d" % (socket.gethostname(), os.getpid())
+
+        def shutdown(signum, frame):
+            self.stdout.write("Stopping after the running jobs...")
+            self.stop.set()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+
+        threads = [
+            threading.Thread(target=self.work, args=("%s:%d" % (name, i),))
+            for i in range(options["concurrency"])
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+
+    def work(self, worker):
+        try:
+            while not self.stop.is_set():
+                jobs.requeue_stale()
+                job = jobs.claim(worker, self.options["kinds"])
+                if job is None:
+                    if self.options["burst"]:
+                        return
+                    self.stop.wait(self.options["poll"])
+                    continue
+                self.stdout.write("%s: running %s" % (worker, job))
+                ok = jobs.run(job)
+                job.refresh_from_db()
+                write = self.style.SUCCESS if ok else self.style.ERROR
+                self.stdout.write(write("%s: %s %s" % (
+                    worker, job, job.message)))
+        finally:
+            connection.close()
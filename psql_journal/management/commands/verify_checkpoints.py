@@ -0,0 +1,49 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from psql_journal import checkpoints
+from psql_journal.management.commands.close_period import parse_date
+from psql_journal.models import BalanceCheckpoint
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-derive period-close checkpoints from the raw journal records "
+        "and report (or repair) the accounts that differ."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "period_end", nargs="*", type=parse_date,
+            help="Checkpoints to verify, YYYY-MM-DD. Default: all.")
+        parser.add_argument("--repair", action="store_true",
+                            help="Rewrite the checkpoints that differ.")
+
+    def handle(self, *args, **options):
+        qs = BalanceCheckpoint.objects.order_by("period_end")
+        if options["period_end"]:
+            qs = qs.filter(period_end__in=options["period_end"])
+            missing = set(options["period_end"]) - set(
+                qs.values_list("period_end", flat=True))
+            if missing:
+                raise CommandError("Not closed: %s." % ", ".join(
+                    str(d) for d in sorted(missing)))
+
+        failed = 0
+        for checkpoint in qs:
+            drift = checkpoints.verify(checkpoint)
+            for account, stored, expected in drift:
+                self.stdout.write(
+                    "%s account %s: stored debit/credit %s, expected %s"
+                    % (checkpoint, account, stored, expected))
+            if not drift:
+                continue
+            if options["repair"]:
+                checkpoints.repair(checkpoint)
+                self.stdout.write("Repaired %s." % checkpoint)
+            else:
+                failed += 1
+
+        if failed:
+            raise CommandError("%d checkpoints differ from the journal."
+                               % failed)
+        self.stdout.write(self.style.SUCCESS("Checkpoints are consistent."))
@@ -0,0 +1,226 @@
+"""
+Monthly per-account totals from the lzy_account_month materialized view
+(SQL in asite/sa_tablemodule.py). PostgreSQL only, and optional: create
+it with `manage.py refresh_matviews --create`.
+
+The view is refreshed with REFRESH MATERIALIZED VIEW CONCURRENTLY by the
+refresh_matviews command (run it from cron, or with --every as a small
+scheduler) or by calling refresh_if_stale() from any periodic job.
+
+Reports use it only when it is fresh enough, i.e. refreshed less than
+PSQLJ_MATVIEW_MAX_AGE seconds ago (default 300, 0 = never), and only for
+date ranges made of whole months; otherwise they fall back to the exact
+AccountDayBalance queries in reports.py. The view is built from the live
+records, so it is not used for months removed to the archive.
+
+Reads go through replicas.read_connection(), so report views read the
+view on the replica like the rest of their queries.
+"""
+import datetime
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from asite.sa_tablemodule import (
+    lzy_account_month_def,
+    lzy_account_month_drop,
+    lzy_custom_sql,
+)
+
+from . import archive, export
+from .models import Transaction
+from .replicas import read_connection
+
+
+VIEW = "lzy_account_month"
+DEFAULT_MAX_AGE = 300
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def max_age():
+    return getattr(settings, "PSQLJ_MATVIEW_MAX_AGE", DEFAULT_MAX_AGE)
+
+
+def exists(connection=None):
+    connection = connection or read_connection(Transaction)
+    if connection.vendor != "postgresql":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT to_regclass(%s) IS NOT NULL", [VIEW])
+        return cursor.fetchone()[0]
+
+
+def create():
+    with transaction.atomic():
+        lzy_custom_sql(lzy_account_month_def)
+
+
+def drop():
+    with transaction.atomic():
+        lzy_custom_sql(lzy_account_month_drop)
+
+
+def refresh(concurrently=True):
+    """Refresh the view and record when. Return the time taken in ms."""
+    start = time.perf_counter()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute("REFRESH MATERIALIZED VIEW %s%s" % (
+                "CONCURRENTLY " if concurrently else "", VIEW))
+            elapsed = (time.perf_counter() - start) * 1000
+            cursor.execute(
+                "UPDATE lzy_matview_refresh "
+                "SET refreshed_at = now(), duration_ms = %s WHERE name = %s",
+                [elapsed, VIEW])
+    return elapsed
+
+
+def last_refresh():
+    """When the view was last refreshed, None if it does not exist."""
+    connection = read_connection(Transaction)
+    if not exists(connection):
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT refreshed_at FROM lzy_matview_refresh WHERE name = %s",
+            [VIEW])
+        row = cursor.fetchone()
+    return row[0] if row else None
+
+
+def age():
+    """Seconds since the last refresh, None if never."""
+    refreshed = last_refresh()
+    if refreshed is None:
+        return None
+    return (timezone.now() - refreshed).total_seconds()
+
+
+def is_fresh():
+    limit = max_age()
+    if not limit:
+        return False
+    current = age()
+    return current is not None and current <= limit
+
+
+def refresh_if_stale(older_than=None):
+    """
+    Scheduler hook: refresh when the last refresh is older than
+    older_than seconds (default: half of PSQLJ_MATVIEW_MAX_AGE), so
+    readers keep finding the view fresh. Return the ms taken, or None.
+    """
+    if not exists(connection):
+        return None
+    if older_than is None:
+        older_than = max_age() / 2
+    current = age()
+    if current is not None and current < older_than:
+        return None
+    return refresh()
+
+
+##############
+# Reports
+
+def _whole_months(start, end):
+    if start and start.day != 1:
+        return False
+    if end and (end + datetime.timedelta(days=1)).day != 1:
+        return False
+    return True
+
+
+def usable(start=None, end=None, opening=False):
+    """
+    True if the reports may answer [start, end] from the view; opening:
+    and the balances before start.
+    """
+    return (_whole_months(start, end) and is_fresh()
+            and not archive.has_removed(None if opening else start, end))
+
+
+def _query(sql, params, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the rows as dicts, read chunk_size at a time."""
+    with read_connection(Transaction).chunked_cursor() as cursor:
+        cursor.execute(sql, params)
+        columns = [c[0] for c in cursor.description]
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                yield dict(zip(columns, row))
+
+
+def _code_order(column):
+    """SQL ordering column by code point, as export.code_point_order()."""
+    return '%s COLLATE "%s"' % (
+        column, export.CODE_POINT_COLLATIONS["postgresql"])
+
+
+def _filters(account, conditions, params):
+    if account:
+        conditions.append("a.code = %s")
+        params.append(account)
+    return " AND ".join(conditions) or "TRUE"
+
+
+def trial_balance(start=None, end=None, account=None):
+    """Same rows as reports.trial_balance(), from the view."""
+    conditions, params = [], []
+    if start:
+        conditions.append("m.month >= %s")
+        params.append(start)
+    if end:
+        conditions.append("m.month <= %s")
+        params.append(end)
+    where = _filters(account, conditions, params)
+    return _query(
+        "SELECT a.code AS account, SUM(m.debit)::bigint AS debit, "
+        "SUM(m.credit)::bigint AS credit, "
+        "(SUM(m.debit) - SUM(m.credit))::bigint AS balance "
+        "FROM %s m JOIN psql_journal_account a ON a.id = m.account_id "
+        "WHERE %s GROUP BY a.code ORDER BY %s"
+        % (VIEW, where, _code_order("a.code")),
+        params)
+
+
+def period_close(start, end, account=None):
+    """Same rows as reports.period_close(), from the view."""
+    where_params = [end]
+    where = _filters(account, ["m.month <= %s"], where_params)
+    return _query(
+        "SELECT account, opening, debit, credit, "
+        "opening + debit - credit AS closing FROM ("
+        " SELECT a.code AS account,"
+        " COALESCE(SUM(m.debit - m.credit) FILTER (WHERE m.month < %%s),"
+        "  0)::bigint AS opening,"
+        " COALESCE(SUM(m.debit) FILTER (WHERE m.month >= %%s), 0)::bigint"
+        "  AS debit,"
+        " COALESCE(SUM(m.credit) FILTER (WHERE m.month >= %%s), 0)::bigint"
+        "  AS credit"
+        " FROM %s m JOIN psql_journal_account a ON a.id = m.account_id"
+        " WHERE %s GROUP BY a.code) s ORDER BY %s"
+        % (VIEW, where, _code_order("account")),
+        [start, start, start] + where_params)
+
+
+def monthly_totals(start=None, end=None, account=None):
+    """{"account", "month", "debit", "credit", "records"} per account and month."""
+    conditions, params = [], []
+    if start:
+        conditions.append("m.month >= date_trunc('month', %s::date)")
+        params.append(start)
+    if end:
+        conditions.append("m.month <= %s")
+        params.append(end)
+    where = _filters(account, conditions, params)
+    return _query(
+        "SELECT a.code AS account, m.month, m.debit, m.credit, m.records "
+        "FROM %s m JOIN psql_journal_account a ON a.id = m.account_id "
+        "WHERE %s ORDER BY %s, m.month"
+        % (VIEW, where, _code_order("a.code")),
+        params)
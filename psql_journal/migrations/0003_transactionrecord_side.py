@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0002_transaction_transactionrecord'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='transactionrecord',
+            name='side',
+            field=models.CharField(choices=[('D', 'Debit'), ('C', 'Credit')], default='D', max_length=1),
+        ),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:57
+
+from django.db import migrations, models
+from django.db.models import Q, Sum
+
+
+def seed_balances(apps, schema_editor):
+    TransactionRecord = apps.get_model('psql_journal', 'TransactionRecord')
+    AccountBalance = apps.get_model('psql_journal', 'AccountBalance')
+    AccountDayBalance = apps.get_model('psql_journal', 'AccountDayBalance')
+
+    rows = TransactionRecord.objects.values('account', 'transaction__tdate').annotate(
+        debit=Sum('amount', filter=Q(side='D'), default=0),
+        credit=Sum('amount', filter=Q(side='C'), default=0),
+    ).order_by()
+    totals = {}
+    days = []
+    for row in rows:
+        days.append(AccountDayBalance(
+            account=row['account'], tdate=row['transaction__tdate'],
+            debit=row['debit'], credit=row['credit'],
+        ))
+        debit, credit = totals.get(row['account'], (0, 0))
+        totals[row['account']] = (debit + row['debit'], credit + row['credit'])
+    AccountDayBalance.objects.bulk_create(days, batch_size=1000)
+    AccountBalance.objects.bulk_create(
+        [AccountBalance(account=a, debit=d, credit=c) for a, (d, c) in totals.items()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0003_transactionrecord_side'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AccountBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=200, unique=True)),
+                ('debit', models.BigIntegerField(default=0)),
+                ('credit', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='AccountDayBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('account', models.CharField(max_length=200)),
+                ('tdate', models.DateField()),
+                ('debit', models.BigIntegerField(default=0)),
+                ('credit', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='accountdaybalance',
+            constraint=models.UniqueConstraint(fields=('account', 'tdate'), name='psqlj_accountday_uniq'),
+        ),
+        migrations.RunPython(seed_balances, migrations.RunPython.noop),
+    ]
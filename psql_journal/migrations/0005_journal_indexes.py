@@ -0,0 +1,21 @@
+# Generated by Django 4.2.30 on 2026-10-18 00:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0004_accountbalance'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='transaction',
+            index=models.Index(fields=['tdate', 'id'], name='psqlj_txn_tdate_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['account', 'transaction'], name='psqlj_rec_account_txn_idx'),
+        ),
+    ]
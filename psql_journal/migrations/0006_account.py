@@ -0,0 +1,111 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def create_accounts(apps, schema_editor):
+    """
+    One Account per distinct account string of the journal and the
+    balance tables, then point every row at it with one UPDATE per
+    account.
+    """
+    Account = apps.get_model('psql_journal', 'Account')
+    TransactionRecord = apps.get_model('psql_journal', 'TransactionRecord')
+    AccountBalance = apps.get_model('psql_journal', 'AccountBalance')
+    AccountDayBalance = apps.get_model('psql_journal', 'AccountDayBalance')
+
+    models_with_codes = [TransactionRecord, AccountBalance, AccountDayBalance]
+    codes = set()
+    for model in models_with_codes:
+        codes.update(
+            model.objects.values_list('account_code', flat=True).distinct())
+
+    for code in sorted(codes):
+        acc = Account.objects.create(code=code)
+        acc.path = '/%d/' % acc.pk
+        acc.save(update_fields=['path'])
+        for model in models_with_codes:
+            model.objects.filter(account_code=code).update(account=acc)
+
+
+def restore_codes(apps, schema_editor):
+    Account = apps.get_model('psql_journal', 'Account')
+    TransactionRecord = apps.get_model('psql_journal', 'TransactionRecord')
+    AccountBalance = apps.get_model('psql_journal', 'AccountBalance')
+    AccountDayBalance = apps.get_model('psql_journal', 'AccountDayBalance')
+
+    for acc in Account.objects.all():
+        for model in (TransactionRecord, AccountBalance, AccountDayBalance):
+            model.objects.filter(account=acc).update(account_code=acc.code)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0005_journal_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Account',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('code', models.CharField(max_length=200, unique=True)),
+                ('name', models.CharField(blank=True, max_length=200)),
+                ('path', models.CharField(default='', editable=False, max_length=255)),
+                ('parent', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.RESTRICT, related_name='children', to='psql_journal.account')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='account',
+            index=models.Index(fields=['path'], name='psqlj_account_path_idx', opclasses=['varchar_pattern_ops']),
+        ),
+
+        # keep the old strings as account_code while the FKs are filled
+        migrations.RemoveIndex(
+            model_name='transactionrecord',
+            name='psqlj_rec_account_txn_idx',
+        ),
+        migrations.RemoveConstraint(
+            model_name='accountdaybalance',
+            name='psqlj_accountday_uniq',
+        ),
+        migrations.RenameField(
+            model_name='transactionrecord',
+            old_name='account',
+            new_name='account_code',
+        ),
+        migrations.RenameField(
+            model_name='accountbalance',
+            old_name='account',
+            new_name='account_code',
+        ),
+        migrations.RenameField(
+            model_name='accountdaybalance',
+            old_name='account',
+            new_name='account_code',
+        ),
+        migrations.AlterField(
+            model_name='accountbalance',
+            name='account_code',
+            field=models.CharField(max_length=200),
+        ),
+        migrations.AddField(
+            model_name='transactionrecord',
+            name='account',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.RESTRICT, to='psql_journal.account'),
+        ),
+        migrations.AddField(
+            model_name='accountbalance',
+            name='account',
+            field=models.OneToOneField(null=True, on_delete=django.db.models.deletion.CASCADE, related_name='total', to='psql_journal.account'),
+        ),
+        migrations.AddField(
+            model_name='accountdaybalance',
+            name='account',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='psql_journal.account'),
+        ),
+
+        migrations.RunPython(create_accounts, restore_codes),
+    ]
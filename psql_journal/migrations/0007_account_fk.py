@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:07
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0006_account'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='transactionrecord',
+            name='account_code',
+        ),
+        migrations.RemoveField(
+            model_name='accountbalance',
+            name='account_code',
+        ),
+        migrations.RemoveField(
+            model_name='accountdaybalance',
+            name='account_code',
+        ),
+        migrations.AlterField(
+            model_name='transactionrecord',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, to='psql_journal.account'),
+        ),
+        migrations.AlterField(
+            model_name='accountbalance',
+            name='account',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='total', to='psql_journal.account'),
+        ),
+        migrations.AlterField(
+            model_name='accountdaybalance',
+            name='account',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='psql_journal.account'),
+        ),
+        migrations.AddIndex(
+            model_name='transactionrecord',
+            index=models.Index(fields=['account', 'transaction'], name='psqlj_rec_account_txn_idx'),
+        ),
+        migrations.AddConstraint(
+            model_name='accountdaybalance',
+            constraint=models.UniqueConstraint(fields=('account', 'tdate'), name='psqlj_accountday_uniq'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Double-entry check at commit, see lzy_balance_check_def.
+
+from django.db import migrations
+
+from asite.sa_tablemodule import lzy_balance_check_def, lzy_balance_check_drop
+
+
+def _run(schema_editor, sql):
+    # not schema_editor.execute(): it would %-format the plpgsql
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(sql)
+
+
+def create_balance_check(apps, schema_editor):
+    _run(schema_editor, lzy_balance_check_def)
+
+
+def drop_balance_check(apps, schema_editor):
+    _run(schema_editor, lzy_balance_check_drop)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0010_job'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_balance_check, drop_balance_check),
+    ]
@@ -0,0 +1,36 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:28
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0011_balance_check'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceCheckpoint',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('period_end', models.DateField(unique=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CheckpointBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('debit', models.BigIntegerField(default=0)),
+                ('credit', models.BigIntegerField(default=0)),
+                ('account', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='checkpoint_balances', to='psql_journal.account')),
+                ('checkpoint', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='balances', to='psql_journal.balancecheckpoint')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='checkpointbalance',
+            constraint=models.UniqueConstraint(fields=('checkpoint', 'account'), name='psqlj_checkpoint_account_uniq'),
+        ),
+    ]
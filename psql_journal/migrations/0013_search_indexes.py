@@ -0,0 +1,38 @@
+# Search indexes, see lzy_search_fts_def and lzy_search_trgm_def.
+
+from django.db import migrations
+
+from asite.sa_tablemodule import (
+    lzy_search_drop,
+    lzy_search_fts_def,
+    lzy_search_trgm_def,
+)
+
+
+def create_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute(lzy_search_fts_def)
+        cursor.execute(
+            "SELECT EXISTS (SELECT 1 FROM pg_available_extensions "
+            "WHERE name = 'pg_trgm')")
+        if cursor.fetchone()[0]:
+            cursor.execute(lzy_search_trgm_def)
+
+
+def drop_search_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(lzy_search_drop)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0012_balancecheckpoint'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_indexes, drop_search_indexes),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 4.2.30 on 2026-10-18 01:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0013_search_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchiveFile',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('month', models.DateField()),
+                ('path', models.CharField(max_length=255, unique=True)),
+                ('transactions', models.PositiveBigIntegerField(default=0)),
+                ('records', models.PositiveBigIntegerField(default=0)),
+                ('removed', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['month'], name='psqlj_archive_month_idx')],
+            },
+        ),
+    ]
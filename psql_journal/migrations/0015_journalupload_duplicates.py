@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0014_archivefile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='journalupload',
+            name='duplicates',
+            field=models.PositiveBigIntegerField(default=0),
+        ),
+    ]
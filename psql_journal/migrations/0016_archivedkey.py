@@ -0,0 +1,49 @@
+# Generated by Django 4.2.30 on 2026-10-18 02:36
+
+from pathlib import Path
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def seed_keys(apps, schema_editor):
+    ArchiveFile = apps.get_model('psql_journal', 'ArchiveFile')
+    ArchivedKey = apps.get_model('psql_journal', 'ArchivedKey')
+
+    files = list(ArchiveFile.objects.filter(removed__isnull=False))
+    if not files:
+        return
+    import pyarrow.parquet as pq
+
+    root = Path(getattr(settings, 'PSQLJ_ARCHIVE_DIR', 'archive'))
+    for f in files:
+        table = pq.read_table(root / f.path,
+                              columns=['transaction_id', 'idempotency_key'])
+        keys = dict(zip(table.column('idempotency_key').to_pylist(),
+                        table.column('transaction_id').to_pylist()))
+        keys.pop(None, None)
+        ArchivedKey.objects.bulk_create(
+            [ArchivedKey(key=k, transaction_id=t, file=f) for k, t in keys.items()],
+            batch_size=1000,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('psql_journal', '0015_journalupload_duplicates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=100, unique=True)),
+                ('transaction_id', models.BigIntegerField()),
+                ('file', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='keys', to='psql_journal.archivefile')),
+            ],
+        ),
+        migrations.RunPython(seed_keys, migrations.RunPython.noop),
+    ]
@@ -1,19 +1,293 @@
-from django.db import models
+from django.core.exceptions import ValidationError
+from django.db import models, transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat, Substr
+from django.utils import timezone
 
 class TwoInputFields(models.Model):
     str1 = models.CharField(max_length=50)
     str2 = models.CharField(max_length=50)
 
 
+class Account(models.Model):
+    """
+    Chart of accounts. Journal records point here by id instead of
+    repeating the account code.
+
+    path is the materialized path of ids from the root, e.g. "/1/7/42/",
+    so a whole subtree is one indexed prefix query:
+        Account.objects.filter(path__startswith=acc.path)
+    """
+    code = models.CharField(max_length=200, unique=True)
+    name = models.CharField(max_length=200, blank=True)
+    parent = models.ForeignKey(
+        "self", null=True, blank=True,
+        on_delete=models.RESTRICT, related_name="children",
+    )
+    path = models.CharField(max_length=255, editable=False, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["path"], name="psqlj_account_path_idx",
+                         opclasses=["varchar_pattern_ops"]),
+        ]
+
+    def __str__(self):
+        return self.code
+
+    def build_path(self):
+        prefix = self.parent.path if self.parent_id else "/"
+        return "%s%d/" % (prefix, self.pk)
+
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            old_path = self.path
+            if old_path and self.parent_id:
+                # the stored path, self.parent may have moved since loaded
+                parent_path = Account.objects.values_list(
+                    "path", flat=True).get(pk=self.parent_id)
+                if parent_path.startswith(old_path):
+                    raise ValidationError(
+                        "An account cannot be moved under itself or one of "
+                        "its descendants.", code="cycle")
+            super().save(*args, **kwargs)
+            new_path = self.build_path()
+            if new_path == old_path:
+                return
+            Account.objects.filter(pk=self.pk).update(path=new_path)
+            self.path = new_path
+            if old_path:
+                # moved: rewrite the paths of the whole subtree at once
+                Account.objects.filter(path__startswith=old_path).update(
+                    path=Concat(Value(new_path),
+                                Substr("path", len(old_path) + 1)))
+
+    @classmethod
+    def fill_missing_paths(cls):
+        """Set the path of root accounts created with bulk_create()."""
+        cls.objects.filter(path="", parent__isnull=True).update(
+            path=Concat(Value("/"), Cast("id", CharField()), Value("/")))
+
+
 class Transaction(models.Model):
     """
     A transaction balance must be zero
+    (checked at commit on PostgreSQL, see psql_journal/audit.py)
     """
     tdate = models.DateField()
     desc = models.CharField(max_length=200)
+    # set by machine posts (api.post_transactions) so a retried
+    #   request does not post the same transaction twice
+    idempotency_key = models.CharField(
+        max_length=100, null=True, blank=True, unique=True, editable=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["tdate", "id"], name="psqlj_txn_tdate_idx"),
+        ]
 
 class TransactionRecord(models.Model):
+    DEBIT = "D"
+    CREDIT = "C"
+    SIDE_CHOICES = [
+        (DEBIT, "Debit"),
+        (CREDIT, "Credit"),
+    ]
+
     transaction = models.ForeignKey(Transaction, on_delete=models.RESTRICT)
     record_num = models.SmallIntegerField()
-    account = models.CharField(max_length=200)
+    account = models.ForeignKey(Account, on_delete=models.RESTRICT)
     amount = models.PositiveBigIntegerField()
+    side = models.CharField(max_length=1, choices=SIDE_CHOICES, default=DEBIT)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["account", "transaction"],
+                         name="psqlj_rec_account_txn_idx"),
+        ]
+
+    @property
+    def signed_amount(self):
+        """Debit is positive, credit is negative."""
+        return self.amount if self.side == self.DEBIT else -self.amount
+
+
+class AccountBalance(models.Model):
+    """
+    Running debit/credit totals per account.
+    Kept up to date by psql_journal.balances, never edit by hand.
+    """
+    account = models.OneToOneField(
+        Account, on_delete=models.CASCADE, related_name="total")
+    debit = models.BigIntegerField(default=0)
+    credit = models.BigIntegerField(default=0)
+
+    @property
+    def balance(self):
+        return self.debit - self.credit
+
+
+class AccountDayBalance(models.Model):
+    """Debit/credit totals per account per Transaction.tdate."""
+    account = models.ForeignKey(Account, on_delete=models.CASCADE)
+    tdate = models.DateField()
+    debit = models.BigIntegerField(default=0)
+    credit = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["account", "tdate"], name="psqlj_accountday_uniq"),
+        ]
+
+    @property
+    def balance(self):
+        return self.debit - self.credit
+
+
+class BalanceCheckpoint(models.Model):
+    """
+    A closed period: the debit/credit totals of every account over all
+    records with tdate <= period_end (CheckpointBalance), so balance
+    queries start here instead of at the first record.
+    Written by psql_journal.checkpoints, kept up to date by balances.
+    """
+    period_end = models.DateField(unique=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return str(self.period_end)
+
+
+class CheckpointBalance(models.Model):
+    checkpoint = models.ForeignKey(
+        BalanceCheckpoint, on_delete=models.CASCADE, related_name="balances")
+    account = models.ForeignKey(
+        Account, on_delete=models.CASCADE, related_name="checkpoint_balances")
+    debit = models.BigIntegerField(default=0)
+    credit = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["checkpoint", "account"],
+                name="psqlj_checkpoint_account_uniq"),
+        ]
+
+    @property
+    def balance(self):
+        return self.debit - self.credit
+
+
+class JournalUpload(models.Model):
+    """
+    Progress of a streamed journal upload (api.upload_journal).
+
+    offset counts the input entries that are committed; it is saved in
+    the same transaction as each chunk, so a failed or interrupted
+    upload resumes exactly there.
+    """
+    RUNNING = "running"
+    FAILED = "failed"
+    DONE = "done"
+    STATUS_CHOICES = [
+        (RUNNING, "Running"),
+        (FAILED, "Failed"),
+        (DONE, "Done"),
+    ]
+
+    format = models.CharField(max_length=10)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=RUNNING)
+    offset = models.PositiveBigIntegerField(default=0)
+    records = models.PositiveBigIntegerField(default=0)
+    # entries skipped because their key was already posted
+    duplicates = models.PositiveBigIntegerField(default=0)
+    chunks = models.PositiveIntegerField(default=0)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+
+class Job(models.Model):
+    """
+    A unit of background work for the run_jobs worker (see jobs.py).
+
+    A queued job is claimed by one worker at a time; run_after delays
+    retries, heartbeat lets a stuck job be requeued.
+    """
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [
+        (QUEUED, "Queued"),
+        (RUNNING, "Running"),
+        (DONE, "Done"),
+        (FAILED, "Failed"),
+    ]
+
+    kind = models.CharField(max_length=50)
+    params = models.JSONField(default=dict, blank=True)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES,
+                              default=QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    max_attempts = models.PositiveSmallIntegerField(default=3)
+    run_after = models.DateTimeField(default=timezone.now)
+    progress_done = models.PositiveBigIntegerField(default=0)
+    progress_total = models.PositiveBigIntegerField(null=True, blank=True)
+    message = models.CharField(max_length=200, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    worker = models.CharField(max_length=100, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    finished = models.DateTimeField(null=True, blank=True)
+    heartbeat = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["status", "run_after"],
+                         name="psqlj_job_queue_idx"),
+        ]
+
+    def __str__(self):
+        return "%s #%s (%s)" % (self.kind, self.pk, self.status)
+
+
+class ArchiveFile(models.Model):
+    """
+    A Parquet file of the journal records of one month (see archive.py).
+
+    Once removed is set, the file holds the only copy of its records and
+    readers merge it with the live tables.
+    """
+    month = models.DateField()
+    path = models.CharField(max_length=255, unique=True)
+    transactions = models.PositiveBigIntegerField(default=0)
+    records = models.PositiveBigIntegerField(default=0)
+    removed = models.DateTimeField(null=True, blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["month"], name="psqlj_archive_month_idx"),
+        ]
+
+    def __str__(self):
+        return self.path
+
+
+class ArchivedKey(models.Model):
+    """
+    The idempotency key of a transaction removed to an archive file, so
+    bulkload.posted_keys() still finds it once the live row is gone.
+    """
+    key = models.CharField(max_length=100, unique=True)
+    # the id the transaction had, and keeps in the file
+    transaction_id = models.BigIntegerField()
+    file = models.ForeignKey(ArchiveFile, on_delete=models.CASCADE,
+                             related_name="keys")
+
+    def __str__(self):
+        return self.key
@@ -0,0 +1,196 @@
+"""
+Cache of rendered list pages and report fragments.
+
+Entries are stored with Django's cache framework (PSQLJ_PAGE_CACHE names
+the alias in CACHES) under a per-namespace version. A write to one of
+the namespace's models does not delete anything, it only replaces the
+version once the database transaction commits, so every old entry stops
+being looked up and simply expires. Bulk write paths that skip model
+signals (bulkload, balances.rebuild) call invalidate() themselves.
+
+Callers read version() once before rendering and pass it to both get()
+and set(), so a page rendered while a write committed is stored under
+the old version and never served.
+
+Versions only work if every process that writes sees the same cache:
+with a per-process backend (local memory, dummy) caching is off, since
+an import_journal or run_jobs process could not invalidate the pages
+of the web processes.
+
+A page rendered from a read replica (see replicas.py) may miss writes
+the replica has not replayed yet, so it is kept for at most
+PSQLJ_REPLICA_MAX_LAG seconds.
+
+Hits and misses are counted per namespace in the cache as well, so they
+are shared by all processes that share the cache backend.
+
+Settings:
+    PSQLJ_PAGE_CACHE          cache alias, default "default"
+    PSQLJ_PAGE_CACHE_TIMEOUT  seconds an entry lives, default 300
+    PSQLJ_PAGE_CACHE_ENABLED  default True, needs a shared backend
+"""
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from . import replicas
+from .models import Account, Transaction, TransactionRecord, TwoInputFields
+
+
+# namespace: models whose writes invalidate it
+NAMESPACES = {
+    "journal": (Transaction, TransactionRecord, Account),
+    "twoinput": (TwoInputFields,),
+}
+
+DEFAULT_TIMEOUT = 300
+
+# backends other processes do not share
+LOCAL_BACKENDS = (LocMemCache, DummyCache)
+
+_VERSION_KEY = "psqlj:version:%s"
+_STATS_KEY = "psqlj:stats:%s:%s"
+
+
+def get_cache():
+    return caches[getattr(settings, "PSQLJ_PAGE_CACHE", "default")]
+
+
+def shared():
+    """True if all processes see the same page cache."""
+    return not isinstance(get_cache(), LOCAL_BACKENDS)
+
+
+def enabled():
+    return getattr(settings, "PSQLJ_PAGE_CACHE_ENABLED", True) and shared()
+
+
+def timeout():
+    return getattr(settings, "PSQLJ_PAGE_CACHE_TIMEOUT", DEFAULT_TIMEOUT)
+
+
+def version(namespace):
+    """
+    Current version of namespace. A random token, not a counter, so a
+    version key evicted from the cache can never bring old entries back.
+    """
+    cache = get_cache()
+    key = _VERSION_KEY % namespace
+    current = cache.get(key)
+    if current is None:
+        cache.add(key, uuid.uuid4().hex, None)
+        current = cache.get(key)
+    return current
+
+
+def _bump(namespace):
+    get_cache().set(_VERSION_KEY % namespace, uuid.uuid4().hex, None)
+
+
+def invalidate(namespace="journal", using=None):
+    """Give namespace a new version when the current transaction commits."""
+    transaction.on_commit(lambda: _bump(namespace), using=using)
+
+
+def invalidate_model(model, using=None):
+    """Invalidate every namespace that model belongs to."""
+    for namespace, models in NAMESPACES.items():
+        if model in models:
+            invalidate(namespace, using=using)
+
+
+def make_key(name, vary=()):
+    """Cache key of the entry name for the values in vary."""
+    digest = hashlib.md5(
+        "\x1f".join(str(v) for v in vary).encode(), usedforsecurity=False,
+    ).hexdigest()
+    return "psqlj:%s:%s" % (name, digest)
+
+
+def _count(namespace, outcome):
+    cache = get_cache()
+    key = _STATS_KEY % (namespace, outcome)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # first count, or evicted
+        cache.add(key, 0, None)
+        cache.incr(key)
+
+
+def get(namespace, name, vary=(), current=None):
+    """
+    The cached value or None, counting the hit or miss. current is the
+    version() of namespace read by the caller.
+    """
+    if current is None:
+        current = version(namespace)
+    value = get_cache().get(make_key(name, vary), version=current)
+    _count(namespace, "hits" if value is not None else "misses")
+    return value
+
+
+def set(namespace, name, vary, value, current=None):
+    """
+    Store value under current, the version() the caller read before it
+    rendered value.
+    """
+    if current is None:
+        current = version(namespace)
+    seconds = timeout()
+    if replicas.used():
+        seconds = min(seconds, replicas.max_lag())
+    get_cache().set(make_key(name, vary), value, seconds, version=current)
+
+
+def stats():
+    """{namespace: {"hits", "misses", "hit_ratio"}}."""
+    cache = get_cache()
+    result = {}
+    for namespace in NAMESPACES:
+        counts = cache.get_many(
+            [_STATS_KEY % (namespace, o) for o in ("hits", "misses")])
+        hits = counts.get(_STATS_KEY % (namespace, "hits"), 0)
+        misses = counts.get(_STATS_KEY % (namespace, "misses"), 0)
+        total = hits + misses
+        result[namespace] = {
+            "hits": hits,
+            "misses": misses,
+            "hit_ratio": hits / total if total else None,
+        }
+    return result
+
+
+def reset_stats():
+    get_cache().delete_many([
+        _STATS_KEY % (namespace, o)
+        for namespace in NAMESPACES for o in ("hits", "misses")
+    ])
+
+
+##############
+# Signal handlers, connected in PsqlJournalConfig.ready()
+
+def _invalidate_handler(namespace):
+    def handler(sender, using=None, **kwargs):
+        invalidate(namespace, using=using)
+    return handler
+
+
+_handlers = {namespace: _invalidate_handler(namespace)
+             for namespace in NAMESPACES}
+
+
+def connect_signals():
+    for namespace, models in NAMESPACES.items():
+        handler = _handlers[namespace]
+        for model in models:
+            uid = "psqlj_pagecache_%s" % model._meta.label_lower
+            post_save.connect(handler, sender=model, dispatch_uid=uid)
+            post_delete.connect(handler, sender=model, dispatch_uid=uid)
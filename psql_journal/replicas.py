@@ -0,0 +1,179 @@
+"""
+Read replica routing.
+
+With a PSQLJ_REPLICA_ALIAS database configured (see ASITE_DB_REPLICA_*
+in settings.py), the journal reads of views marked replica_reads = True
+(lists, search, reports, export, the read API) go to the replica and
+everything else to "default":
+
+  * ReplicaRouterMiddleware marks the request when it reaches such a
+    view, for the whole response including template rendering and
+    streamed content,
+  * reads inside transaction.atomic() stay on the primary, they may
+    lock rows or expect to see the block's own writes,
+  * a write to a psql_journal model (or pin() from raw SQL writers)
+    pins the rest of the request to the primary, and a cookie keeps
+    the next PSQLJ_REPLICA_STICKY seconds of the client on it too, so a
+    redirect after a POST shows what was just written,
+  * the replica is skipped while its replay lag is above
+    PSQLJ_REPLICA_MAX_LAG seconds or it cannot be reached. The lag is
+    measured at most every LAG_CHECK_INTERVAL seconds per process.
+
+Raw SQL readers pick their connection with read_connection().
+Without the middleware or the replica database all reads use "default".
+"""
+import contextvars
+import time
+
+from django.conf import settings
+from django.db import DatabaseError, connections, router
+
+APP_LABEL = "psql_journal"
+COOKIE = "psqlj_primary"
+DEFAULT_MAX_LAG = 5.0
+DEFAULT_STICKY = 10
+LAG_CHECK_INTERVAL = 2.0
+
+_state = contextvars.ContextVar("psqlj_replica", default=None)
+
+# alias: (time.monotonic() of the check, lag in seconds or None)
+_lag_cache = {}
+
+
+class RequestState:
+    def __init__(self, pinned=False):
+        self.read = False       # the view reads from the replica
+        self.pinned = pinned    # stay on the primary
+        self.wrote = False
+        self.used = False       # a query went to the replica
+
+
+def replica_alias():
+    alias = getattr(settings, "PSQLJ_REPLICA_ALIAS", "replica")
+    return alias if alias in settings.DATABASES else None
+
+
+def max_lag():
+    return getattr(settings, "PSQLJ_REPLICA_MAX_LAG", DEFAULT_MAX_LAG)
+
+
+def sticky():
+    return getattr(settings, "PSQLJ_REPLICA_STICKY", DEFAULT_STICKY)
+
+
+def _measure(alias):
+    conn = connections[alias]
+    if conn.vendor != "postgresql":
+        return 0.0
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT CASE WHEN NOT pg_is_in_recovery() "
+            "OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+            "ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()) "
+            "END")
+        lag = cursor.fetchone()[0]
+    return None if lag is None else float(lag)
+
+
+def lag(alias):
+    """Replay lag of alias in seconds, None if unknown or unreachable."""
+    now = time.monotonic()
+    checked = _lag_cache.get(alias)
+    if checked is not None and now - checked[0] < LAG_CHECK_INTERVAL:
+        return checked[1]
+    try:
+        value = _measure(alias)
+    except DatabaseError:
+        value = None
+    _lag_cache[alias] = (now, value)
+    return value
+
+
+def usable(alias):
+    current = lag(alias)
+    return current is not None and current <= max_lag()
+
+
+def pin():
+    """Keep the current request on the primary, e.g. after raw SQL writes."""
+    state = _state.get()
+    if state is not None:
+        state.wrote = state.pinned = True
+
+
+def used():
+    """True if the current request read from the replica."""
+    state = _state.get()
+    return state is not None and state.used
+
+
+def read_connection(model):
+    """The connection reads of model use in the current request."""
+    return connections[router.db_for_read(model) or "default"]
+
+
+def replica_reads(view):
+    """Mark a function view as reading from the replica."""
+    view.replica_reads = True
+    return view
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if (state is None or not state.read or state.pinned
+                or model._meta.app_label != APP_LABEL
+                or connections["default"].in_atomic_block):
+            return None
+        alias = replica_alias()
+        if alias is None or not usable(alias):
+            return None
+        state.used = True
+        return alias
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == APP_LABEL:
+            pin()
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        return db != replica_alias()
+
+
+def _bound(state, content):
+    """Iterate streamed content with the request's routing state."""
+    token = _state.set(state)
+    try:
+        yield from content
+    finally:
+        _state.reset(token)
+
+
+class ReplicaRouterMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        state = RequestState(pinned=COOKIE in request.COOKIES)
+        token = _state.set(state)
+        try:
+            response = self.get_response(request)
+        finally:
+            _state.reset(token)
+        if response.streaming and state.read:
+            response.streaming_content = _bound(
+                state, response.streaming_content)
+        if state.wrote and replica_alias():
+            response.set_cookie(COOKIE, "1", max_age=sticky(),
+                                httponly=True, samesite="Lax")
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        view_class = getattr(view_func, "view_class", None)
+        if getattr(view_func, "replica_reads", False) or getattr(
+                view_class, "replica_reads", False):
+            _state.get().read = True
@@ -0,0 +1,259 @@
+"""
+Reports computed in the database.
+
+Totals come from GROUP BY over AccountDayBalance (one row per account per
+day, see balances.py) instead of the raw journal, and the running balance
+of the ledger is a window function. Each report is a generator over a
+server-side cursor, so memory stays bounded whatever the ledger size.
+
+Balances before a date start from the nearest period-close checkpoint
+(see checkpoints.py) and only sum the days after it.
+
+On PostgreSQL, whole-month ranges are answered from the monthly
+materialized view when it is fresh enough (see matviews.py).
+"""
+import datetime
+import itertools
+
+from django.db.models import Case, F, Max, Q, Sum, Value, When, Window
+from django.db.models.functions import Coalesce, TruncMonth
+
+from . import archive, checkpoints, export, matviews
+from .models import Account, AccountDayBalance, TransactionRecord
+from .utils import keyset_q
+
+
+DEFAULT_CHUNK_SIZE = 2000
+CURSOR_SEPARATOR = "~"
+
+
+def _range(qs, start=None, end=None, field="tdate"):
+    if start:
+        qs = qs.filter(**{field + "__gte": start})
+    if end:
+        qs = qs.filter(**{field + "__lte": end})
+    return qs
+
+
+def _with_code(qs, chunk_size, field="account__code"):
+    """Iterate qs, renaming field (the account code) to account."""
+    for row in qs.iterator(chunk_size=chunk_size):
+        row["account"] = row.pop(field)
+        yield row
+
+
+def trial_balance(start=None, end=None, account=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield {"account", "debit", "credit", "balance"} per account for the
+    tdate range, ordered by account.
+    """
+    if matviews.usable(start, end):
+        return matviews.trial_balance(start, end, account)
+    checkpoint = None if start else checkpoints.nearest(end)
+    if checkpoint is not None:
+        qs = checkpoints.account_totals(checkpoint, end, account).values(
+            "code",
+        ).annotate(
+            debit=Coalesce(Max("cp__debit"), 0)
+            + Coalesce(Sum("days__debit"), 0),
+            credit=Coalesce(Max("cp__credit"), 0)
+            + Coalesce(Sum("days__credit"), 0),
+        ).annotate(
+            balance=F("debit") - F("credit"),
+        ).order_by(export.code_point_order("code"))
+        return _with_code(qs, chunk_size, "code")
+    qs = _range(AccountDayBalance.objects.all(), start, end)
+    if account:
+        qs = qs.filter(account__code=account)
+    qs = qs.values("account__code").annotate(
+        debit=Sum("debit"),
+        credit=Sum("credit"),
+    ).annotate(
+        balance=F("debit") - F("credit"),
+    ).order_by(export.code_point_order())
+    return _with_code(qs, chunk_size)
+
+
+def opening_balances(start, account=None):
+    """{account id: debit - credit} of everything before start."""
+    if not start:
+        return {}
+    return checkpoints.balances_at(start - datetime.timedelta(days=1),
+                                   account)
+
+
+def period_close(start, end, account=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield {"account", "opening", "debit", "credit", "closing"} per account
+    for the period [start, end], in one GROUP BY query.
+    """
+    if matviews.usable(start, end, opening=True):
+        return matviews.period_close(start, end, account)
+    checkpoint = checkpoints.nearest(start - datetime.timedelta(days=1))
+    if checkpoint is not None:
+        in_period = Q(days__tdate__gte=start)
+        qs = checkpoints.account_totals(checkpoint, end, account).values(
+            "code",
+        ).annotate(
+            opening=Coalesce(Max(F("cp__debit") - F("cp__credit")), 0)
+            + Coalesce(Sum(F("days__debit") - F("days__credit"),
+                           filter=~in_period), 0),
+            debit=Coalesce(Sum("days__debit", filter=in_period), 0),
+            credit=Coalesce(Sum("days__credit", filter=in_period), 0),
+        ).annotate(
+            closing=F("opening") + F("debit") - F("credit"),
+        ).order_by(export.code_point_order("code"))
+        return _with_code(qs, chunk_size, "code")
+    qs = AccountDayBalance.objects.filter(tdate__lte=end)
+    if account:
+        qs = qs.filter(account__code=account)
+    in_period = Q(tdate__gte=start)
+    qs = qs.values("account__code").annotate(
+        opening=Coalesce(
+            Sum(F("debit") - F("credit"), filter=~in_period), Value(0)),
+        debit=Coalesce(Sum("debit", filter=in_period), Value(0)),
+        credit=Coalesce(Sum("credit", filter=in_period), Value(0)),
+    ).annotate(
+        closing=F("opening") + F("debit") - F("credit"),
+    ).order_by(export.code_point_order())
+    return _with_code(qs, chunk_size)
+
+
+def month_range(start=None, end=None):
+    """Widen [start, end] to whole months."""
+    if start:
+        start = start.replace(day=1)
+    if end:
+        end = (end.replace(day=1) + datetime.timedelta(days=32)).replace(
+            day=1) - datetime.timedelta(days=1)
+    return start, end
+
+
+def monthly_totals(start=None, end=None, account=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Yield {"account", "month", "debit", "credit", "records"} per account
+    and month touched by the range, ordered by account and month.
+    "records" is only known from the materialized view, else None.
+    """
+    start, end = month_range(start, end)
+    if matviews.usable(start, end):
+        return matviews.monthly_totals(start, end, account)
+    qs = _range(AccountDayBalance.objects.all(), start, end)
+    if account:
+        qs = qs.filter(account__code=account)
+    qs = qs.annotate(month=TruncMonth("tdate")).values(
+        "account__code", "month",
+    ).annotate(
+        debit=Sum("debit"),
+        credit=Sum("credit"),
+    ).order_by(export.code_point_order(), "month")
+    return ({**row, "records": None} for row in _with_code(qs, chunk_size))
+
+
+def signed_amount():
+    return Case(
+        When(side=TransactionRecord.DEBIT, then=F("amount")),
+        default=-F("amount"),
+    )
+
+
+LEDGER_KEYSET = ["code_point", "transaction__tdate", "transaction_id",
+                 "record_num"]
+
+
+def ledger_key(row):
+    """Keyset of an account_ledger() row, for its after argument."""
+    return (row["account"], row["tdate"], row["transaction_id"],
+            row["record_num"])
+
+
+def encode_ledger_cursor(row):
+    return CURSOR_SEPARATOR.join(str(v) for v in ledger_key(row))
+
+
+def decode_ledger_cursor(cursor):
+    """ledger_key() of a cursor; raise ValueError if it is not one."""
+    # the account code may contain the separator, the rest cannot
+    parts = cursor.rsplit(CURSOR_SEPARATOR, 3)
+    if len(parts) != 4:
+        raise ValueError("Invalid ledger cursor.")
+    code, tdate, transaction_id, record_num = parts
+    return (code, datetime.date.fromisoformat(tdate), int(transaction_id),
+            int(record_num))
+
+
+def account_ledger(start=None, end=None, account=None,
+                   chunk_size=DEFAULT_CHUNK_SIZE, after=None, limit=None):
+    """
+    Yield the records of the tdate range ordered by account code (by
+    code point, see export.py) and date, each with "balance": the
+    account balance after that record.
+
+    The running sum inside the range is a window function; the opening
+    balance before start comes from one query on AccountDayBalance.
+
+    after (a ledger_key()) and limit page the ledger: yield at most
+    limit records after that one. The records of its account before it
+    are summed into the opening balance in one more query.
+    """
+    opening = opening_balances(start, account)
+    if archive.has_removed(start, end):
+        rows = _merged_ledger(start, end, account, chunk_size, opening)
+        if after:
+            rows = itertools.dropwhile(lambda r: ledger_key(r) <= after, rows)
+        yield from itertools.islice(rows, limit)
+        return
+
+    qs = _range(TransactionRecord.objects.all(), start, end,
+                field="transaction__tdate")
+    if account:
+        qs = qs.filter(account__code=account)
+    order = [F("transaction__tdate"), F("transaction_id"), F("record_num")]
+    if after:
+        qs = qs.alias(code_point=export.code_point_order())
+        before = qs.filter(account__code=after[0]).exclude(
+            keyset_q(LEDGER_KEYSET[1:], after[1:]))
+        opening = dict(opening)
+        for account_id, amount in before.values_list("account_id").annotate(
+                amount=Sum(signed_amount())).order_by():
+            opening[account_id] = opening.get(account_id, 0) + amount
+        qs = qs.filter(keyset_q(LEDGER_KEYSET, after))
+    qs = qs.annotate(
+        running=Window(
+            Sum(signed_amount()),
+            partition_by=[F("account_id")],
+            order_by=order,
+        ),
+    ).order_by(export.code_point_order(), *order).values(
+        "account_id", "account__code", "transaction_id", "transaction__tdate",
+        "transaction__desc", "record_num", "side", "amount", "running",
+    )
+    if limit is not None:
+        qs = qs[:limit]
+
+    for row in qs.iterator(chunk_size=chunk_size):
+        row["account"] = row.pop("account__code")
+        row["tdate"] = row.pop("transaction__tdate")
+        row["desc"] = row.pop("transaction__desc")
+        row["balance"] = (opening.get(row.pop("account_id"), 0)
+                          + row.pop("running"))
+        yield row
+
+
+def _merged_ledger(start, end, account, chunk_size, opening):
+    """account_ledger() over live and archived records, summed in Python."""
+    ids = dict(Account.objects.values_list("code", "id"))
+    current, balance = None, 0
+    for (transaction_id, tdate, desc, record_num, code, side,
+         amount) in export.ledger_rows(start, end, account, chunk_size,
+                                       by_account=True):
+        if code != current:
+            current, balance = code, opening.get(ids.get(code), 0)
+        balance += amount if side == TransactionRecord.DEBIT else -amount
+        yield {
+            "transaction_id": transaction_id, "record_num": record_num,
+            "side": side, "amount": amount, "account": code, "tdate": tdate,
+            "desc": desc, "balance": balance,
+        }
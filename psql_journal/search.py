@@ -0,0 +1,167 @@
+"""
+Ranked search of transactions by description and account.
+
+    search(q="rent", account="11")
+
+q matches Transaction.desc, account matches the code or name of an
+account of any record of the transaction. Results are ordered by rank,
+best first, and paged with a keyset cursor on (rank, id): the "next"
+cursor of a page is passed back as after=.
+
+On PostgreSQL the query is raw SQL over the indexes of migration 0013:
+
+  * every word of q must match a word of desc, or its beginning
+    ("ren" finds "Rent"), via the GIN index on the stored tsvector
+    column desc_tsv,
+  * with pg_trgm installed, q also matches anywhere inside desc
+    (ILIKE '%q%' via the trigram GIN index), and the rank adds
+    word_similarity() to ts_rank().
+
+Other backends fall back to icontains with a coarse rank (exact match,
+prefix, anywhere); it scans, but tests and small databases run the same
+code path.
+"""
+import re
+
+from django.db.models import Case, FloatField, Prefetch, Q, Value, When
+
+from .models import Transaction, TransactionRecord
+from .replicas import read_connection
+
+
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+CURSOR_SEPARATOR = "~"
+
+# alias: whether the trigram indexes exist
+_trigram = {}
+
+
+def trigram_enabled(connection):
+    if connection.vendor != "postgresql":
+        return False
+    if connection.alias not in _trigram:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT to_regclass('psqlj_txn_desc_trgm_idx') IS NOT NULL")
+            _trigram[connection.alias] = cursor.fetchone()[0]
+    return _trigram[connection.alias]
+
+
+def encode_cursor(rank, pk):
+    return "%r%s%d" % (rank, CURSOR_SEPARATOR, pk)
+
+
+def decode_cursor(cursor):
+    """(rank, id) of a cursor; raise ValueError if it is not one."""
+    rank, sep, pk = cursor.partition(CURSOR_SEPARATOR)
+    if not sep:
+        raise ValueError("Invalid search cursor.")
+    return float(rank), int(pk)
+
+
+def _like(value):
+    """ILIKE pattern matching value anywhere."""
+    return "%%%s%%" % re.sub(r"([\\%_])", r"\\\1", value)
+
+
+def _prefix_tsquery(q):
+    """to_tsquery() text requiring every word of q, as a word prefix."""
+    words = re.findall(r"\w+", q)
+    return " & ".join("'%s':*" % w for w in words)
+
+
+def _search_pg(connection, q, account, after, limit):
+    conditions, params = [], []
+    rank = "0"
+    rank_params = []
+    if q:
+        tsquery = _prefix_tsquery(q)
+        matches = []
+        if tsquery:
+            rank = "ts_rank(t.desc_tsv, to_tsquery('simple', %s))"
+            rank_params = [tsquery]
+            matches.append("t.desc_tsv @@ to_tsquery('simple', %s)")
+            params.append(tsquery)
+        if trigram_enabled(connection):
+            rank = "%s + word_similarity(%%s, t.\"desc\")" % rank
+            rank_params.append(q)
+            matches.append("t.\"desc\" ILIKE %s")
+            params.append(_like(q))
+        if not matches:
+            return []
+        conditions.append("(%s)" % " OR ".join(matches))
+    if account:
+        conditions.append(
+            "t.id IN (SELECT r.transaction_id "
+            "FROM psql_journal_transactionrecord r "
+            "JOIN psql_journal_account a ON a.id = r.account_id "
+            "WHERE a.code ILIKE %s OR a.name ILIKE %s)")
+        params += [_like(account), _like(account)]
+
+    sql = ("SELECT id, rank FROM (SELECT t.id, (%s)::float8 AS rank "
+           "FROM psql_journal_transaction t WHERE %s) found"
+           % (rank, " AND ".join(conditions)))
+    params = rank_params + params
+    if after:
+        sql += " WHERE rank < %s OR (rank = %s AND id < %s)"
+        params += [after[0], after[0], after[1]]
+    sql += " ORDER BY rank DESC, id DESC LIMIT %s"
+    params.append(limit)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def _search_orm(connection, q, account, after, limit):
+    qs = Transaction.objects.all()
+    if q:
+        qs = qs.filter(desc__icontains=q).annotate(rank=Case(
+            When(desc__iexact=q, then=Value(3.0)),
+            When(desc__istartswith=q, then=Value(2.0)),
+            default=Value(1.0),
+            output_field=FloatField(),
+        ))
+    else:
+        qs = qs.annotate(rank=Value(0.0, output_field=FloatField()))
+    if account:
+        qs = qs.filter(id__in=TransactionRecord.objects.filter(
+            Q(account__code__icontains=account)
+            | Q(account__name__icontains=account),
+        ).values("transaction_id"))
+    if after:
+        qs = qs.filter(Q(rank__lt=after[0]) | Q(rank=after[0], id__lt=after[1]))
+    return list(qs.order_by("-rank", "-id").values_list("id", "rank")[:limit])
+
+
+def search(q="", account="", after=None, limit=DEFAULT_LIMIT):
+    """
+    Return {"results": [(transaction, rank)], "next": cursor or None}.
+    The transactions have their records in .records. after is a cursor
+    from a previous page; an invalid one raises ValueError.
+    """
+    q, account = (q or "").strip(), (account or "").strip()
+    if not (q or account):
+        return {"results": [], "next": None}
+    after = decode_cursor(after) if after else None
+    limit = max(1, min(limit, MAX_LIMIT))
+
+    # the routed connection: the replica in views marked replica_reads
+    connection = read_connection(Transaction)
+    find = _search_pg if connection.vendor == "postgresql" else _search_orm
+    rows = find(connection, q, account, after, limit + 1)
+    has_next = len(rows) > limit
+    rows = rows[:limit]
+
+    txns = Transaction.objects.prefetch_related(
+        Prefetch(
+            "transactionrecord_set",
+            queryset=TransactionRecord.objects.select_related(
+                "account").order_by("record_num"),
+            to_attr="records",
+        )
+    ).in_bulk([pk for pk, _ in rows])
+    return {
+        "results": [(txns[pk], rank) for pk, rank in rows if pk in txns],
+        "next": encode_cursor(*rows[-1][::-1]) if has_next else None,
+    }
@@ -0,0 +1,48 @@
+from django import template
+
+from psql_journal import pagecache
+
+register = template.Library()
+
+
+class FragmentCacheNode(template.Node):
+    def __init__(self, nodelist, namespace, name, vary):
+        self.nodelist = nodelist
+        self.namespace = namespace
+        self.name = name
+        self.vary = vary
+
+    def render(self, context):
+        if not pagecache.enabled():
+            return self.nodelist.render(context)
+        namespace = self.namespace.resolve(context)
+        name = "fragment:%s" % self.name.resolve(context)
+        vary = [v.resolve(context) for v in self.vary]
+        current = pagecache.version(namespace)
+        value = pagecache.get(namespace, name, vary, current)
+        if value is None:
+            value = self.nodelist.render(context)
+            pagecache.set(namespace, name, vary, value, current)
+        return value
+
+
+@register.tag("fragmentcache")
+def do_fragmentcache(parser, token):
+    """
+    Cache the enclosed fragment in pagecache until namespace changes:
+
+        {% load psqlj_cache %}
+        {% fragmentcache "journal" "trial-balance" report_vary %}
+            ...
+        {% endfragmentcache %}
+
+    Every argument after the name is part of the key.
+    """
+    nodelist = parser.parse(("endfragmentcache",))
+    parser.delete_first_token()
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(
+            "'%s' takes at least two arguments: namespace and name." % bits[0])
+    namespace, name, *vary = [parser.compile_filter(b) for b in bits[1:]]
+    return FragmentCacheNode(nodelist, namespace, name, vary)
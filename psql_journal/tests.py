@@ -1,3 +1,1766 @@
-from django.test import TestCase
+import csv
+import datetime
+import importlib.util
+import io
+import json
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from collections import defaultdict
+from unittest import mock
 
-# Create your tests here.
+from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.management import CommandError, call_command
+from django.db import (
+    DatabaseError,
+    DataError,
+    IntegrityError,
+    connection,
+    connections,
+    router,
+    transaction,
+)
+from django.db.models import F
+from django.http import QueryDict
+from django.test import (
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from asite.sa_tablemodule import lzy_reserve_ids
+
+from . import (
+    accounts,
+    api,
+    archive,
+    audit,
+    balances,
+    benchmarks,
+    bulkload,
+    checkpoints,
+    columnar,
+    export,
+    instrumentation,
+    jobs,
+    matviews,
+    pagecache,
+    replicas,
+    reports,
+    search,
+    views,
+)
+from .benchmarks import synthetic_entries
+from .bulkload import clean_entry, load_journal
+from .management.commands import bench_suite
+from .utils import (
+    CodeChoiceField,
+    CodeInlineFormSet,
+    cached_modelform_factory,
+    clear_form_class_cache,
+    ph_inlineformset_factory,
+    ph_modelform_factory,
+)
+from .models import (
+    Account,
+    AccountBalance,
+    ArchivedKey,
+    CheckpointBalance,
+    Job,
+    JournalUpload,
+    Transaction,
+    TransactionRecord,
+    TwoInputFields,
+)
+
+
+def entry(*records, tdate="2024-01-15", key=None):
+    """A raw entry of (account, amount, side) records."""
+    data = {
+        "tdate": tdate,
+        "desc": "test",
+        "records": [{"account": a, "amount": amt, "side": s}
+                    for a, amt, s in records],
+    }
+    if key is not None:
+        data["key"] = key
+    return data
+
+
+def balanced(amount=100, key=None, tdate="2024-01-15"):
+    return entry(("1000", amount, "D"), ("2000", amount, "C"),
+                 key=key, tdate=tdate)
+
+
+##############
+# Bulk load and API validation
+
+class CleanEntryTests(SimpleTestCase):
+    def test_clean(self):
+        cleaned = clean_entry(entry(("1000", "150", "D"), ("2000", 150, "c")))
+        self.assertEqual(cleaned["tdate"], datetime.date(2024, 1, 15))
+        self.assertEqual(
+            [(r["record_num"], r["amount"], r["side"])
+             for r in cleaned["records"]],
+            [(1, 150, "D"), (2, 150, "C")])
+
+    def test_unbalanced(self):
+        with self.assertRaises(ValidationError) as cm:
+            clean_entry(entry(("1000", 100, "D"), ("2000", 99, "C")))
+        self.assertEqual(cm.exception.code, "unbalanced")
+
+    def test_amount_must_be_whole(self):
+        # int(1.9) == 1 would balance against 1
+        for amount in (1.9, 1.0, True, "1.5", "-1", -1, None, 2 ** 63):
+            with self.subTest(amount=amount):
+                with self.assertRaises(ValidationError):
+                    clean_entry(entry(("1000", amount, "D"),
+                                      ("2000", 1, "C")))
+
+    def test_record_num(self):
+        cleaned = clean_entry({**balanced(), "records": [
+            {"account": "1000", "amount": 5, "record_num": "7"},
+            {"account": "2000", "amount": 5, "side": "C", "record_num": ""},
+        ]})
+        self.assertEqual([r["record_num"] for r in cleaned["records"]], [7, 2])
+        for record_num in ("x", 2 ** 15, 0, 1.5):
+            with self.subTest(record_num=record_num):
+                with self.assertRaises(ValidationError):
+                    clean_entry({**balanced(), "records": [
+                        {"account": "1000", "amount": 5,
+                         "record_num": record_num},
+                        {"account": "2000", "amount": 5, "side": "C"},
+                    ]})
+
+    def test_bad_structure(self):
+        for data in ([], {"records": []}, {"tdate": "2024-13-01"},
+                     entry(("1000", 5, "D")),
+                     entry(("1000", 5, "X"), ("2000", 5, "C")),
+                     entry(("", 5, "D"), ("2000", 5, "C")),
+                     {**balanced(), "key": ""}):
+            with self.subTest(data=data):
+                with self.assertRaises(ValidationError):
+                    clean_entry(data)
+
+
+class ReaderTests(SimpleTestCase):
+    def test_csv(self):
+        lines = io.StringIO(
+            "ref,tdate,desc,account,amount,side\n"
+            "a,2024-01-02,\"rent, January\",1000,50,\n"
+            "a,,,2000,50,C\n"
+            "b,2024-01-03,fee,1000,5,D\n"
+            "b,,,2000,5,C\n")
+        entries = list(bulkload.iter_csv(lines))
+        self.assertEqual([(e["tdate"], e["desc"]) for e in entries],
+                         [("2024-01-02", "rent, January"),
+                          ("2024-01-03", "fee")])
+        self.assertEqual(
+            [(r["account"], r["amount"], r["side"])
+             for r in entries[0]["records"]],
+            [("1000", "50", "D"), ("2000", "50", "C")])
+        cleaned = clean_entry(entries[0])
+        self.assertEqual([r["amount"] for r in cleaned["records"]], [50, 50])
+
+
+class WriterTests(TestCase):
+    def entries(self):
+        awkward = {**balanced(amount=7, key="k1"),
+                   "desc": 'comma, "quote", tab\t, back\\slash\nnewline'}
+        return [clean_entry(e) for e in
+                (awkward, balanced(amount=3), balanced(amount=9, key="k2"))]
+
+    def written(self, ids):
+        txns = Transaction.objects.in_bulk(ids)
+        return [
+            (txns[pk].tdate, txns[pk].desc, txns[pk].idempotency_key,
+             list(TransactionRecord.objects.filter(transaction_id=pk)
+                  .order_by("record_num")
+                  .values_list("record_num", "account__code", "amount",
+                               "side")))
+            for pk in ids
+        ]
+
+    def expected(self, entries):
+        return [
+            (e["tdate"], e["desc"], e.get("key"),
+             [(r["record_num"], r["account"], r["amount"], r["side"])
+              for r in e["records"]])
+            for e in entries
+        ]
+
+    def test_write_entries(self):
+        entries = self.entries()
+        ids = bulkload.write_entries(entries)
+        self.assertEqual(len(set(ids)), 3)
+        self.assertEqual(self.written(ids), self.expected(entries))
+        self.assertEqual(AccountBalance.objects.get(
+            account__code="1000").debit, 19)
+
+    def test_orm_fallback(self):
+        entries = self.entries()
+        account_ids = accounts.resolve_codes({"1000", "2000"})
+        ids = bulkload._write_orm(entries, account_ids)
+        self.assertEqual(self.written(ids), self.expected(entries))
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_copy(self):
+        entries = self.entries()
+        account_ids = accounts.resolve_codes({"1000", "2000"})
+        ids = bulkload._write_copy(entries, account_ids)
+        self.assertEqual(self.written(ids), self.expected(entries))
+
+    @unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_reserve_ids(self):
+        ids = lzy_reserve_ids(Transaction._meta.db_table, 5)
+        self.assertEqual(len(set(ids)), 5)
+        self.assertEqual(ids, sorted(ids))
+        # the sequence moved past them
+        txn = Transaction.objects.create(tdate=datetime.date(2024, 1, 1))
+        self.assertGreater(txn.pk, max(ids))
+
+
+class PostTransactionsTests(TestCase):
+    url = reverse("psqlj:api-transactions-bulk")
+
+    def post(self, items, query=""):
+        return self.client.post(self.url + query, json.dumps(items),
+                                content_type="application/json")
+
+    def test_batch(self):
+        Transaction.objects.create(tdate=datetime.date(2024, 1, 1),
+                                   idempotency_key="old")
+        response = self.post([
+            balanced(key="a"),
+            entry(("1000", 1.9, "D"), ("2000", 1, "C")),
+            balanced(key="a"),
+            balanced(key="old"),
+            {**balanced(), "records": [
+                {"account": "1000", "amount": 5, "record_num": "x"},
+                {"account": "2000", "amount": 5, "side": "C"},
+            ]},
+        ])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([r["status"] for r in data["results"]],
+                         ["created", "invalid", "duplicate", "duplicate",
+                          "invalid"])
+        self.assertEqual(data["results"][2]["id"], data["results"][0]["id"])
+        self.assertEqual((data["created"], data["duplicates"], data["invalid"]),
+                         (1, 2, 2))
+        self.assertEqual(Transaction.objects.filter(
+            idempotency_key="a").count(), 1)
+
+    def test_atomic(self):
+        response = self.post([balanced(), entry(("1000", 1, "D"))],
+                             "?atomic=1")
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual([r["status"] for r in response.json()["results"]],
+                         ["skipped", "invalid"])
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_bad_body(self):
+        response = self.client.post(self.url, "{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+        response = self.post({"transactions": "nope"})
+        self.assertEqual(response.status_code, 400)
+
+    @override_settings(PSQLJ_API_MAX_BATCH=2)
+    def test_too_large(self):
+        response = self.post([balanced()] * 3)
+        self.assertEqual(response.status_code, 413)
+
+    def post_ndjson(self, items):
+        body = "".join(json.dumps(e) + "\n" for e in items)
+        return self.client.post(self.url, body,
+                                content_type="application/x-ndjson")
+
+    def test_bytes_limit(self):
+        items = [balanced(key="k%d" % i) for i in range(3)]
+        size = len(json.dumps(items))
+        with override_settings(PSQLJ_API_MAX_BYTES=size):
+            self.assertEqual(self.post(items).status_code, 200)
+        with override_settings(PSQLJ_API_MAX_BYTES=size - 1):
+            self.assertEqual(self.post(items).status_code, 413)
+        with override_settings(PSQLJ_API_MAX_BYTES=size // 2):
+            self.assertEqual(self.post_ndjson(items).status_code, 413)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_line_limit(self):
+        line = len(json.dumps(balanced(key="a")))
+        with override_settings(PSQLJ_API_MAX_LINE_BYTES=line - 1):
+            response = self.post_ndjson([balanced(key="a")])
+        self.assertEqual(response.status_code, 413)
+        self.assertIn("Line 1", response.json()["error"])
+        with override_settings(PSQLJ_API_MAX_LINE_BYTES=line):
+            response = self.post_ndjson([balanced(key="a"), balanced(key="b")])
+        self.assertEqual(response.json()["created"], 2)
+
+
+class UploadTests(TestCase):
+    url = reverse("psqlj:api-uploads")
+
+    def upload(self, entries, url=None):
+        body = "".join(json.dumps(e) + "\n" for e in entries)
+        return self.client.post(url or self.url + "?format=jsonl&chunk_size=2",
+                                body, content_type="application/octet-stream")
+
+    def test_upload(self):
+        response = self.upload([balanced(key=k) for k in "abc"])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["status"], data["offset"], data["records"],
+                          data["chunks"]), ("done", 3, 6, 2))
+
+    def test_posted_keys_are_skipped(self):
+        load_journal([balanced(key="a")])
+        response = self.upload([balanced(key="a"), balanced(key="b"),
+                                balanced(key="b"), balanced()])
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["status"], data["offset"], data["duplicates"]),
+                         ("done", 4, 2))
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_bad_entry_and_resume(self):
+        entries = [balanced(key=k) for k in "abc"]
+        entries[2] = entry(("1000", 2, "D"), ("2000", 1, "C"))
+        response = self.upload(entries)
+        self.assertEqual(response.status_code, 422)
+        data = response.json()
+        self.assertEqual((data["status"], data["offset"]), ("failed", 2))
+        self.assertIn("Entry 3", data["error"])
+
+        entries[2] = balanced(key="c")
+        response = self.upload(entries[2:], data["url"] + "?start=2")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["offset"], 3)
+        self.assertEqual(Transaction.objects.count(), 3)
+
+    def test_database_error(self):
+        with mock.patch.object(bulkload, "write_entries",
+                               side_effect=DataError("value out of range")):
+            response = self.upload([balanced()])
+        self.assertEqual(response.status_code, 422)
+        data = response.json()
+        self.assertEqual(data["status"], "failed")
+        self.assertIn("value out of range", data["error"])
+        # not left running: a retry is not refused with 409
+        response = self.upload([balanced()], data["url"])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(JournalUpload.objects.get().status, "done")
+
+
+##############
+# Forms
+
+class CodeFormsetTests(TestCase):
+    def formset_class(self):
+        return ph_inlineformset_factory(
+            Transaction, TransactionRecord, fields=["account", "amount", "side"],
+            formset=CodeInlineFormSet, field_classes={"account": CodeChoiceField},
+            extra=0)
+
+    def test_existing_rows_resolved_in_one_query(self):
+        load_journal([entry(("1000", 5, "D"), ("1100", 3, "D"),
+                            ("2000", 8, "C"))])
+        txn = Transaction.objects.get()
+        formset = self.formset_class()(instance=txn)
+        # the records, then all their accounts
+        with self.assertNumQueries(2):
+            codes = [form["account"].value() for form in formset]
+        self.assertEqual(codes, ["1000", "1100", "2000"])
+
+    def test_bound_codes(self):
+        Account.objects.create(code="1000", name="cash")
+        Account.objects.create(code="2000", name="sales")
+        data = {"transactionrecord_set-TOTAL_FORMS": "2",
+                "transactionrecord_set-INITIAL_FORMS": "0"}
+        for i, (code, side) in enumerate([("1000", "D"), ("2000", "C")]):
+            data.update({"transactionrecord_set-%d-account" % i: code,
+                         "transactionrecord_set-%d-amount" % i: "5",
+                         "transactionrecord_set-%d-side" % i: side})
+        formset = self.formset_class()(data, instance=Transaction(
+            tdate=datetime.date(2024, 1, 1)))
+        with self.assertNumQueries(1):
+            self.assertTrue(formset.is_valid(), formset.errors)
+        self.assertEqual([f.cleaned_data["account"].code for f in formset],
+                         ["1000", "2000"])
+
+    def test_other_foreign_keys_are_validated(self):
+        # a plain ModelChoiceField keeps the model's unique check
+        account = Account.objects.create(code="1000", name="cash")
+        AccountBalance.objects.create(account=account)
+        form = ph_modelform_factory(
+            AccountBalance, fields=["account", "debit", "credit"])(
+            {"account": account.pk, "debit": 0, "credit": 0})
+        self.assertFalse(form.is_valid())
+        self.assertIn("account", form.errors)
+
+
+class FormClassCacheTests(SimpleTestCase):
+    def setUp(self):
+        clear_form_class_cache()
+        self.addCleanup(clear_form_class_cache)
+
+    def test_same_class(self):
+        form = cached_modelform_factory(TwoInputFields, fields=["str1"])
+        self.assertIs(cached_modelform_factory(TwoInputFields,
+                                               fields=["str1"]), form)
+        self.assertIsNot(cached_modelform_factory(TwoInputFields,
+                                                  fields=["str2"]), form)
+        self.assertIs(ph_inlineformset_factory(
+            Transaction, TransactionRecord, fields=["amount"]),
+            ph_inlineformset_factory(
+                Transaction, TransactionRecord, fields=["amount"]))
+
+    def test_unhashable_arguments_are_not_cached(self):
+        def factory():
+            return cached_modelform_factory(
+                TwoInputFields, fields=["str1"],
+                widgets={"str1": forms.Textarea()})
+        self.assertIsNot(factory(), factory())
+
+    def test_setting_disables(self):
+        form = cached_modelform_factory(TwoInputFields, fields=["str1"])
+        with override_settings(PSQLJ_FORM_CLASS_CACHE=False):
+            self.assertIsNot(cached_modelform_factory(
+                TwoInputFields, fields=["str1"]), form)
+            self.assertIsNot(
+                cached_modelform_factory(TwoInputFields, fields=["str1"]),
+                cached_modelform_factory(TwoInputFields, fields=["str1"]))
+        # changing the setting cleared the cache
+        self.assertIsNot(cached_modelform_factory(
+            TwoInputFields, fields=["str1"]), form)
+
+
+##############
+# Incremental balances
+
+class BalancesTests(TestCase):
+    def assertNoDrift(self):
+        self.assertEqual(balances.find_drift(), [])
+
+    def test_bulk_load(self):
+        entries = [
+            entry(("1000", 10 * i, "D"), ("1100", i, "D"), ("2000", 11 * i, "C"),
+                  tdate="2024-01-%02d" % (i % 28 + 1))
+            for i in range(1, 51)
+        ]
+        result = load_journal(entries, chunk_size=20)
+        self.assertEqual(result.transactions, 50)
+        self.assertNoDrift()
+        debit = sum(AccountBalance.objects.values_list("debit", flat=True))
+        self.assertEqual(debit, 11 * sum(range(1, 51)))
+
+    def test_orm_writes(self):
+        # every step keeps the transactions balanced, PostgreSQL checks
+        # that at commit
+        load_journal([balanced(100), balanced(50, tdate="2024-02-01")])
+        cash = Account.objects.get(code="1000")
+        first, second = Transaction.objects.order_by("id")
+
+        for rec in first.transactionrecord_set.all():
+            rec.amount = 70
+            rec.save()
+        self.assertNoDrift()
+
+        rec = first.transactionrecord_set.get(account=cash)
+        rec.account = Account.objects.create(code="3000", name="other")
+        rec.save()
+        self.assertNoDrift()
+
+        first.tdate = datetime.date(2023, 12, 31)
+        first.save()
+        self.assertNoDrift()
+
+        TransactionRecord.objects.create(
+            transaction=first, record_num=3, account=cash, amount=5)
+        TransactionRecord.objects.create(
+            transaction=first, record_num=4, account=cash, amount=5,
+            side=TransactionRecord.CREDIT)
+        self.assertNoDrift()
+
+        for rec in second.transactionrecord_set.all():
+            rec.delete()
+        second.delete()
+        self.assertNoDrift()
+        self.assertEqual(
+            AccountBalance.objects.values_list("debit", "credit").get(
+                account=cash), (5, 5))
+
+    def test_drift_and_rebuild(self):
+        load_journal([balanced(100)])
+        # update() bypasses the signals
+        TransactionRecord.objects.update(amount=90)
+        drift = balances.find_drift()
+        self.assertEqual({kind for kind, _, _, _ in drift}, {"account", "day"})
+        balances.rebuild()
+        self.assertNoDrift()
+
+
+##############
+# Chart of accounts
+
+class AccountTreeTests(TestCase):
+    def setUp(self):
+        # assets > cash > petty, assets > bank; equity
+        self.assets = Account.objects.create(code="1", name="assets")
+        self.cash = Account.objects.create(code="10", parent=self.assets)
+        self.petty = Account.objects.create(code="100", parent=self.cash)
+        self.bank = Account.objects.create(code="11", parent=self.assets)
+        self.equity = Account.objects.create(code="3", name="equity")
+
+    def paths(self):
+        return dict(Account.objects.values_list("code", "path"))
+
+    def test_paths(self):
+        a, c, p = self.assets.pk, self.cash.pk, self.petty.pk
+        self.assertEqual(self.paths()["100"], "/%d/%d/%d/" % (a, c, p))
+        self.assertEqual(
+            [acc.code for acc in accounts.subtree(self.cash).order_by("code")],
+            ["10", "100"])
+
+    def test_move_rewrites_subtree(self):
+        self.cash.parent = self.equity
+        self.cash.save()
+        e, c, p = self.equity.pk, self.cash.pk, self.petty.pk
+        paths = self.paths()
+        self.assertEqual(paths["10"], "/%d/%d/" % (e, c))
+        self.assertEqual(paths["100"], "/%d/%d/%d/" % (e, c, p))
+        self.assertEqual(paths["11"], "/%d/%d/" % (self.assets.pk,
+                                                   self.bank.pk))
+
+        # back to a root
+        self.cash.parent = None
+        self.cash.save()
+        self.assertEqual(self.paths()["100"], "/%d/%d/" % (c, p))
+
+    def test_cycle_is_rejected(self):
+        before = self.paths()
+        for parent in (self.petty, self.cash):
+            with self.subTest(parent=parent.code):
+                self.cash.parent = parent
+                with self.assertRaises(ValidationError):
+                    self.cash.save()
+                self.assertEqual(self.paths(), before)
+        # a stale parent instance: the check reads the stored path
+        bank = Account.objects.get(pk=self.bank.pk)
+        self.bank.parent = self.cash
+        self.bank.save()
+        self.cash.parent = bank
+        with self.assertRaises(ValidationError):
+            self.cash.save()
+
+    def test_subtree_balance(self):
+        load_journal([
+            entry(("100", 30, "D"), ("3", 30, "C")),
+            entry(("11", 50, "D"), ("10", 20, "C"), ("3", 30, "C")),
+        ])
+        self.assertEqual(accounts.subtree_balance(self.cash),
+                         {"debit": 30, "credit": 20, "balance": 10})
+        self.assertEqual(accounts.subtree_balance(self.assets),
+                         {"debit": 80, "credit": 20, "balance": 60})
+        self.assertEqual(accounts.subtree_balance(self.bank)["balance"], 50)
+        self.cash.parent = self.equity
+        self.cash.save()
+        self.assertEqual(accounts.subtree_balance(self.equity),
+                         {"debit": 30, "credit": 80, "balance": -50})
+
+
+##############
+# Archive
+
+@unittest.skipIf(archive.pa is None or columnar.np is None,
+                 "needs pyarrow and numpy")
+class ArchiveTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        overrides = override_settings(PSQLJ_ARCHIVE_DIR=location)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        # codes whose order differs between collations
+        codes = ["a100", "B200", "b300", "1000", "Z9"]
+        entries = []
+        for i in range(90):
+            tdate = datetime.date(2024, 1, 1) + datetime.timedelta(days=i)
+            debit, credit = codes[i % 5], codes[(i * 3 + 1) % 5]
+            entries.append(entry((debit, 10 + i, "D"), (credit, 10 + i, "C"),
+                                 tdate=tdate.isoformat()))
+        load_journal(entries)
+        checkpoints.close(datetime.date(2024, 2, 29))
+
+    def snapshot(self, start=None, end=None):
+        return {
+            "ledger": list(reports.account_ledger(start, end)),
+            "export": list(export.ledger_rows(start, end)),
+            "by_account": list(export.ledger_rows(start, end,
+                                                  by_account=True)),
+            "balances": archive.balances(start, end),
+            "columnar": columnar.ColumnarLedger.load(start, end).balances(),
+            "drift": balances.find_drift(),
+        }
+
+    def test_removed_month_is_merged(self):
+        ranges = [(None, None), (datetime.date(2024, 1, 10),
+                                 datetime.date(2024, 2, 10))]
+        before = [self.snapshot(*r) for r in ranges]
+        ledger = columnar.ColumnarLedger.load()
+        entry_ = archive.archive_month(datetime.date(2024, 1, 1), remove=True)
+        self.assertEqual(entry_.records, 62)
+        self.assertTrue(archive.has_removed())
+        for r, expected in zip(ranges, before):
+            with self.subTest(range=r):
+                after = self.snapshot(*r)
+                for key in expected:
+                    self.assertEqual(after[key], expected[key], key)
+        # the shared copy notices the removal
+        self.assertEqual(ledger.refresh(), 180)
+        self.assertEqual(ledger.balances(), before[0]["columnar"])
+
+    def test_archived_key_is_posted(self):
+        load_journal([balanced(key="jan", tdate="2024-01-20"),
+                      balanced(key="feb", tdate="2024-02-20")])
+        jan = Transaction.objects.get(idempotency_key="jan").pk
+        archive.archive_month(datetime.date(2024, 1, 1), remove=True)
+        self.assertFalse(Transaction.objects.filter(pk=jan).exists())
+        self.assertEqual(bulkload.posted_keys(["jan", "feb", "new"]), {
+            "jan": jan,
+            "feb": Transaction.objects.get(idempotency_key="feb").pk,
+        })
+        response = self.client.post(
+            reverse("psqlj:api-transactions-bulk"),
+            json.dumps([balanced(key="jan", tdate="2024-03-01")]),
+            content_type="application/json")
+        result = response.json()["results"][0]
+        self.assertEqual((result["status"], result["id"]), ("duplicate", jan))
+        self.assertFalse(Transaction.objects.filter(
+            idempotency_key="jan").exists())
+        # restored, the key is live again
+        archive.restore(datetime.date(2024, 1, 1))
+        self.assertFalse(ArchivedKey.objects.exists())
+        self.assertEqual(bulkload.posted_keys(["jan"]), {"jan": jan})
+
+    def test_ledger_pages(self):
+        archive.archive_month(datetime.date(2024, 1, 1), remove=True)
+        start = datetime.date(2024, 1, 10)
+        full = list(reports.account_ledger(start))
+        after = reports.ledger_key(full[40])
+        self.assertEqual(
+            list(reports.account_ledger(start, after=after, limit=30)),
+            full[41:71])
+
+    def test_by_account_order(self):
+        archive.archive_month(datetime.date(2024, 1, 1), remove=True)
+        rows = list(export.ledger_rows(by_account=True))
+        self.assertEqual(rows, sorted(rows, key=export.ledger_key(True)))
+
+
+##############
+# Columnar ledger
+
+@unittest.skipIf(columnar.np is None, "needs numpy")
+class ColumnarTests(TestCase):
+    def setUp(self):
+        load_journal(synthetic_entries(40, days=10))
+        columnar._ledgers.clear()
+        self.addCleanup(columnar._ledgers.clear)
+
+    @override_settings(PSQLJ_COLUMNAR_MAX_LEDGERS=2)
+    def test_ledgers_are_bounded(self):
+        days = [datetime.date(2024, 1, d) for d in (1, 2, 3)]
+        first = columnar.ledger(end=days[0])
+        columnar.ledger(end=days[1])
+        # using the first again makes the second the oldest
+        self.assertIs(columnar.ledger(end=days[0]), first)
+        columnar.ledger(end=days[2])
+        self.assertEqual(list(columnar._ledgers),
+                         [(None, days[0]), (None, days[2])])
+
+    def test_refresh_matches_load(self):
+        ledger = columnar.ledger()
+        load_journal(synthetic_entries(10, days=10))
+        self.assertEqual(ledger.refresh(), 20)
+        self.assertEqual(ledger.balances(),
+                         columnar.ColumnarLedger.load().balances())
+        self.assertEqual(ledger.rollup(),
+                         columnar.ColumnarLedger.load().rollup())
+
+    def test_readers_see_whole_snapshots(self):
+        ledger = columnar.ledger()
+        before = ledger.balances()
+        load_journal(synthetic_entries(10, days=10))
+        fetch = ledger._fetch
+        seen = []
+
+        def fetch_and_read(*args):
+            parts = fetch(*args)
+            # another thread aggregating while the refresh runs
+            seen.append((len(ledger), ledger.balances()))
+            return parts
+
+        with mock.patch.object(ledger, "_fetch", fetch_and_read):
+            ledger.refresh()
+        self.assertEqual(seen, [(80, before)])
+        self.assertEqual(len(ledger), 100)
+
+
+##############
+# Keyset paging
+
+@override_settings(PSQLJ_PAGE_CACHE_ENABLED=False)
+class KeysetListViewTests(TestCase):
+    url = reverse("psqlj:journal")
+
+    @classmethod
+    def setUpTestData(cls):
+        # 30 days for 120 transactions, so many share a tdate
+        load_journal([
+            balanced(10 + i, tdate=(datetime.date(2024, 1, 1)
+                                    + datetime.timedelta(days=i % 30)).isoformat())
+            for i in range(120)
+        ])
+        cls.expected = list(Transaction.objects.order_by(
+            "tdate", "id").values_list("id", flat=True))
+
+    def page(self, url=None, **params):
+        response = self.client.get(url or self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return [obj.pk for obj in response.context["object_list"]], response.context
+
+    def test_forward_and_back(self):
+        seen, pages, params = [], [], {}
+        while True:
+            ids, context = self.page(**params)
+            seen += ids
+            pages.append(ids)
+            if not context["has_next"]:
+                break
+            params = {"after": context["next_cursor"]}
+        self.assertEqual(seen, self.expected)
+        self.assertEqual([len(p) for p in pages], [50, 50, 20])
+
+        ids, context = self.page(before=context["previous_cursor"])
+        self.assertEqual(ids, pages[1])
+        ids, context = self.page(before=context["previous_cursor"])
+        self.assertEqual(ids, pages[0])
+        self.assertFalse(context["has_previous"])
+
+    def test_records_prefetched(self):
+        with self.assertNumQueries(2):
+            ids, context = self.page()
+        for txn in context["object_list"]:
+            self.assertEqual([r.record_num for r in txn.records], [1, 2])
+
+    def test_bad_cursor(self):
+        for cursor in ("x", "2024-01-01", "2024-01-01~x", "1~2~3"):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(self.url, {"after": cursor})
+                self.assertEqual(response.status_code, 404)
+
+    def test_two_input_list(self):
+        TwoInputFields.objects.bulk_create(
+            TwoInputFields(str1=str(i), str2=str(i)) for i in range(60))
+        expected = list(TwoInputFields.objects.order_by(
+            "pk").values_list("pk", flat=True))
+        url = reverse("psqlj:list")
+        ids, context = self.page(url)
+        self.assertEqual(ids, expected[:50])
+        ids, context = self.page(url, after=context["next_cursor"])
+        self.assertEqual(ids, expected[50:])
+        self.assertFalse(context["has_next"])
+
+
+class KeysetPagingTests(TestCase):
+    url = reverse("psqlj:api-transactions")
+
+    @classmethod
+    def setUpTestData(cls):
+        # 30 days for 120 transactions, so many share a tdate
+        load_journal(synthetic_entries(120, days=30))
+        cls.expected = list(Transaction.objects.order_by(
+            "tdate", "id").values_list("id", flat=True))
+
+    def page(self, **params):
+        response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        return [t["id"] for t in data["results"]], data
+
+    def test_forward_and_back(self):
+        seen, pages, cursor = [], [], None
+        while True:
+            ids, data = self.page(**({"after": cursor} if cursor else {}))
+            seen += ids
+            pages.append(ids)
+            cursor = data["next"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, self.expected)
+        self.assertEqual([len(p) for p in pages], [50, 50, 20])
+
+        ids, data = self.page(before=data["previous"])
+        self.assertEqual(ids, pages[1])
+        ids, data = self.page(before=data["previous"])
+        self.assertEqual(ids, pages[0])
+        self.assertIsNone(data["previous"])
+
+    def test_records_in_order(self):
+        ids, data = self.page()
+        for txn in data["results"]:
+            self.assertEqual([r["record_num"] for r in txn["records"]],
+                             list(range(1, len(txn["records"]) + 1)))
+
+    def test_bad_cursor(self):
+        for cursor in ("x", "2024-01-01", "2024-01-01~x", "1~2~3"):
+            with self.subTest(cursor=cursor):
+                response = self.client.get(self.url, {"after": cursor})
+                self.assertEqual(response.status_code, 404)
+
+
+##############
+# Background jobs
+
+class Flaky(Exception):
+    pass
+
+
+@jobs.task("test_ok", concurrency=1)
+def _test_ok(job, value=None):
+    jobs.progress(job, 1, 1)
+    return {"value": value}
+
+
+@jobs.task("test_flaky", max_attempts=2, retry_delay=60)
+def _test_flaky(job):
+    raise Flaky("try again")
+
+
+@jobs.task("test_bad")
+def _test_bad(job):
+    raise jobs.JobError("bad parameters")
+
+
+@jobs.task("test_sleep")
+def _test_sleep(job, seconds):
+    time.sleep(seconds)
+    return {}
+
+
+class JobTests(TestCase):
+    def test_run(self):
+        job = jobs.enqueue("test_ok", {"value": 3})
+        claimed = jobs.claim("w1", ["test_ok"])
+        self.assertEqual(claimed.pk, job.pk)
+        self.assertEqual((claimed.status, claimed.attempts, claimed.worker),
+                         (Job.RUNNING, 1, "w1"))
+        self.assertTrue(jobs.run(claimed))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.result, job.progress_done),
+                         (Job.DONE, {"value": 3}, 1))
+
+    def test_unknown_kind(self):
+        with self.assertRaises(jobs.JobError):
+            jobs.enqueue("no_such_kind")
+
+    def test_concurrency(self):
+        jobs.enqueue("test_ok")
+        jobs.enqueue("test_ok")
+        self.assertIsNotNone(jobs.claim("w1", ["test_ok"]))
+        self.assertIsNone(jobs.claim("w2", ["test_ok"]))
+
+    def test_delayed(self):
+        jobs.enqueue("test_ok", delay=60)
+        self.assertIsNone(jobs.claim("w1", ["test_ok"]))
+
+    def test_retry(self):
+        job = jobs.enqueue("test_flaky")
+        self.assertFalse(jobs.run(jobs.claim("w1", ["test_flaky"])))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.QUEUED, 1))
+        self.assertGreater(job.run_after, timezone.now())
+        self.assertIn("Flaky", job.error)
+        self.assertIsNone(jobs.claim("w1", ["test_flaky"]))
+
+        Job.objects.filter(pk=job.pk).update(run_after=timezone.now())
+        self.assertFalse(jobs.run(jobs.claim("w1", ["test_flaky"])))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.attempts), (Job.FAILED, 2))
+
+    def test_no_retry(self):
+        job = jobs.enqueue("test_bad")
+        self.assertFalse(jobs.run(jobs.claim("w1", ["test_bad"])))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message),
+                         (Job.FAILED, "bad parameters"))
+
+    def test_requeue_stale(self):
+        job = jobs.enqueue("test_ok", {"value": 1})
+        lost = jobs.claim("w1", ["test_ok"])
+        self.assertEqual(jobs.requeue_stale(60), 0)
+        Job.objects.filter(pk=job.pk).update(
+            heartbeat=timezone.now() - datetime.timedelta(seconds=61))
+        self.assertEqual(jobs.requeue_stale(60), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.QUEUED)
+
+        # the concurrency slot is free again
+        again = jobs.claim("w2", ["test_ok"])
+        self.assertEqual((again.pk, again.attempts), (job.pk, 2))
+        # the first worker finishing late records nothing
+        self.assertFalse(jobs.run(lost))
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.worker), (Job.RUNNING, "w2"))
+        self.assertTrue(jobs.run(again))
+
+    def test_stale_at_max_attempts(self):
+        job = jobs.enqueue("test_ok")
+        jobs.claim("w1", ["test_ok"])
+        Job.objects.filter(pk=job.pk).update(
+            attempts=job.max_attempts,
+            heartbeat=timezone.now() - datetime.timedelta(seconds=61))
+        jobs.requeue_stale(60)
+        job.refresh_from_db()
+        self.assertEqual((job.status, job.message),
+                         (Job.FAILED, "worker lost"))
+
+
+class JobHeartbeatTests(TransactionTestCase):
+    @override_settings(PSQLJ_JOB_STALE_AFTER=0.4)
+    def test_heartbeat_while_running(self):
+        job = jobs.enqueue("test_sleep", {"seconds": 1})
+        claimed = jobs.claim("w1", ["test_sleep"])
+        started = claimed.heartbeat
+        self.assertTrue(jobs.run(claimed))
+        job.refresh_from_db()
+        self.assertEqual(job.status, Job.DONE)
+        self.assertGreater(job.heartbeat, started)
+
+
+##############
+# Page cache
+
+class PageCacheTests(TestCase):
+    def setUp(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        overrides = override_settings(
+            CACHES={"default": {
+                "BACKEND":
+                    "django.core.cache.backends.filebased.FileBasedCache",
+                "LOCATION": location,
+            }},
+            PSQLJ_PAGE_CACHE="default",
+            PSQLJ_PAGE_CACHE_ENABLED=True,
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+    def test_version_changes_on_commit(self):
+        before = pagecache.version("journal")
+        twoinput = pagecache.version("twoinput")
+        with self.captureOnCommitCallbacks(execute=True):
+            with transaction.atomic():
+                Account.objects.create(code="1000", name="cash")
+                self.assertEqual(pagecache.version("journal"), before)
+        self.assertNotEqual(pagecache.version("journal"), before)
+        self.assertEqual(pagecache.version("twoinput"), twoinput)
+
+    def test_no_change_on_rollback(self):
+        before = pagecache.version("journal")
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            try:
+                with transaction.atomic():
+                    Account.objects.create(code="1000", name="cash")
+                    raise ValueError
+            except ValueError:
+                pass
+        self.assertEqual(callbacks, [])
+        self.assertEqual(pagecache.version("journal"), before)
+
+    def test_bulk_load_invalidates(self):
+        before = pagecache.version("journal")
+        with self.captureOnCommitCallbacks(execute=True):
+            load_journal([balanced()])
+        self.assertNotEqual(pagecache.version("journal"), before)
+
+    def test_page(self):
+        url = reverse("psqlj:journal")
+        self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+        self.assertEqual(self.client.get(url, {"x": 1})["X-Cache"], "MISS")
+        with self.captureOnCommitCallbacks(execute=True):
+            load_journal([balanced(key="shown")])
+        response = self.client.get(url)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+
+    def test_write_while_rendering(self):
+        url = reverse("psqlj:journal")
+        render = views.TransactionListView.get_context_data
+
+        def commit_meanwhile(view, **kwargs):
+            pagecache._bump("journal")
+            return render(view, **kwargs)
+
+        with mock.patch.object(views.TransactionListView, "get_context_data",
+                               commit_meanwhile):
+            self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+        # stored under the version it was rendered at, never served
+        self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+
+    def test_fragment(self):
+        url = reverse("psqlj:trial-balance")
+        load_journal([balanced()])
+        self.assertEqual(pagecache.stats()["journal"]["misses"], 0)
+        self.client.get(url)
+        self.client.get(url)
+        self.assertEqual(pagecache.stats()["journal"]["hits"], 1)
+
+    @override_settings(PSQLJ_PAGE_CACHE_ENABLED=False)
+    def test_disabled(self):
+        url = reverse("psqlj:journal")
+        self.client.get(url)
+        self.assertNotIn("X-Cache", self.client.get(url))
+
+    @unittest.skipIf("ASITE_CACHE_REDIS_URL" in os.environ,
+                     "the default is Redis")
+    def test_default_cache_is_shared(self):
+        from asite import settings as site_settings
+        default = site_settings.CACHES["default"]
+        self.assertEqual(default["BACKEND"],
+                         "django.core.cache.backends.filebased.FileBasedCache")
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        with override_settings(CACHES={"default": dict(
+                default, LOCATION=location)}):
+            self.assertTrue(pagecache.enabled())
+
+
+##############
+# Benchmark suite
+
+@override_settings(PSQLJ_PROFILE_SAMPLE_RATE=0.0)
+class BenchSuiteTests(TestCase):
+    def bench(self, **options):
+        out = io.StringIO()
+        call_command("bench_suite", sizes=[20], records=2, repeat=1,
+                     stdout=out, **options)
+        return out.getvalue()
+
+    def test_run_and_compare(self):
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location, True)
+        path = os.path.join(location, "bench.json")
+        self.bench(output=path)
+        with open(path) as f:
+            results = json.load(f)
+        cases = results["results"]["20"]
+        self.assertEqual(list(cases),
+                         [name for name, *_ in bench_suite.request_cases()])
+        # the seeded journal is rolled back
+        self.assertFalse(Transaction.objects.exists())
+
+        self.assertIn("No regressions.", self.bench(baseline=path,
+                                                     threshold=100))
+        for timing in cases.values():
+            timing["median_ms"] /= 1000
+        with open(path, "w") as f:
+            json.dump(results, f)
+        with self.assertRaisesMessage(CommandError, "slower than the baseline"):
+            self.bench(baseline=path)
+
+    def test_compare(self):
+        results = {"results": {"10": {
+            "a": {"median_ms": 2.5}, "b": {"median_ms": 1.1},
+            "new": {"median_ms": 1.0},
+        }}}
+        baseline = {"results": {"10": {
+            "a": {"median_ms": 1.0}, "b": {"median_ms": 1.0},
+        }}}
+        self.assertEqual(
+            [(case, regressed) for _, case, _, _, _, regressed
+             in benchmarks.compare(results, baseline, 0.2)],
+            [("a", True), ("b", False)])
+
+
+##############
+# Read replica routing
+#   asite/test_settings.py adds "replica" as a test mirror of "default",
+#   a second connection to the same test database. It does not see the
+#   uncommitted rows of a TestCase, hence TransactionTestCase.
+
+@unittest.skipUnless("replica" in settings.DATABASES,
+                     "needs the replica test mirror, "
+                     "see --settings=asite.test_settings")
+@override_settings(PSQLJ_REPLICA_ALIAS="replica", PSQLJ_PAGE_CACHE_ENABLED=False)
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = "__all__"
+
+    def setUp(self):
+        replicas._lag_cache.clear()
+        self.addCleanup(replicas._lag_cache.clear)
+        load_journal([balanced(key="a")])
+
+    def journal_queries(self, *args, **kwargs):
+        """Journal queries of a GET, per alias."""
+        captured = {}
+        with CaptureQueriesContext(connections["default"]) as default, \
+                CaptureQueriesContext(connections["replica"]) as replica:
+            response = self.client.get(*args, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        for alias, context in (("default", default), ("replica", replica)):
+            captured[alias] = [q["sql"] for q in context.captured_queries
+                               if "psql_journal_" in q["sql"]]
+        return captured
+
+    def test_marked_views_read_replica(self):
+        for name in ("psqlj:journal", "psqlj:trial-balance",
+                     "psqlj:api-transactions"):
+            with self.subTest(view=name):
+                queries = self.journal_queries(reverse(name))
+                self.assertEqual(queries["default"], [])
+                self.assertTrue(queries["replica"])
+
+    def test_other_reads_use_default(self):
+        self.assertEqual(router.db_for_read(Transaction), "default")
+        job = jobs.enqueue("test_ok")
+        queries = self.journal_queries(reverse("psqlj:api-job", args=[job.pk]))
+        self.assertEqual(queries["replica"], [])
+        self.assertTrue(queries["default"])
+
+    def test_write_pins_client(self):
+        response = self.client.post(
+            reverse("psqlj:api-transactions-bulk"),
+            json.dumps([balanced(key="b")]), content_type="application/json")
+        self.assertEqual(response.json()["created"], 1)
+        cookie = response.cookies[replicas.COOKIE]
+        self.assertEqual(cookie["max-age"], replicas.sticky())
+        # the test client sends the cookie back
+        queries = self.journal_queries(reverse("psqlj:journal"))
+        self.assertEqual(queries["replica"], [])
+        self.assertTrue(queries["default"])
+
+    def test_writes_and_atomic_reads_use_default(self):
+        state = replicas.RequestState()
+        state.read = True
+        token = replicas._state.set(state)
+        self.addCleanup(replicas._state.reset, token)
+        self.assertEqual(router.db_for_read(Transaction), "replica")
+        with transaction.atomic():
+            self.assertEqual(router.db_for_read(Transaction), "default")
+        self.assertEqual(router.db_for_write(Transaction), "default")
+        self.assertEqual(router.db_for_read(Transaction), "default")
+        self.assertTrue(state.wrote)
+
+    def test_fallback(self):
+        cases = [
+            ("no replica", override_settings(PSQLJ_REPLICA_ALIAS="missing")),
+            ("lagging", override_settings(PSQLJ_REPLICA_MAX_LAG=-1)),
+            ("unreachable", mock.patch.object(
+                replicas, "_measure", side_effect=DatabaseError)),
+        ]
+        for name, context in cases:
+            with self.subTest(name), context:
+                replicas._lag_cache.clear()
+                queries = self.journal_queries(reverse("psqlj:journal"))
+                self.assertEqual(queries["replica"], [])
+                self.assertTrue(queries["default"])
+
+
+##############
+# Balance checks
+
+class AuditJournalTests(TestCase):
+    def audit(self, *args):
+        out, err = io.StringIO(), io.StringIO()
+        try:
+            call_command("audit_journal", *args, stdout=out, stderr=err)
+        except CommandError as e:
+            return out.getvalue(), str(e)
+        return out.getvalue(), err.getvalue()
+
+    def test_output(self):
+        load_journal([balanced()])
+        out, err = self.audit()
+        self.assertEqual(out, "")
+        self.assertIn("All transactions balance.", err)
+
+        # written past the checks; deleted again before TestCase checks
+        #   the deferred constraints (the trigger on PostgreSQL)
+        txn = Transaction.objects.create(tdate=datetime.date(2024, 2, 1),
+                                         desc="bad")
+        bad = TransactionRecord.objects.create(
+            transaction=txn, record_num=1, amount=70,
+            account=Account.objects.get(code="1000"))
+        self.addCleanup(bad.delete)
+        out, err = self.audit()
+        self.assertEqual(out, "%d debit 70 credit 0\n" % txn.pk)
+        self.assertEqual(err, "1 unbalanced transactions.")
+        self.assertEqual(self.audit("--ids-only")[0], "%d\n" % txn.pk)
+        out, err = self.audit("--end", "2024-01-31")
+        self.assertEqual(out, "")
+        self.assertIn("All transactions balance.", err)
+
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class BalanceTriggerTests(TransactionTestCase):
+    """The deferred trigger of migration 0011 only runs at a real COMMIT."""
+
+    def setUp(self):
+        self.cash = Account.objects.create(code="1000")
+        self.bank = Account.objects.create(code="2000")
+
+    def record(self, txn, num, account, amount, side):
+        return TransactionRecord.objects.create(
+            transaction=txn, record_num=num, account=account, amount=amount,
+            side=side)
+
+    def test_unbalanced_fails_at_commit(self):
+        self.assertTrue(audit.trigger_installed())
+        with self.assertRaises(IntegrityError) as cm:
+            with transaction.atomic():
+                txn = Transaction.objects.create(
+                    tdate=datetime.date(2024, 1, 1), desc="bad")
+                self.record(txn, 1, self.cash, 100, "D")
+                self.record(txn, 2, self.bank, 99, "C")
+                # the statements themselves pass
+                self.assertEqual(TransactionRecord.objects.count(), 2)
+        self.assertIn("unbalanced transactions: %d" % txn.pk,
+                      str(cm.exception))
+        self.assertFalse(Transaction.objects.exists())
+
+    def test_balanced_over_several_statements(self):
+        with transaction.atomic():
+            txn = Transaction.objects.create(
+                tdate=datetime.date(2024, 1, 1), desc="ok")
+            debit = self.record(txn, 1, self.cash, 100, "D")
+            # unbalanced in between
+            self.record(txn, 2, self.bank, 60, "C")
+            self.record(txn, 3, self.bank, 40, "C")
+        with transaction.atomic():
+            TransactionRecord.objects.filter(pk=debit.pk).update(amount=150)
+            TransactionRecord.objects.filter(record_num=3).update(amount=90)
+        self.assertEqual(list(audit.unbalanced()), [])
+
+        # an update the Python checks never see
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                TransactionRecord.objects.filter(pk=debit.pk).update(
+                    amount=1)
+        debit.refresh_from_db()
+        self.assertEqual(debit.amount, 150)
+
+
+##############
+# Monthly materialized view
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class MatviewTests(TestCase):
+    def setUp(self):
+        # codes whose order differs between collations
+        codes = ["a100", "B200", "b300", "1000", "Z9"]
+        load_journal(entry((codes[i % 5], 10 + i, "D"),
+                           (codes[(i + 2) % 5], 10 + i, "C"),
+                           tdate="2024-%02d-15" % (1 + i % 3))
+                     for i in range(30))
+        matviews.create()
+
+    def test_same_rows_by_code_point(self):
+        start, end = datetime.date(2024, 2, 1), datetime.date(2024, 3, 31)
+        reads = {
+            "trial_balance": lambda: reports.trial_balance(start, end),
+            "period_close": lambda: reports.period_close(start, end),
+            "monthly_totals": lambda: reports.monthly_totals(start, end),
+        }
+        for name, read in reads.items():
+            with self.subTest(name):
+                self.assertTrue(matviews.usable(start, end, opening=True))
+                rows = list(read())
+                with override_settings(PSQLJ_MATVIEW_MAX_AGE=0):
+                    exact = list(read())
+                accounts = [r["account"] for r in rows]
+                self.assertEqual(accounts, sorted(accounts))
+                if name == "monthly_totals":
+                    self.assertTrue(all(r["records"] for r in rows))
+                    rows = [{**r, "records": None} for r in rows]
+                key = lambda r: (r["account"], r.get("month"))
+                self.assertEqual(sorted(rows, key=key),
+                                 sorted(exact, key=key))
+
+    def test_query_reads_in_chunks(self):
+        rows = matviews._query("SELECT generate_series(1, 5) AS n", [],
+                               chunk_size=2)
+        self.assertEqual([r["n"] for r in rows], [1, 2, 3, 4, 5])
+
+
+##############
+# Reports
+
+@override_settings(PSQLJ_PAGE_CACHE_ENABLED=False)
+class ReportTests(TestCase):
+    start, end = datetime.date(2024, 2, 1), datetime.date(2024, 3, 31)
+
+    def setUp(self):
+        # codes whose order differs between collations
+        codes = ["a100", "B200", "b300", "1000", "Z9"]
+        load_journal(entry((codes[i % 5], 10 + i, "D"),
+                           (codes[(i * 3 + 1) % 5], 10 + i, "C"),
+                           tdate="2024-%02d-%02d" % (1 + i % 3, 1 + i % 28))
+                     for i in range(40))
+
+    def records(self):
+        return TransactionRecord.objects.values_list(
+            "account__code", "transaction__tdate", "transaction_id",
+            "record_num", "side", "amount")
+
+    def both(self, test):
+        """Run test without, then with checkpoints before the range."""
+        for close in (None, datetime.date(2024, 1, 31)):
+            if close:
+                checkpoints.close(close)
+            with self.subTest(checkpoint=close):
+                test()
+
+    def test_trial_balance(self):
+        def test():
+            rows = list(reports.trial_balance(end=self.end))
+            self.assertEqual(rows, archive.balances(end=self.end))
+            self.assertEqual([r["account"] for r in rows],
+                             ["1000", "B200", "Z9", "a100", "b300"])
+        self.both(test)
+
+    def test_period_close(self):
+        before = {r["account"]: r["balance"] for r in archive.balances(
+            end=self.start - datetime.timedelta(days=1))}
+        expected = [
+            {"account": r["account"], "opening": before.get(r["account"], 0),
+             "debit": r["debit"], "credit": r["credit"],
+             "closing": before.get(r["account"], 0) + r["balance"]}
+            for r in archive.balances(self.start, self.end)]
+        self.both(lambda: self.assertEqual(
+            list(reports.period_close(self.start, self.end)), expected))
+
+    def test_monthly_totals(self):
+        totals = defaultdict(lambda: [0, 0])
+        for code, tdate, _, _, side, amount in self.records():
+            if self.start <= tdate <= self.end:
+                totals[code, tdate.replace(day=1)][side == "C"] += amount
+        expected = [{"account": code, "month": month, "debit": d,
+                     "credit": c, "records": None}
+                    for (code, month), (d, c) in sorted(totals.items())]
+        self.both(lambda: self.assertEqual(
+            list(reports.monthly_totals(self.start, self.end)), expected))
+
+    def test_account_ledger(self):
+        balance = defaultdict(int)
+        expected = []
+        for code, tdate, txn, num, side, amount in sorted(self.records()):
+            balance[code] += amount if side == "D" else -amount
+            if tdate >= self.start:
+                expected.append((code, tdate, txn, num, balance[code]))
+
+        def test():
+            rows = list(reports.account_ledger(self.start))
+            self.assertEqual([reports.ledger_key(r) + (r["balance"],)
+                              for r in rows], expected)
+            # paged, the balances carry over from page to page
+            pages, after = [], None
+            while True:
+                page = list(reports.account_ledger(self.start, after=after,
+                                                   limit=7))
+                if not page:
+                    break
+                pages += page
+                after = reports.ledger_key(page[-1])
+            self.assertEqual(pages, rows)
+        self.both(test)
+
+    def test_ledger_view_pages(self):
+        url = reverse("psqlj:account-ledger")
+        full = list(reports.account_ledger())
+        shown, query = [], {}
+        with mock.patch.object(views.AccountLedgerView, "paginate_by", 15):
+            while True:
+                page = self.client.get(url, query).context["rows"]
+                self.assertLessEqual(len(page), 15)
+                shown += page
+                if not page.next_query:
+                    break
+                query = QueryDict(page.next_query)
+        self.assertEqual(shown, full)
+        self.assertEqual(self.client.get(url, {"after": "x"}).status_code,
+                         404)
+
+
+##############
+# Period-close checkpoints
+
+class CheckpointTests(TestCase):
+    def setUp(self):
+        load_journal(synthetic_entries(60, n_records=3, n_accounts=6,
+                                       start=datetime.date(2024, 1, 1),
+                                       days=90))
+
+    def stored(self, checkpoint):
+        return {a: (d, c) for a, d, c in checkpoint.balances.values_list(
+            "account_id", "debit", "credit")}
+
+    def test_close_matches_raw_sums(self):
+        jan = checkpoints.close(datetime.date(2024, 1, 31))
+        # the second one starts from the first
+        feb = checkpoints.close(datetime.date(2024, 2, 29))
+        # a back-dated write is added to both
+        load_journal([balanced(amount=7, tdate="2024-01-20")])
+        for checkpoint in (jan, feb):
+            with self.subTest(checkpoint=checkpoint):
+                derived = checkpoints.derive(checkpoint.period_end)
+                self.assertEqual(self.stored(checkpoint), derived)
+                self.assertEqual(
+                    checkpoints.balances_at(checkpoint.period_end),
+                    {a: d - c for a, (d, c) in derived.items()})
+                self.assertEqual(checkpoints.verify(checkpoint), [])
+
+    def verify_command(self, *args):
+        out = io.StringIO()
+        try:
+            call_command("verify_checkpoints", *args, stdout=out)
+        except CommandError as e:
+            return out.getvalue(), str(e)
+        return out.getvalue(), None
+
+    def test_verify_and_repair(self):
+        checkpoint = checkpoints.close(datetime.date(2024, 2, 29))
+        rows = checkpoint.balances.order_by("account_id")
+        changed, removed = rows[0], rows[1]
+        CheckpointBalance.objects.filter(pk=changed.pk).update(
+            debit=F("debit") + 5)
+        removed.delete()
+        expected = checkpoints.derive(checkpoint.period_end)
+        self.assertEqual(checkpoints.verify(checkpoint), [
+            (changed.account_id, (changed.debit + 5, changed.credit),
+             expected[changed.account_id]),
+            (removed.account_id, (0, 0), expected[removed.account_id]),
+        ])
+
+        out, error = self.verify_command()
+        self.assertIn("account %d: stored" % changed.account_id, out)
+        self.assertEqual(error, "1 checkpoints differ from the journal.")
+        # nothing was changed
+        self.assertEqual(len(checkpoints.verify(checkpoint)), 2)
+
+        out, error = self.verify_command("2024-02-29", "--repair")
+        self.assertIsNone(error)
+        self.assertIn("Repaired 2024-02-29.", out)
+        self.assertEqual(checkpoints.verify(checkpoint), [])
+        self.assertEqual(self.stored(checkpoint), expected)
+        self.assertIn("Checkpoints are consistent.",
+                      self.verify_command()[0])
+
+
+##############
+# Search
+
+class SearchTests(TestCase):
+    def setUp(self):
+        cash = Account.objects.create(code="1000", name="Cash")
+        bank = Account.objects.create(code="2000", name="Bank")
+        self.ids = {}
+        for desc in ["office rent", "rent", "groceries", "Rent March"]:
+            load_journal([balanced()])
+            txn = Transaction.objects.latest("id")
+            Transaction.objects.filter(pk=txn.pk).update(desc=desc)
+            self.ids[desc] = txn.pk
+        TransactionRecord.objects.filter(
+            transaction_id=self.ids["groceries"], account=cash).update(
+                account=bank)
+
+    def found(self, **kwargs):
+        return [(txn.desc, rank) for txn, rank in
+                search.search(**kwargs)["results"]]
+
+    def test_ranking(self):
+        found = self.found(q="rent")
+        self.assertEqual(sorted(d for d, _ in found),
+                         ["Rent March", "office rent", "rent"])
+        # best first, ties newest first
+        keys = [(-rank, -self.ids[d]) for d, rank in found]
+        self.assertEqual(keys, sorted(keys))
+        self.assertEqual(sorted(d for d, _ in self.found(account="cas")),
+                         ["Rent March", "office rent", "rent"])
+        self.assertEqual(self.found(q="groceries", account="1000"), [])
+        results = search.search(q="groceries")["results"]
+        self.assertEqual([r.account.code for r in results[0][0].records],
+                         ["2000", "2000"])
+
+    def test_orm_fallback(self):
+        rows = search._search_orm(connection, "rent", "", None, 10)
+        self.assertEqual(rows, [(self.ids["rent"], 3.0),
+                                (self.ids["Rent March"], 2.0),
+                                (self.ids["office rent"], 1.0)])
+        rows = search._search_orm(connection, "rent", "", (2.0, 10 ** 9), 10)
+        self.assertEqual([pk for pk, _ in rows],
+                         [self.ids["Rent March"], self.ids["office rent"]])
+
+    def test_paging_across_ties(self):
+        load_journal([balanced() for _ in range(7)])
+        Transaction.objects.filter(desc="test").update(desc="tied entry")
+        expected = list(Transaction.objects.filter(
+            desc="tied entry").order_by("-id").values_list("id", flat=True))
+        shown, after = [], None
+        while True:
+            page = search.search(q="tied", after=after, limit=3)
+            self.assertLessEqual(len(page["results"]), 3)
+            shown += [txn.pk for txn, _ in page["results"]]
+            after = page["next"]
+            if not after:
+                break
+        self.assertEqual(shown, expected)
+        with self.assertRaises(ValueError):
+            search.search(q="tied", after="nope")
+
+
+##############
+# Creating many rows at once
+
+@override_settings(PSQLJ_PAGE_CACHE_ENABLED=False)
+class MultipleCreateViewTests(TestCase):
+    url = reverse("psqlj:multiple-add")
+
+    def post(self, rows, total=None):
+        data = {"form-TOTAL_FORMS": total or len(rows),
+                "form-INITIAL_FORMS": 0}
+        for i, (str1, str2) in enumerate(rows):
+            data["form-%d-str1" % i] = str1
+            data["form-%d-str2" % i] = str2
+        return self.client.post(self.url, data)
+
+    def test_get_rows(self):
+        response = self.client.get(self.url, {"rows": 3})
+        self.assertEqual(len(response.context["formset"].forms), 3)
+        response = self.client.get(self.url, {"rows": "x"})
+        self.assertEqual(len(response.context["formset"].forms),
+                         views.TwoInputMultipleCreateView.extra)
+
+    def test_create_stripped(self):
+        response = self.post([(" 1000", "cash "), ("", ""), ("  ", " "),
+                              ("2000", "bank")])
+        self.assertRedirects(response, reverse("psqlj:list"),
+                             fetch_redirect_response=False)
+        self.assertEqual(
+            list(TwoInputFields.objects.order_by("id").values_list(
+                "str1", "str2")),
+            [("1000", "cash"), ("2000", "bank")])
+
+    def test_invalid_row(self):
+        response = self.post([("1000", "cash"), ("x" * 51, "long")])
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context["formset"].forms[1].errors)
+        self.assertFalse(TwoInputFields.objects.exists())
+
+    @override_settings(PSQLJ_BATCH_MAX_ROWS=2)
+    def test_too_many_rows(self):
+        response = self.post([("a", "b")] * 3)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(TwoInputFields.objects.exists())
+
+
+##############
+# Async JSON API
+
+class AsyncTransactionListTests(TestCase):
+    url = reverse("psqlj:api-transactions")
+
+    def setUp(self):
+        load_journal(entry(("1000", 5, "D"), ("1001", 2, "C"), ("1002", 3, "C"),
+                           tdate="2024-01-%02d" % (10 - i % 4))
+                     for i in range(8))
+
+    @mock.patch.object(api.AsyncTransactionListView, "paginate_by", 3)
+    async def test_pages_in_order(self):
+        expected = [pk async for pk in Transaction.objects.order_by(
+            "tdate", "id").values_list("id", flat=True)]
+        shown, pages, query = [], [], {}
+        while True:
+            response = await self.async_client.get(self.url, query)
+            self.assertEqual(response.status_code, 200)
+            data = response.json()
+            self.assertLessEqual(len(data["results"]), 3)
+            for txn in data["results"]:
+                self.assertEqual([r["record_num"] for r in txn["records"]],
+                                 [1, 2, 3])
+            shown += [txn["id"] for txn in data["results"]]
+            pages.append(data)
+            if not data["next"]:
+                break
+            query = {"after": data["next"]}
+        self.assertEqual(shown, expected)
+        # and back from the last page
+        response = await self.async_client.get(
+            self.url, {"before": pages[-1]["previous"]})
+        self.assertEqual(response.json()["results"], pages[-2]["results"])
+
+
+##############
+# Request profiling
+
+@override_settings(PSQLJ_PROFILE_SAMPLE_RATE=1.0,
+                   PSQLJ_PAGE_CACHE_ENABLED=False)
+class RequestProfileTests(TestCase):
+    def get(self, *args, **kwargs):
+        with self.assertLogs("psql_journal.profile", "INFO") as logs:
+            response = self.client.get(*args, **kwargs)
+        self.assertEqual(len(logs.records), 1)
+        return response, json.loads(logs.records[0].getMessage())
+
+    def test_server_timing(self):
+        load_journal([balanced()])
+        response, line = self.get(reverse("psqlj:journal"))
+        timing = response["Server-Timing"]
+        self.assertTrue(timing.startswith(
+            'sql;dur=%s;desc="%d queries, %d duplicates"'
+            % (line["sql_ms"], line["queries"], line["duplicates"])))
+        self.assertIn("render;dur=", timing)
+        self.assertTrue(timing.endswith("total;dur=%s" % line["total_ms"]))
+        self.assertGreater(line["queries"], 0)
+        self.assertEqual((line["view"], line["status"]),
+                         ("psqlj:journal", 200))
+
+    @override_settings(PSQLJ_PROFILE_SAMPLE_RATE=0.0)
+    def test_not_sampled(self):
+        response = self.client.get(reverse("psqlj:journal"))
+        self.assertNotIn("Server-Timing", response)
+
+    def test_forms_are_timed_lazily(self):
+        url = reverse("psqlj:multiple-add")
+        response, _ = self.get(url, {"rows": 3})
+        self.assertIn("forms;dur=", response["Server-Timing"])
+
+        # the bulk path never builds the forms of the rows
+        data = {"form-TOTAL_FORMS": 2, "form-INITIAL_FORMS": 0,
+                "form-0-str1": "a", "form-0-str2": "b",
+                "form-1-str1": "c", "form-1-str2": "d"}
+        with mock.patch("django.forms.formsets.BaseFormSet._construct_form",
+                        side_effect=AssertionError("built a form")):
+            with self.assertLogs("psql_journal.profile", "INFO"):
+                response = self.client.post(url, data)
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(TwoInputFields.objects.count(), 2)
+        self.assertIn("forms;dur=", response["Server-Timing"])
+        self.assertIsNone(instrumentation.current_profile())
+
+
+##############
+# Ledger export
+
+@override_settings(PSQLJ_PAGE_CACHE_ENABLED=False)
+class LedgerExportTests(TestCase):
+    url = reverse("psqlj:ledger-export")
+
+    def setUp(self):
+        load_journal(entry(("1000", 10 + i, "D"), ("2000", 10 + i, "C"),
+                           tdate="2024-01-%02d" % (20 - i % 7))
+                     for i in range(12))
+
+    def expected(self, **filters):
+        return [[str(v) for v in row]
+                for row in export.ledger_queryset(**filters)]
+
+    def test_csv_is_streamed_in_order(self):
+        response = self.client.get(self.url, {"start": "2024-01-15",
+                                              "account": "2000"})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response["Content-Type"], "text/csv")
+        rows = list(csv.reader(io.StringIO(
+            b"".join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], export.LEDGER_HEADER)
+        expected = self.expected(start=datetime.date(2024, 1, 15),
+                                 account="2000")
+        self.assertEqual(rows[1:], expected)
+        self.assertEqual(len(expected), 11)
+        self.assertEqual(rows[1:], sorted(
+            rows[1:], key=lambda r: (r[1], int(r[0]), int(r[3]))))
+
+    def test_bad_filter(self):
+        response = self.client.get(self.url, {"start": "2024-02-01",
+                                              "end": "2024-01-01"})
+        self.assertEqual(response.status_code, 400)
+
+    @unittest.skipIf(importlib.util.find_spec("openpyxl") is None,
+                     "needs openpyxl")
+    def test_xlsx(self):
+        from openpyxl import load_workbook
+        response = self.client.get(self.url, {"format": "xlsx"})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("ledger.xlsx", response["Content-Disposition"])
+        sheet = load_workbook(io.BytesIO(
+            b"".join(response.streaming_content)))["Ledger"]
+        rows = [[str(v) for v in row]
+                for row in sheet.iter_rows(values_only=True)]
+        self.assertEqual(rows[0], export.LEDGER_HEADER)
+        self.assertEqual(len(rows) - 1, 24)
+
+    @unittest.skipUnless(importlib.util.find_spec("openpyxl") is None,
+                         "openpyxl is installed")
+    def test_xlsx_without_openpyxl(self):
+        response = self.client.get(self.url, {"format": "xlsx"})
+        self.assertEqual(response.status_code, 400)
+
+
+##############
+# Journal partitions
+#   The partitions are DDL run by the sync trigger, hence
+#   TransactionTestCase.
+
+@unittest.skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+class JournalPartitionTests(TransactionTestCase):
+    def setUp(self):
+        call_command("journal_partitions", "--create", stdout=io.StringIO())
+        self.addCleanup(call_command, "journal_partitions", "--drop",
+                        stdout=io.StringIO())
+
+    def count(self, table):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT count(*) FROM %s" % table)
+            return cursor.fetchone()[0]
+
+    def partitions(self):
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "WHERE i.inhparent = 'lzy_journal_part'::regclass "
+                "ORDER BY c.relname")
+            return [name for name, in cursor.fetchall()]
+
+    def test_insert_creates_month(self):
+        self.assertEqual(self.partitions(), ["lzy_journal_part_default"])
+        load_journal([balanced(tdate="2024-05-17")])
+        self.assertEqual(self.partitions(), ["lzy_journal_part_202405",
+                                             "lzy_journal_part_default"])
+        self.assertEqual(self.count("lzy_journal_part_202405"), 2)
+        self.assertEqual(self.count("lzy_journal_part_default"), 0)
+
+        # moving a transaction to another month moves its rows
+        Transaction.objects.update(tdate=datetime.date(2024, 6, 1))
+        self.assertEqual(self.count("lzy_journal_part_202405"), 0)
+        self.assertEqual(self.count("lzy_journal_part_202406"), 2)
+
+    def test_create_fills_months(self):
+        call_command("journal_partitions", "--drop", stdout=io.StringIO())
+        load_journal([balanced(tdate="2024-03-31"),
+                      balanced(tdate="2024-04-01")])
+        call_command("journal_partitions", "--create", stdout=io.StringIO())
+        self.assertEqual(self.count("lzy_journal_part_202403"), 2)
+        self.assertEqual(self.count("lzy_journal_part_202404"), 2)
+        self.assertEqual(self.count("lzy_journal_part_default"), 0)
@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 app_name = "psqlj"
 urlpatterns = [
@@ -9,6 +9,32 @@ urlpatterns = [
     path("madd/", views.TwoInputMultipleCreateView.as_view(), 
         name="multiple-add"),
     path("list/", views.TwoInputListView.as_view(),     name="list"),
+    path("journal/", views.TransactionListView.as_view(), name="journal"),
+    path("journal/export/", views.LedgerExportView.as_view(),
+        name="ledger-export"),
+    path("reports/trial-balance/", views.TrialBalanceView.as_view(),
+        name="trial-balance"),
+    path("reports/ledger/", views.AccountLedgerView.as_view(),
+        name="account-ledger"),
+    path("reports/period-close/", views.PeriodCloseView.as_view(),
+        name="period-close"),
+    path("reports/monthly/", views.MonthlyTotalsView.as_view(),
+        name="monthly-totals"),
+    path("search/", views.SearchView.as_view(), name="search"),
+
+    path("api/transactions/", api.AsyncTransactionListView.as_view(),
+        name="api-transactions"),
+    path("api/transactions/bulk/", api.post_transactions,
+        name="api-transactions-bulk"),
+    path("api/transactions/<int:pk>/", api.transaction_detail,
+        name="api-transaction"),
+    path("api/balances/", api.account_balances, name="api-balances"),
+    path("api/search/", api.search_transactions, name="api-search"),
+    path("api/uploads/", api.upload_journal, name="api-uploads"),
+    path("api/uploads/<int:pk>/", api.upload_journal, name="api-upload"),
+    path("api/jobs/", api.enqueue_job, name="api-jobs"),
+    path("api/jobs/<int:pk>/", api.job_status, name="api-job"),
+    path("api/jobs/<int:pk>/file/", api.job_file, name="api-job-file"),
 
     path("tested1/", views.MainFormView.as_view(),   name="tested1"),
     path("test2/", views.MasterCreateView.as_view(), name="test2"),
@@ -1,7 +1,17 @@
+import functools
+import threading
 
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.db.models import ForeignKey, Q
+from django.dispatch import receiver
 from django.forms import (
+    BaseInlineFormSet,
+    ModelChoiceField,
     ModelForm,
+    TextInput,
     modelform_factory,
+    modelformset_factory,
     inlineformset_factory,
 )
 
@@ -16,12 +26,181 @@ class PhModelForm(ModelForm):
             formfield.widget.attrs["placeholder"] = formfield.help_text
             formfield.widget.attrs.update({"class": "form-control"})
 
+    def _get_validation_exclusions(self):
+        # A CodeChoiceField value was already taken from its queryset (for
+        # a formset, in one query), don't let ForeignKey.validate() look
+        # it up again per row. Other fields are validated as usual.
+        exclude = super()._get_validation_exclusions()
+        for name, formfield in self.fields.items():
+            if isinstance(formfield, CodeChoiceField):
+                exclude.add(name)
+        return exclude
+
+
+class CodeChoiceField(ModelChoiceField):
+    """
+    ForeignKey entered as a code in a text input (e.g. Account.code)
+    instead of a <select> of the whole table.
+    choices_cache ({code: obj}) and pk_cache ({pk: obj}) are filled by
+    CodeInlineFormSet so a formset resolves all its codes, typed or
+    shown for existing rows, with one query.
+    """
+    widget = TextInput
+    code_field = "code"
+
+    def __init__(self, queryset, **kwargs):
+        kwargs["to_field_name"] = self.code_field
+        super().__init__(queryset, **kwargs)
+        self.choices_cache = None
+        self.pk_cache = None
+
+    def prepare_value(self, value):
+        if hasattr(value, "_meta"):
+            return getattr(value, self.code_field)
+        if value and not isinstance(value, str):
+            # a primary key from the instance
+            if self.pk_cache is not None and value in self.pk_cache:
+                obj = self.pk_cache[value]
+            else:
+                obj = self.queryset.filter(pk=value).first()
+            return getattr(obj, self.code_field) if obj else value
+        return value
+
+    def to_python(self, value):
+        if self.choices_cache is not None and value in self.choices_cache:
+            return self.choices_cache[value]
+        return super().to_python(value)
+
+
+class CodeInlineFormSet(BaseInlineFormSet):
+    """
+    Resolve the CodeChoiceField values of all forms in one query: the
+    codes typed into bound forms and the keys of the existing rows.
+    """
+
+    def _code_caches(self):
+        if not hasattr(self, "_code_cache_map"):
+            self._code_cache_map = {}
+            for name, field in self.form.base_fields.items():
+                if not isinstance(field, CodeChoiceField):
+                    continue
+                codes = set()
+                if self.is_bound:
+                    codes = {
+                        self.data.get("%s-%s" % (self.add_prefix(i), name))
+                        for i in range(self.total_form_count())
+                    } - {None, ""}
+                attname = self.model._meta.get_field(name).attname
+                pks = {getattr(obj, attname)
+                       for obj in self.get_queryset()} - {None}
+                if not codes and not pks:
+                    continue
+                objs = list(field.queryset.filter(
+                    Q(**{field.code_field + "__in": codes})
+                    | Q(pk__in=pks)))
+                self._code_cache_map[name] = (
+                    {getattr(obj, field.code_field): obj for obj in objs},
+                    {obj.pk: obj for obj in objs},
+                )
+        return self._code_cache_map
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        for name, (by_code, by_pk) in self._code_caches().items():
+            form.fields[name].choices_cache = by_code
+            form.fields[name].pk_cache = by_pk
+        return form
+
+
+##############
+# Process-level cache of generated form/formset classes.
+#   The factories build a new class through the ModelForm metaclass on
+#   every call; the result only depends on the arguments, so build once.
+#   Set PSQLJ_FORM_CLASS_CACHE = False to turn it off.
+
+_class_cache = {}
+_class_cache_lock = threading.Lock()
+
+
+def _freeze(value):
+    """Turn lists/dicts of arguments into a hashable key."""
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    hash(value)
+    return value
+
+
+def cached_factory(factory, *args, **kwargs):
+    """Call factory(*args, **kwargs) once per distinct set of arguments."""
+    if not getattr(settings, "PSQLJ_FORM_CLASS_CACHE", True):
+        return factory(*args, **kwargs)
+    try:
+        key = (factory, _freeze(args), _freeze(kwargs))
+    except TypeError:
+        # something unhashable (e.g. a widget instance), do not cache
+        return factory(*args, **kwargs)
+    cls = _class_cache.get(key)
+    if cls is None:
+        with _class_cache_lock:
+            cls = _class_cache.get(key)
+            if cls is None:
+                cls = _class_cache[key] = factory(*args, **kwargs)
+    return cls
+
+
+@functools.lru_cache(maxsize=None)
+def first_foreign_key(model):
+    """The first ForeignKey field of model, or None."""
+    for f in model._meta.fields:
+        if isinstance(f, ForeignKey):
+            return f
+    return None
+
+
+def clear_form_class_cache():
+    """Forget all generated classes (for tests and after reloads)."""
+    with _class_cache_lock:
+        _class_cache.clear()
+    first_foreign_key.cache_clear()
+
+
+@receiver(setting_changed)
+def _clear_on_setting_changed(setting, **kwargs):
+    if setting == "PSQLJ_FORM_CLASS_CACHE":
+        clear_form_class_cache()
+
 
 def ph_modelform_factory(model, form=PhModelForm, **kwargs):
     """
     Modify Django's modelform_factory()
     """
-    return modelform_factory(model, form, **kwargs)
+    return cached_factory(modelform_factory, model, form, **kwargs)
 
 def ph_inlineformset_factory(parent_model, model, form=PhModelForm, **kwargs):
-    return inlineformset_factory(parent_model, model, form, **kwargs)
+    return cached_factory(inlineformset_factory, parent_model, model, form,
+                          **kwargs)
+
+def cached_modelform_factory(model, **kwargs):
+    return cached_factory(modelform_factory, model, **kwargs)
+
+def cached_modelformset_factory(model, **kwargs):
+    return cached_factory(modelformset_factory, model, **kwargs)
+
+def cached_inlineformset_factory(parent_model, model, **kwargs):
+    return cached_factory(inlineformset_factory, parent_model, model, **kwargs)
+
+
+def keyset_q(names, values, forward=True):
+    """
+    Q for (k1, k2, ...) > (v1, v2, ...), or < when going backward.
+    The leading k1 >= v1 term lets the database use a range scan.
+    """
+    op = "gt" if forward else "lt"
+    q = Q()
+    for i in range(len(names) - 1, -1, -1):
+        term = Q(**{"%s__%s" % (names[i], op): values[i]})
+        q = term if i == len(names) - 1 else term | (
+            Q(**{names[i]: values[i]}) & q)
+    return Q(**{"%s__%se" % (names[0], op): values[0]}) & q
@@ -1,28 +1,50 @@
+import time
+
+from django.conf import settings
+from django.contrib import messages
 from django.shortcuts import render
 from django.urls import reverse_lazy
-from django.core.exceptions import ImproperlyConfigured
+from django.utils.functional import SimpleLazyObject
+from django.core.exceptions import FieldError, ImproperlyConfigured
 
 from django.views.generic.edit import CreateView, ModelFormMixin
-from django.views.generic import ListView
+from django.views.generic import ListView, TemplateView
 from django.views.generic.base import ContextMixin, TemplateResponseMixin, View
 from django.views.generic.list import MultipleObjectMixin
 
-from django.forms import (
-    modelformset_factory, 
-    modelform_factory, 
-    inlineformset_factory,
-)
-
 from .models import (
     TwoInputFields, 
     Transaction, 
     TransactionRecord,
 )
 from django.contrib.admin.utils import flatten_fieldsets
-from django.db.models import ForeignKey
-from django.http import Http404
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import Prefetch
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpResponse,
+    HttpResponseBadRequest,
+    HttpResponseRedirect,
+    StreamingHttpResponse,
+)
 
-from .utils import ph_modelform_factory, ph_inlineformset_factory
+from . import balances, export, pagecache, reports, search
+from .instrumentation import timed_forms
+from .bulkload import check_balanced
+from .forms import LedgerFilterForm, SearchForm
+from .utils import (
+    CodeChoiceField,
+    CodeInlineFormSet,
+    cached_inlineformset_factory,
+    cached_modelform_factory,
+    cached_modelformset_factory,
+    first_foreign_key,
+    keyset_q,
+    ph_inlineformset_factory,
+    ph_modelform_factory,
+)
 
 
 def index(request):
@@ -35,12 +57,339 @@ class TwoInputCreateView(CreateView):
     template_name = "psqlj/add.html"
     success_url = reverse_lazy("psqlj:list")
 
+
+
+##############
+# Keyset (seek) pagination
+#   Pages are addressed by the key of the last/first row shown, not by
+#   OFFSET, so page 1000 costs the same index range scan as page 1.
+
+class KeysetPaginationMixin(MultipleObjectMixin):
+    """
+    Page a queryset ordered by keyset_fields, which must be unique
+    together (end with the primary key) and should be indexed.
+    ?after=<cursor> gives the next page, ?before=<cursor> the previous.
+    """
+    keyset_fields = ("pk",)
+    paginate_by = 50
+    cursor_separator = "~"
+
+    def get_keyset_fields(self):
+        return list(self.keyset_fields)
+
+    def _model_field(self, name):
+        opts = self.get_queryset().model._meta
+        return opts.pk if name == "pk" else opts.get_field(name)
+
+    def encode_cursor(self, obj):
+        return self.cursor_separator.join(
+            str(self._model_field(name).value_to_string(obj))
+            for name in self.get_keyset_fields()
+        )
+
+    def decode_cursor(self, cursor):
+        names = self.get_keyset_fields()
+        parts = cursor.split(self.cursor_separator)
+        if len(parts) != len(names):
+            raise Http404("Invalid page cursor.")
+        try:
+            return [
+                self._model_field(name).to_python(part)
+                for name, part in zip(names, parts)
+            ]
+        except ValidationError:
+            raise Http404("Invalid page cursor.")
+
+    def keyset_filter(self, values, forward=True):
+        return keyset_q(self.get_keyset_fields(), values, forward)
+
+    def keyset_queryset(self, queryset):
+        """
+        Order and filter queryset for the requested page.
+        Return it sliced to one row more than a page (to see if there
+        is more) and whether we are paging forward.
+        """
+        names = self.get_keyset_fields()
+        size = self.get_paginate_by(queryset)
+        after = self.request.GET.get("after")
+        before = self.request.GET.get("before")
+
+        forward = before is None
+        if forward:
+            queryset = queryset.order_by(*names)
+            if after:
+                queryset = queryset.filter(
+                    self.keyset_filter(self.decode_cursor(after)))
+        else:
+            queryset = queryset.order_by(*["-" + n for n in names]).filter(
+                self.keyset_filter(self.decode_cursor(before), forward=False))
+        return queryset[:size + 1], forward
+
+    def keyset_page(self, rows, forward):
+        """Build the page context from the rows of keyset_queryset()."""
+        size = self.get_paginate_by(None)
+        has_more = len(rows) > size
+        rows = rows[:size]
+        if not forward:
+            rows.reverse()
+
+        has_next = has_more if forward else True
+        has_previous = bool(self.request.GET.get("after")) if forward else has_more
+        return {
+            "object_list": rows,
+            "is_paginated": has_next or has_previous,
+            "has_next": has_next and bool(rows),
+            "has_previous": has_previous and bool(rows),
+            "next_cursor": self.encode_cursor(rows[-1]) if rows else None,
+            "previous_cursor": self.encode_cursor(rows[0]) if rows else None,
+        }
+
+    def paginate_keyset(self, queryset):
+        queryset, forward = self.keyset_queryset(queryset)
+        return self.keyset_page(list(queryset), forward)
+
+    def get_context_data(self, *, object_list=None, **kwargs):
+        queryset = object_list if object_list is not None else self.object_list
+        page = self.paginate_keyset(queryset)
+        context = {
+            "paginator": None,
+            "page_obj": None,
+            **page,
+        }
+        context_object_name = self.get_context_object_name(page["object_list"])
+        if context_object_name is not None:
+            context[context_object_name] = page["object_list"]
+        context.update(kwargs)
+        return ContextMixin.get_context_data(self, **context)
+
+
+class CachedPageMixin:
+    """
+    Serve GET pages from pagecache, keyed by the full path, until a write
+    to a model of cache_namespace gives the namespace a new version.
+    The response carries X-Cache: HIT or MISS.
+    """
+    cache_namespace = "journal"
+
+    def get_cache_vary(self):
+        return (self.request.get_full_path(),)
+
+    def dispatch(self, request, *args, **kwargs):
+        if (request.method not in ("GET", "HEAD") or not pagecache.enabled()
+                # the page would show (and cache) this user's messages
+                or len(messages.get_messages(request))):
+            return super().dispatch(request, *args, **kwargs)
+
+        name = "page:%s" % type(self).__name__
+        vary = self.get_cache_vary()
+        # before rendering: a write committed meanwhile must not be
+        # stored under its new version
+        current = pagecache.version(self.cache_namespace)
+        cached = pagecache.get(self.cache_namespace, name, vary, current)
+        if cached is not None:
+            content, content_type = cached
+            response = HttpResponse(content, content_type=content_type)
+            response["X-Cache"] = "HIT"
+            return response
+
+        response = super().dispatch(request, *args, **kwargs)
+        response["X-Cache"] = "MISS"
+
+        def store(response):
+            if response.status_code == 200:
+                pagecache.set(self.cache_namespace, name, vary,
+                              (response.content, response["Content-Type"]),
+                              current)
+
+        if hasattr(response, "add_post_render_callback"):
+            response.add_post_render_callback(store)
+        elif not response.streaming:
+            store(response)
+        return response
+
+
+class KeysetListView(KeysetPaginationMixin, ListView):
+    """ListView paged with KeysetPaginationMixin."""
+
     
-class TwoInputListView(ListView):
+class TwoInputListView(CachedPageMixin, KeysetListView):
+    replica_reads = True
+    cache_namespace = "twoinput"
     model = TwoInputFields
     template_name = "psqlj/list.html"
 
 
+class TransactionListView(CachedPageMixin, KeysetListView):
+    """Journal, newest page last, with the records of each transaction."""
+    replica_reads = True
+    model = Transaction
+    keyset_fields = ("tdate", "id")
+    template_name = "psqlj/transaction_list.html"
+
+    def get_queryset(self):
+        # one extra query per page for all the records of the page
+        return Transaction.objects.prefetch_related(
+            Prefetch(
+                "transactionrecord_set",
+                queryset=TransactionRecord.objects.select_related(
+                    "account").order_by("record_num"),
+                to_attr="records",
+            )
+        )
+
+
+
+class LedgerExportView(View):
+    """
+    Stream the general ledger as CSV (default) or XLSX.
+    GET params: start, end (YYYY-MM-DD), account, format=csv|xlsx.
+    """
+    replica_reads = True
+    chunk_size = export.DEFAULT_CHUNK_SIZE
+    filename = "ledger"
+
+    def get(self, request, *args, **kwargs):
+        form = LedgerFilterForm(request.GET)
+        if not form.is_valid():
+            return HttpResponseBadRequest(form.errors.as_text())
+        rows = export.ledger_rows(chunk_size=self.chunk_size,
+                                  **form.cleaned_data)
+
+        if request.GET.get("format") == "xlsx":
+            try:
+                tmp = export.xlsx_tempfile(rows)
+            except ImportError as e:
+                return HttpResponseBadRequest(str(e))
+            return FileResponse(
+                tmp, as_attachment=True, filename=self.filename + ".xlsx")
+
+        response = StreamingHttpResponse(
+            export.iter_csv(rows), content_type="text/csv")
+        response["Content-Disposition"] = (
+            'attachment; filename="%s.csv"' % self.filename)
+        return response
+
+
+##############
+# Reports (see reports.py), filtered by LedgerFilterForm
+
+class ReportView(TemplateView):
+    """Run report_function with the filters from the query string."""
+    replica_reads = True
+    report_function = None
+    require_range = False
+
+    def get_filters(self):
+        form = LedgerFilterForm(self.request.GET)
+        if form.is_valid():
+            filters = form.cleaned_data
+            if self.require_range and not (filters["start"] and filters["end"]):
+                form.add_error(None, "start and end are required.")
+            else:
+                return form, filters
+        return form, None
+
+    def get_report(self, filters):
+        return type(self).report_function(**filters)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form, filters = self.get_filters()
+        context["filter_form"] = form
+        # rows is lazy, the query only runs if the template's
+        # {% fragmentcache %} misses
+        context["rows"] = self.get_report(filters) if filters is not None else []
+        context["report_vary"] = sorted(filters.items()) if filters else ""
+        return context
+
+
+class TrialBalanceView(ReportView):
+    template_name = "psqlj/report_trial_balance.html"
+    report_function = reports.trial_balance
+
+
+class LedgerPage(list):
+    """The rows of one ledger page and the query strings of its links."""
+    first_query = next_query = None
+    is_paginated = False
+
+
+class AccountLedgerView(ReportView):
+    """The ledger, paginate_by records a page; next page with ?after=."""
+    template_name = "psqlj/report_ledger.html"
+    report_function = reports.account_ledger
+    paginate_by = 200
+
+    def get_after(self):
+        after = self.request.GET.get("after")
+        try:
+            return reports.decode_ledger_cursor(after) if after else None
+        except ValueError:
+            raise Http404("Invalid page cursor.")
+
+    def get_report(self, filters):
+        after = self.get_after()
+        return SimpleLazyObject(lambda: self.get_page(filters, after))
+
+    def get_page(self, filters, after):
+        size = self.paginate_by
+        rows = list(reports.account_ledger(**filters, after=after,
+                                           limit=size + 1))
+        page = LedgerPage(rows[:size])
+        query = self.request.GET.copy()
+        query.pop("after", None)
+        page.first_query = query.urlencode()
+        if len(rows) > size:
+            query["after"] = reports.encode_ledger_cursor(page[-1])
+            page.next_query = query.urlencode()
+        page.is_paginated = bool(page.next_query or after)
+        return page
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        if context["report_vary"]:
+            context["report_vary"].append(
+                ("after", self.request.GET.get("after", "")))
+        return context
+
+
+class PeriodCloseView(ReportView):
+    template_name = "psqlj/report_period_close.html"
+    report_function = reports.period_close
+    require_range = True
+
+
+class MonthlyTotalsView(ReportView):
+    template_name = "psqlj/report_monthly.html"
+    report_function = reports.monthly_totals
+
+
+class SearchView(TemplateView):
+    """Ranked transaction search, ?q=&account=, next page with ?after=."""
+    replica_reads = True
+    template_name = "psqlj/search.html"
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        form = SearchForm(self.request.GET)
+        page = {"results": [], "next": None}
+        if form.is_valid():
+            try:
+                page = search.search(**form.cleaned_data)
+            except ValueError:
+                raise Http404("Invalid search cursor.")
+        query = self.request.GET.copy()
+        query.pop("after", None)
+        first_query = query.urlencode()
+        next_query = None
+        if page["next"]:
+            query["after"] = page["next"]
+            next_query = query.urlencode()
+        context.update(search_form=form, results=page["results"],
+                       first_query=first_query, next_query=next_query,
+                       is_paginated=bool(next_query or form["after"].value()))
+        return context
+
 
 ##############
 # a Formset CreateView
@@ -62,6 +411,7 @@ class FormsetMixin(ContextMixin):
     def get_formset_class(self):
         return self.formset_class
 
+    @timed_forms
     def get_formset(self, formset_class=None):
         if formset_class is None:
             formset_class = self.get_formset_class()
@@ -118,7 +468,7 @@ class ModelFormsetMixin(FormsetMixin):
                     "Using ModelFormsetMixin without "
                     "the 'fields' attribute is prohibited."
                 )
-            return modelformset_factory(model, **self.get_modelformset_factory_kwargs())
+            return cached_modelformset_factory(model, **self.get_modelformset_factory_kwargs())
 
     def get_modelformset_factory_kwargs(self):
         kwargs = {
@@ -143,20 +493,115 @@ class ProcessFormsetView(View):
     
 
 class BaseMultipleCreateView(ModelFormsetMixin, ProcessFormsetView):
-    """Base view to create mulitple objects."""
+    """
+    Base view to create mulitple objects.
+
+    GET shows `extra` empty rows, or ?rows=N up to max_num.
+    POST does not build a ModelForm per row: each row is cleaned with the
+    model fields' own clean() and all rows are inserted with bulk_create
+    in chunks of batch_size. Only when a row is invalid is the full
+    formset built, to show the errors.
+    """
     extra = 10
-    max_num = 10
+    max_num = None          # settings.PSQLJ_BATCH_MAX_ROWS
+    batch_size = None       # settings.PSQLJ_BATCH_CHUNK_SIZE
+
+    def get_max_num(self):
+        return self.max_num or getattr(settings, "PSQLJ_BATCH_MAX_ROWS", 5000)
+
+    def get_batch_size(self):
+        return self.batch_size or getattr(settings, "PSQLJ_BATCH_CHUNK_SIZE", 1000)
+
+    def get_extra(self):
+        try:
+            rows = int(self.request.GET.get("rows", self.extra))
+        except ValueError:
+            rows = self.extra
+        return max(1, min(rows, self.get_max_num()))
 
     def get_modelformset_factory_kwargs(self):
         kwargs = super().get_modelformset_factory_kwargs()
         kwargs.update(
             {
                 "extra" : self.extra,
-                "max_num" : self.max_num,
+                "max_num" : self.get_max_num(),
+                "absolute_max" : self.get_max_num(),
+                "validate_max" : True,
             }
         )
         return kwargs
 
+    def get_formset(self, formset_class=None):
+        formset = super().get_formset(formset_class)
+        if not formset.is_bound:
+            # per instance, so ?rows= does not make a new formset class
+            formset.extra = self.get_extra()
+        return formset
+
+    def clean_row(self, values, index):
+        """Hook for checks across the fields of one row."""
+        return values
+
+    def clean_rows(self, formset):
+        """
+        Return the new (unsaved) objects of a bound formset, skipping
+        empty rows. Raise ValidationError if any row is invalid.
+        """
+        if not formset.management_form.is_valid():
+            raise ValidationError("Management form is missing or invalid.")
+        # total_form_count() is already capped at max_num, check the
+        # submitted count so extra rows are not dropped silently
+        if (formset.management_form.cleaned_data["TOTAL_FORMS"]
+                > self.get_max_num()):
+            raise ValidationError("Too many rows.")
+        model_fields = [self.model._meta.get_field(n) for n in self.fields]
+        data = formset.data
+        objs = []
+        errors = False
+        for i in range(formset.total_form_count()):
+            prefix = formset.add_prefix(i)
+            # stripped, as the form fields of a ModelForm would
+            raw = {f.name: data.get("%s-%s" % (prefix, f.name), "").strip()
+                   for f in model_fields}
+            if not any(raw.values()):
+                continue
+            try:
+                values = {f.name: f.clean(raw[f.name], None)
+                          for f in model_fields}
+                objs.append(self.model(**self.clean_row(values, i)))
+            except ValidationError:
+                errors = True
+        if errors:
+            raise ValidationError("Some rows are invalid.")
+        return objs
+
+    def save_rows(self, objs):
+        with transaction.atomic():
+            created = self.model.objects.bulk_create(
+                objs, batch_size=self.get_batch_size())
+            # bulk_create sends no post_save
+            pagecache.invalidate_model(self.model)
+        return created
+
+    def rows_saved(self, created, elapsed):
+        messages.success(
+            self.request,
+            "Inserted %d rows in %.3f s." % (len(created), elapsed),
+        )
+        return HttpResponseRedirect(self.get_success_url())
+
+    def post(self, request, *args, **kwargs):
+        start = time.perf_counter()
+        formset = self.get_formset()
+        try:
+            objs = self.clean_rows(formset)
+        except ValidationError:
+            # build the forms now, for their error messages
+            formset.is_valid()
+            return self.form_invalid(formset)
+        created = self.save_rows(objs)
+        return self.rows_saved(created, time.perf_counter() - start)
+
 class TwoInputMultipleCreateView(TemplateResponseMixin, BaseMultipleCreateView):
     """Finally, a View to create multiple objects."""
 
@@ -204,6 +649,10 @@ class TmpFieldsetsMixin(ModelFormMixin):
     fieldsets = None
     object = None
 
+    @timed_forms
+    def get_form(self, form_class=None):
+        return super().get_form(form_class)
+
     def get_fields(self):
         if self.fieldsets:
             return flatten_fieldsets(self.fieldsets)
@@ -239,13 +688,14 @@ class MainFormMixin(TmpFieldsetsMixin):
             )
 
         try:
-            return modelform_factory(model, fields=fields)
+            return cached_modelform_factory(model, fields=fields)
         except FieldError as e:
             raise FieldError(
                 "%s. Check fieldsets/fields attributes of class %s."
                 % (e, self.__class__.__name__)
             )
 
+    @timed_forms
     def create_formsets(self):
         if self.inline:
             inline = self.inline()
@@ -272,7 +722,7 @@ class InlineFormsetMixin(TmpFieldsetsMixin):
             "fields": self.get_fields(),
             **kwargs,
         }
-        return inlineformset_factory(self.parent_model, self.model, **defaults) 
+        return cached_inlineformset_factory(self.parent_model, self.model, **defaults)
 
     def get_formset_kwargs(self, **kwargs_ext):
         kwargs = {
@@ -318,6 +768,10 @@ class FieldsetsModelFormMixin(ModelFormMixin):
     fieldsets = None
     object = None
 
+    @timed_forms
+    def get_form(self, form_class=None):
+        return super().get_form(form_class)
+
     def get_fields(self):
         if self.fieldsets:
             return flatten_fieldsets(self.fieldsets)
@@ -368,8 +822,12 @@ class MasterModelFormMixin(FieldsetsModelFormMixin):
             )
 
 
+    @timed_forms
     def get_inline_formset(self, **extfsparams):
         if self.inline:
+            if self.request.method in ("POST", "PUT"):
+                extfsparams.setdefault("data", self.request.POST)
+                extfsparams.setdefault("files", self.request.FILES)
             # Instantiate the inline model wrapper
             iw = self.inline()      
             Formset        = iw.create_formset()
@@ -396,6 +854,63 @@ class MasterModelFormMixin(FieldsetsModelFormMixin):
             context["inlineformset"] = self.get_inline_formset(**formset_kwargs)
         return context
 
+    def clean_inlines(self, form, formset):
+        """
+        Cross-row validation of the whole form + formset, in Python.
+        Raise ValidationError to reject. Runs before any SQL is sent.
+        """
+
+    def prepare_inline(self, obj, index):
+        """Hook to set fields the inline form does not show."""
+
+    def get_inline_update_fields(self, formset):
+        return list(formset.form._meta.fields)
+
+    def save_inline_formset(self, formset, parent):
+        """
+        Save the inline rows set-based: one bulk_create for new rows,
+        one bulk_update for changed rows, one DELETE for removed rows.
+        """
+        fk_name = formset.fk.name
+        new, changed, removed = [], [], []
+        index = 0
+        for f in formset.forms:
+            obj = f.instance
+            if formset.can_delete and formset._should_delete_form(f):
+                if obj.pk is not None:
+                    removed.append(obj.pk)
+                continue
+            if obj.pk is None and not f.has_changed():
+                continue        # untouched extra form
+            index += 1
+            setattr(obj, fk_name, parent)
+            self.prepare_inline(obj, index)
+            if obj.pk is None:
+                new.append(obj)
+            else:
+                changed.append(obj)
+
+        model = formset.model
+        if removed:
+            model._default_manager.filter(pk__in=removed).delete()
+        if changed:
+            model._default_manager.bulk_update(
+                changed, self.get_inline_update_fields(formset))
+        if new:
+            model._default_manager.bulk_create(new)
+        return new, changed, removed
+
+    def forms_valid(self, form, formset):
+        with transaction.atomic():
+            self.object = form.save()
+            if formset is not None:
+                self.save_inline_formset(formset, self.object)
+        return HttpResponseRedirect(self.get_success_url())
+
+    def forms_invalid(self, form, formset):
+        return self.render_to_response(
+            self.get_context_data(form=form, inlineformset=formset))
+
 
 class InlineModelFormMixin(FieldsetsModelFormMixin):
     """Wrapper for inline-model"""
@@ -408,13 +923,9 @@ class InlineModelFormMixin(FieldsetsModelFormMixin):
         return self.fk_name
 
     def _get_default_fk_field(self):
-        """Save the first Foreign Key field."""
-        opts = self.model._meta
-        for f in opts.fields:
-            if isinstance(f, ForeignKey):
-                self._default_fkfield = f
-                #breakpoint()
-                return f
+        """Save the first Foreign Key field (looked up once per model)."""
+        self._default_fkfield = first_foreign_key(self.model)
+        return self._default_fkfield
 
     def get_default_fk_name(self):
         if self._default_fkfield is None:
@@ -474,7 +985,19 @@ class ProcessMasterFormView(View):
         return self.render_to_response(self.get_context_data())
 
     def post(self, request, *args, **kwargs):
-        raise Http404("Post not ready yet")
+        form = self.get_form()
+        formset = self.get_inline_formset(instance=form.instance)
+        valid = form.is_valid()
+        valid = (formset is None or formset.is_valid()) and valid
+        if valid:
+            try:
+                self.clean_inlines(form, formset)
+            except ValidationError as e:
+                form.add_error(None, e)
+                valid = False
+        if valid:
+            return self.forms_valid(form, formset)
+        return self.forms_invalid(form, formset)
 
     def put(self, *args, **kwargs):
         return self.post(*args, **kwargs)
@@ -487,15 +1010,19 @@ class BaseMasterCreateView(MasterModelFormMixin, ProcessMasterFormView):
 
 class InlineModelWrapper(InlineModelFormMixin):
     model = TransactionRecord
-    fields = ["account", "amount"]
+    fields = ["account", "amount", "side"]
     help_texts = {
             "account": "Account no...",
             "amount" : "Amount...",
+            "side"   : "Debit/Credit",
         }
 
     def get_createformset_kwargs(self):
         kwargs = super().get_createformset_kwargs()
         kwargs["help_texts"] = self.help_texts
+        # account is typed as a code, looked up once for the formset
+        kwargs["formset"] = CodeInlineFormSet
+        kwargs["field_classes"] = {"account": CodeChoiceField}
         return kwargs
 
 
@@ -508,4 +1035,35 @@ class MasterCreateView(TemplateResponseMixin, BaseMasterCreateView):
         }
     template_name = "psqlj/psqlj_createview.html"
     inline = InlineModelWrapper
+    success_url = reverse_lazy("psqlj:journal")
+
+    def clean_inlines(self, form, formset):
+        records = [
+            f.cleaned_data for f in formset.forms
+            if f.cleaned_data and not (
+                formset.can_delete and formset._should_delete_form(f))
+        ]
+        if len(records) < 2:
+            raise ValidationError("A transaction needs at least 2 records.")
+        check_balanced(records)
+
+    def prepare_inline(self, obj, index):
+        obj.record_num = index
+
+    def get_inline_update_fields(self, formset):
+        return super().get_inline_update_fields(formset) + ["record_num"]
+
+    def forms_valid(self, form, formset):
+        # Signals would update the balances row by row, apply one delta
+        # for the whole transaction instead.
+        with transaction.atomic():
+            old_rows = []
+            if form.instance.pk is not None:
+                old_rows = list(
+                    balances.rows_of_transactions([form.instance.pk]))
+            with balances.suspended():
+                response = super().forms_valid(form, formset)
+            balances.replace_records(
+                old_rows, balances.rows_of_transactions([self.object.pk]))
+        return response
 